@@ -7,9 +7,13 @@
 import numpy as np
 from torch.utils.data import DataLoader
 from torch.utils.data.dataloader import default_collate
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.sampler import SubsetRandomSampler, RandomSampler, SequentialSampler, BatchSampler
 
-__all__ = ['BaseDataLoader']
+__all__ = ['BaseDataLoader', 'BatchDataLoader']
+
+
+def _batch_collate(batch):
+    return batch[0]
 
 
 class BaseDataLoader(DataLoader):
@@ -64,3 +68,19 @@ class BaseDataLoader(DataLoader):
             return None
         else:
             return DataLoader(sampler=self.valid_sampler, **self.init_kwargs)
+
+
+class BatchDataLoader(DataLoader):
+    """
+    hand a whole batch of indexes to the dataset in one __getitem__ call, the dataset returns the collated batch
+    """
+
+    def __init__(self, dataset, batch_size, shuffle, num_workers=4, drop_last=False):
+        self.shuffle = shuffle
+        self.n_samples = len(dataset)
+
+        sampler = RandomSampler(dataset) if self.shuffle else SequentialSampler(dataset)
+        self.batch_index_sampler = BatchSampler(sampler, batch_size, drop_last)
+
+        super(BatchDataLoader, self).__init__(dataset, batch_size=1, sampler=self.batch_index_sampler,
+                                              collate_fn=_batch_collate, num_workers=num_workers)
@@ -6,19 +6,24 @@
 # @Software: PyCharm
 import os
 
+import numpy as np
 import torch
 from PIL import Image
 from torch.utils import data
 from torchvision import transforms
 
-from utils import load_face_from_pickle, load_train_gt_from_txt, check_exists, default_face_scene_target_transforms, \
+from utils import load_train_gt_from_txt, check_exists, default_face_scene_target_transforms, \
     load_val_gt_from_txt, default_scene_pre_progress, default_scene_transforms, default_scene_target_transforms, \
-    load_scene_infos, default_scene_feat_pre_progress, default_scene_feat_remove_noise, default_scene_feat_transforms, \
+    default_scene_feat_pre_progress, default_scene_feat_remove_noise, default_scene_feat_transforms, \
     default_scene_feat_target_transforms, default_fine_tune_pre_progress, default_fine_tune_transforms, \
     default_fine_tune_target_transforms, default_face_scene_pre_progress, sep_cat_qds_face_scene_transforms, \
-    default_face_scene_remove_noise_in_val
+    default_face_scene_remove_noise_in_val, pack_face_scene_vid_infos, sep_cat_qds_face_scene_batch_transforms, \
+    FACE_STORE_COLUMNS, select_feats_by_mask, share_pack_memory, get_pack_arrays, load_or_build_pack, \
+    get_face_store_root, get_scene_store_root, load_image_manifest, load_face_source, load_scene_source, \
+    get_face_store_infos, get_scene_store_infos, pack_store_rows, load_face_store, load_scene_store
 
-__all__ = ['IQiYiExtractSceneDataset', 'IQiYiSceneFeatDataset', 'IQiYiFineTuneSceneDataset', 'IQiYiFaceSceneDataset', ]
+__all__ = ['IQiYiExtractSceneDataset', 'IQiYiSceneFeatDataset', 'IQiYiFineTuneSceneDataset', 'IQiYiFaceSceneDataset',
+           'get_multi_view_dataset', ]
 
 FEAT_PATH = 'feat'
 IMAGE_PATH = 'img'
@@ -34,10 +39,24 @@ SCENE_TEST_NAME = 'scene_infos_test.pickle'
 TRAIN_GT_NAME = 'train_gt.txt'
 VAL_GT_NAME = 'val_gt.txt'
 
+EXTRACT_IMAGE_SIZE = (224, 224)
+FINE_TUNE_IMAGE_SIZE = (256, 256)
+
+
+def _open_image(image_path, draft_size=None):
+    """
+    with draft_size a JPEG is decoded at the smallest DCT scale (1/2, 1/4 or 1/8) still not smaller than draft_size,
+    the other formats are decoded at full size
+    """
+    image_data = Image.open(image_path)
+    if draft_size is not None:
+        image_data.draft('RGB', draft_size)
+    return image_data.convert('RGB')
+
 
 class IQiYiExtractSceneDataset(data.Dataset):
     def __init__(self, root, tvt='train', transform=None, target_transform=None, pre_progress=None, image_root=None,
-                 **kwargs):
+                 cache_root=None, draft=False, **kwargs):
         assert check_exists(root)
         assert tvt in ['train', 'val', 'test', ]
 
@@ -46,13 +65,15 @@ class IQiYiExtractSceneDataset(data.Dataset):
         self.transform = transform
         self.target_transform = target_transform
         self.pre_progress = pre_progress
+        self.cache_root = cache_root
+        self.draft_size = EXTRACT_IMAGE_SIZE if draft else None
         self.kwargs = kwargs
         self.image_root = os.path.join(self.root, IMAGE_PATH) \
             if (image_root is None or not check_exists(image_root)) else image_root
 
         # get the code from https://github.com/CSAILVision/places365/blob/master/run_placesCNN_unified.py
         self.augm_func = transforms.Compose([
-            transforms.Resize((224, 224)),
+            transforms.Resize(EXTRACT_IMAGE_SIZE),
             transforms.ToTensor(),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         ])
@@ -73,8 +94,10 @@ class IQiYiExtractSceneDataset(data.Dataset):
         self._init_feat_labels()
 
     def _init_feat_labels(self):
+        # the frames are picked from the sorted image names of the manifest instead of the listdir order
+        image_manifest = load_image_manifest(self.image_root, self.cache_root)
         self.image_paths, self.video_names, self.image_indexes \
-            = self.pre_progress(self.tvt, self.image_root, **self.kwargs)
+            = self.pre_progress(self.tvt, self.image_root, image_manifest=image_manifest, **self.kwargs)
         self.length = len(self.image_paths)
         print(self.length)
 
@@ -85,7 +108,7 @@ class IQiYiExtractSceneDataset(data.Dataset):
         image_path = self.image_paths[index]
         video_name = self.video_names[index]
         image_index = self.image_indexes[index]
-        image_data = Image.open(image_path).convert('RGB')
+        image_data = _open_image(image_path, self.draft_size)
         image_data = self.transform(image_data, self.augm_func)
         return image_data, video_name, image_index
 
@@ -94,7 +117,8 @@ class IQiYiExtractSceneDataset(data.Dataset):
 
 
 class IQiYiSceneFeatDataset(data.Dataset):
-    def __init__(self, root, tvt='train', transform=None, target_transform=None, pre_progress=None, **kwargs):
+    def __init__(self, root, tvt='train', transform=None, target_transform=None, pre_progress=None, cache_root=None,
+                 **kwargs):
         assert check_exists(root)
         assert tvt in ['train', 'val', 'train+val', 'train+val-noise', 'test', ]
 
@@ -103,6 +127,7 @@ class IQiYiSceneFeatDataset(data.Dataset):
         self.transform = transform
         self.target_transform = target_transform
         self.pre_progress = pre_progress
+        self.cache_root = cache_root
         self.kwargs = kwargs
 
         if self.pre_progress is None:
@@ -136,39 +161,83 @@ class IQiYiSceneFeatDataset(data.Dataset):
 
         self._init_feat_labels()
 
-    def _init_feat_labels(self):
+    def _get_feats_paths(self):
+        if self.tvt == 'train+val' or self.tvt == 'train+val-noise':
+            return [self.train_feats_path, self.val_feats_path]
+        return [self.feats_path]
+
+    def _get_source_paths(self):
+        if self.tvt == 'train+val' or self.tvt == 'train+val-noise':
+            gt_paths = [self.train_gt_path, self.val_gt_path]
+        else:
+            gt_paths = [self.gt_path] if self.gt_path is not None else []
+        feats_paths = self._get_feats_paths()
+        return feats_paths + [get_scene_store_root(feats_path) for feats_path in feats_paths] + gt_paths
+
+    def _build_pack(self):
+        scene_stores = [load_scene_source(feats_path) for feats_path in self._get_feats_paths()]
+        scene_infos = {}
+        for scene_store in scene_stores:
+            scene_infos.update(get_scene_store_infos(scene_store))
+
         if self.tvt == 'train':
-            scene_infos = load_scene_infos(self.feats_path)
             gt_labels = load_train_gt_from_txt(self.gt_path)
         elif self.tvt == 'val':
-            scene_infos = load_scene_infos(self.feats_path)
             gt_labels = load_val_gt_from_txt(self.gt_path)
         elif self.tvt == 'train+val' or self.tvt == 'train+noise' or self.tvt == 'train+val-noise':
-            scene_infos = {}
-            scene_infos.update(load_scene_infos(self.train_feats_path))
-            scene_infos.update(load_scene_infos(self.val_feats_path))
-
             gt_labels = {}
             gt_labels.update(load_train_gt_from_txt(self.train_gt_path))
             gt_labels.update(load_val_gt_from_txt(self.val_gt_path))
         else:
-            scene_infos = load_scene_infos(self.feats_path)
             gt_labels = {}
 
-        self.frame_infos, self.labels, self.video_names \
-            = self.pre_progress(scene_infos, gt_labels, **self.kwargs)
+        frame_infos, labels, video_names = self.pre_progress(scene_infos, gt_labels, **self.kwargs)
         if self.tvt == 'train+val-noise':
-            self.frame_infos, self.labels, self.video_names \
-                = default_scene_feat_remove_noise(self.frame_infos, self.labels, self.video_names, **self.kwargs)
-        self.length = len(self.frame_infos)
+            frame_infos, labels, video_names \
+                = default_scene_feat_remove_noise(frame_infos, labels, video_names, **self.kwargs)
+
+        # only the rows of the videos are packed, the scene stores of the pickles are cached with them
+        return {'scene': pack_store_rows(video_names, scene_stores),
+                'scene_pickle': {str(store_idx): scene_store for store_idx, scene_store in enumerate(scene_stores)
+                                 if not os.path.isdir(get_scene_store_root(self._get_feats_paths()[store_idx]))},
+                'labels': np.array(labels, dtype=np.int64),
+                'video_names': np.array(video_names, dtype=np.str_)}
+
+    def _open_stores(self):
+        scene_pickle = self.pack.get('scene_pickle', {})
+        self.scene_stores = [scene_pickle[str(store_idx)] if str(store_idx) in scene_pickle
+                             else load_scene_store(get_scene_store_root(feats_path))
+                             for store_idx, feats_path in enumerate(self._get_feats_paths())]
+
+    def _init_feat_labels(self):
+        self.pack = load_or_build_pack(self.cache_root, 'scene_feat_{}'.format(self.tvt), self._get_source_paths(),
+                                       self._build_pack, pre_progress=self.pre_progress.__name__)
+        self.labels, self.video_names = self.pack['labels'], self.pack['video_names']
+        self.length = len(self.labels)
+        self._open_stores()
+
+        assert len(self.pack['scene']['row']) == len(self.labels)
+        assert len(self.labels) == len(self.video_names)
 
-        assert len(self.frame_infos) == len(self.labels)
-        assert len(self.frame_infos) == len(self.video_names)
+        # the mask is selected on the feats of a video when it is taken, the transform never selects again
+        self.mask_index = self.kwargs.pop('mask_index', None)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the memmaps of the stores are opened again in the worker instead of being pickled as copies
+        state['scene_stores'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open_stores()
 
     def __getitem__(self, index):
-        frame_info = self.frame_infos[index]
+        frame_info = self.scene_stores[self.pack['scene']['store'][index]]['feat'][self.pack['scene']['row'][index]]
+        if self.mask_index is not None:
+            frame_info = select_feats_by_mask(frame_info, self.mask_index)
         label = self.labels[index]
-        video_name = self.video_names[index]
+        video_name = str(self.video_names[index])
 
         feat = self.transform(frame_info, **self.kwargs)
         label = self.target_transform(label, **self.kwargs)
@@ -181,7 +250,7 @@ class IQiYiSceneFeatDataset(data.Dataset):
 
 class IQiYiFineTuneSceneDataset(data.Dataset):
     def __init__(self, root, tvt='train', transform=None, target_transform=None, pre_progress=None, image_root=None,
-                 **kwargs):
+                 cache_root=None, draft=False, **kwargs):
         assert check_exists(root)
         assert tvt in ['train', 'val-noise', 'train+val-noise']
 
@@ -190,12 +259,14 @@ class IQiYiFineTuneSceneDataset(data.Dataset):
         self.transform = transform
         self.target_transform = target_transform
         self.pre_progress = pre_progress
+        self.cache_root = cache_root
+        self.draft_size = FINE_TUNE_IMAGE_SIZE if draft else None
         self.kwargs = kwargs
         self.image_root = os.path.join(self.root, IMAGE_PATH) \
             if (image_root is None or not check_exists(image_root)) else image_root
 
         self.augm_func_train = transforms.Compose([
-            transforms.Resize((256, 256)),
+            transforms.Resize(FINE_TUNE_IMAGE_SIZE),
             transforms.RandomCrop((224, 224)),
             transforms.RandomHorizontalFlip(p=0.5),
             transforms.ToTensor(),
@@ -246,8 +317,9 @@ class IQiYiFineTuneSceneDataset(data.Dataset):
         else:
             raise RuntimeError
 
+        image_manifest = load_image_manifest(self.image_root, self.cache_root)
         self.image_paths, self.labels, self.video_names \
-            = self.pre_progress(gt_infos, self.image_root, **self.kwargs)
+            = self.pre_progress(gt_infos, self.image_root, image_manifest=image_manifest, **self.kwargs)
         self.length = len(self.image_paths)
 
         assert len(self.image_paths) == len(self.labels)
@@ -263,7 +335,7 @@ class IQiYiFineTuneSceneDataset(data.Dataset):
         video_name = self.video_names[index]
         image_data_list = []
         for image_path in image_paths:
-            image_data = Image.open(image_path).convert('RGB')
+            image_data = _open_image(image_path, self.draft_size)
             image_data = self.transform(image_data, self.augm_func_val if self.is_val else self.augm_func_train)
             image_data_list.append(image_data.view(1, *image_data.size()))
         images_data = torch.cat(image_data_list, dim=0)
@@ -277,7 +349,7 @@ class IQiYiFineTuneSceneDataset(data.Dataset):
 
 class IQiYiFaceSceneDataset(data.Dataset):
     def __init__(self, face_root, scene_root, tvt='train', transform=None, target_transform=None, pre_progress=None,
-                 **kwargs):
+                 batch_transform=None, share_memory=False, cache_root=None, **kwargs):
         assert check_exists(face_root)
         assert check_exists(scene_root)
         assert tvt in ['train', 'val', 'train+val', 'train+val-noise', 'test', ]
@@ -288,12 +360,18 @@ class IQiYiFaceSceneDataset(data.Dataset):
         self.transform = transform
         self.target_transform = target_transform
         self.pre_progress = pre_progress
+        self.batch_transform = batch_transform
+        self.share_memory = share_memory
+        self.shared_pack = None
+        self.cache_root = cache_root
         self.kwargs = kwargs
 
         if self.pre_progress is None:
             self.pre_progress = default_face_scene_pre_progress
         if self.transform is None:
             self.transform = sep_cat_qds_face_scene_transforms
+        if self.batch_transform is None:
+            self.batch_transform = sep_cat_qds_face_scene_batch_transforms
         if self.target_transform is None:
             self.target_transform = default_face_scene_target_transforms
 
@@ -319,39 +397,126 @@ class IQiYiFaceSceneDataset(data.Dataset):
 
         self._init_feat_labels()
 
-    def _init_feat_labels(self):
+    def _get_feats_paths(self):
+        if self.tvt == 'train+val' or self.tvt == 'train+val-noise':
+            return [self.train_face_feats_path, self.val_face_feats_path], \
+                   [self.train_scene_feats_path, self.val_scene_feats_path]
+        return [self.face_feats_path], [self.scene_feats_path]
+
+    def _get_source_paths(self):
+        if self.tvt == 'train+val' or self.tvt == 'train+val-noise':
+            gt_paths = [self.train_gt_path, self.val_gt_path]
+        else:
+            gt_paths = [self.gt_path] if self.gt_path is not None else []
+        face_feats_paths, scene_feats_paths = self._get_feats_paths()
+        return face_feats_paths + [get_face_store_root(feats_path) for feats_path in face_feats_paths] \
+            + scene_feats_paths + [get_scene_store_root(feats_path) for feats_path in scene_feats_paths] + gt_paths
+
+    def _build_pack(self):
+        face_feats_paths, scene_feats_paths = self._get_feats_paths()
+        face_stores = [load_face_source(feats_path) for feats_path in face_feats_paths]
+        scene_stores = [load_scene_source(feats_path) for feats_path in scene_feats_paths]
+
+        face_feat_info = []
+        for face_store in face_stores:
+            face_feat_info += get_face_store_infos(face_store)
+        scene_feat_info = {}
+        for scene_store in scene_stores:
+            scene_feat_info.update(get_scene_store_infos(scene_store))
+
         if self.tvt == 'train':
-            face_feat_info = load_face_from_pickle(self.face_feats_path)
-            scene_feat_info = load_scene_infos(self.scene_feats_path)
             gt_labels = load_train_gt_from_txt(self.gt_path)
         elif self.tvt == 'val':
-            face_feat_info = load_face_from_pickle(self.face_feats_path)
-            scene_feat_info = load_scene_infos(self.scene_feats_path)
             gt_labels = load_val_gt_from_txt(self.gt_path)
         elif self.tvt == 'train+val' or self.tvt == 'train+val-noise':
-            face_feat_info = []
-            face_feat_info += load_face_from_pickle(self.train_face_feats_path)
-            face_feat_info += load_face_from_pickle(self.val_face_feats_path)
-
-            scene_feat_info = {}
-            scene_feat_info.update(load_scene_infos(self.train_scene_feats_path))
-            scene_feat_info.update(load_scene_infos(self.val_scene_feats_path))
-
             gt_labels = {}
             gt_labels.update(load_train_gt_from_txt(self.train_gt_path))
             gt_labels.update(load_val_gt_from_txt(self.val_gt_path))
         else:
-            face_feat_info = load_face_from_pickle(self.face_feats_path)
-            scene_feat_info = load_scene_infos(self.scene_feats_path)
             gt_labels = {}
 
-        self.vid_infos = self.pre_progress(face_feat_info, scene_feat_info, gt_labels, **self.kwargs)
+        vid_infos = self.pre_progress(face_feat_info, scene_feat_info, gt_labels, **self.kwargs)
         if self.tvt == 'train+val-noise':
-            self.vid_infos = default_face_scene_remove_noise_in_val(self.vid_infos, **self.kwargs)
-        self.length = len(self.vid_infos)
+            vid_infos = default_face_scene_remove_noise_in_val(vid_infos, **self.kwargs)
+
+        # only the rows of the videos are packed, the face and scene stores of the pickles are cached with them
+        pack = pack_face_scene_vid_infos(vid_infos, face_stores, scene_stores)
+        pack['face_pickle'] = {str(store_idx): face_store for store_idx, face_store in enumerate(face_stores)
+                               if not os.path.isdir(get_face_store_root(face_feats_paths[store_idx]))}
+        pack['scene_pickle'] = {str(store_idx): scene_store for store_idx, scene_store in enumerate(scene_stores)
+                                if not os.path.isdir(get_scene_store_root(scene_feats_paths[store_idx]))}
+        return pack
+
+    def _open_stores(self):
+        face_feats_paths, scene_feats_paths = self._get_feats_paths()
+        face_pickle = self.pack.get('face_pickle', {})
+        scene_pickle = self.pack.get('scene_pickle', {})
+        self.face_stores = [face_pickle[str(store_idx)] if str(store_idx) in face_pickle
+                            else load_face_store(get_face_store_root(feats_path))
+                            for store_idx, feats_path in enumerate(face_feats_paths)]
+        self.scene_stores = [scene_pickle[str(store_idx)] if str(store_idx) in scene_pickle
+                             else load_scene_store(get_scene_store_root(feats_path))
+                             for store_idx, feats_path in enumerate(scene_feats_paths)]
+
+    def _init_feat_labels(self):
+        self.pack = load_or_build_pack(self.cache_root, 'face_scene_{}'.format(self.tvt), self._get_source_paths(),
+                                       self._build_pack, pre_progress=self.pre_progress.__name__)
+        self.length = len(self.pack['labels'])
+
+        # the masks are selected on the feats gathered for a video or a batch, the transforms never select again
+        self.face_mask = self.kwargs.pop('face_mask', None)
+        self.scene_mask = self.kwargs.pop('scene_mask', None)
+
+        # the pack arrays become views of shared memory tensors, pickling the dataset for a worker sends only handles
+        if self.share_memory:
+            self.shared_pack = share_pack_memory(self.pack)
+            self.pack = get_pack_arrays(self.shared_pack)
+        self._open_stores()
+
+    def _get_vid_info(self, index):
+        face_store = self.face_stores[self.pack['face']['store'][index]]
+        start, end = self.pack['face']['start'][index], self.pack['face']['end'][index]
+        face_frame_infos = {column: face_store[column][start:end] for column in FACE_STORE_COLUMNS}
+        scene_feats = self.scene_stores[self.pack['scene']['store'][index]]['feat'][self.pack['scene']['row'][index]]
+        if self.face_mask is not None:
+            face_frame_infos['feat'] = select_feats_by_mask(face_frame_infos['feat'], self.face_mask)
+        if self.scene_mask is not None:
+            scene_feats = select_feats_by_mask(scene_feats, self.scene_mask)
+
+        return {'face': face_frame_infos,
+                'scene': scene_feats,
+                'label': self.pack['labels'][index],
+                'video_name': str(self.pack['video_names'][index])}
+
+    def get_batch(self, indexes):
+        face_feats, scene_feats = self.batch_transform(self.pack, indexes, self.face_stores, self.scene_stores,
+                                                       face_mask=self.face_mask, scene_mask=self.scene_mask,
+                                                       **self.kwargs)
+        labels = self.target_transform(self.pack['labels'][indexes], **self.kwargs)
+        video_names = self.pack['video_names'][indexes].tolist()
+
+        return face_feats, scene_feats, labels, video_names
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the memmaps of the stores are opened again in the worker instead of being pickled as copies
+        state['face_stores'] = None
+        state['scene_stores'] = None
+        if self.shared_pack is not None:
+            state['pack'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared_pack is not None:
+            self.pack = get_pack_arrays(self.shared_pack)
+        self._open_stores()
 
     def __getitem__(self, index):
-        vid_info = self.vid_infos[index]
+        if isinstance(index, (list, tuple, np.ndarray)):
+            return self.get_batch(index)
+
+        vid_info = self._get_vid_info(index)
         label = vid_info['label']
         video_name = vid_info['video_name']
 
@@ -362,3 +527,13 @@ class IQiYiFaceSceneDataset(data.Dataset):
 
     def __len__(self):
         return self.length
+
+
+def get_multi_view_dataset(model_type, face_root, scene_root, tvt, num_frame=40, compact=False, cache_root=None):
+    """
+    the unmasked dataset of the face_scene or scene multi view models, every model selects its own view of it
+    """
+    if model_type == 'face_scene':
+        return IQiYiFaceSceneDataset(face_root, scene_root, tvt, num_frame=num_frame,
+                                     feat_dtype=np.float16 if compact else np.float32, cache_root=cache_root)
+    return IQiYiSceneFeatDataset(scene_root, tvt, cache_root=cache_root)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from datasets import IQiYiFaceSceneDataset, IQiYiExtractSceneDataset, BatchDataLoader
+from datasets.iqiyi_dataset import FEAT_PATH, FACE_VAL_NAME, SCENE_VAL_NAME, VAL_GT_NAME, EXTRACT_IMAGE_SIZE, \
+    _open_image
+from utils import get_mask_index
+
+"""
+the batched loading and the draft decoding of the datasets against the per index loading and the full decoding
+of the baseline
+"""
+
+FACE_DIM = 512
+SCENE_DIM = 8
+
+
+def _make_face_scene_roots(tmpdir, num_video=23, seed=0):
+    """
+    a val face pickle, scene pickle and gt of num_video videos, every face of a video is unique
+    """
+    rng = np.random.RandomState(seed)
+    face_root = str(tmpdir.mkdir('face'))
+    scene_root = str(tmpdir.mkdir('scene'))
+    os.makedirs(os.path.join(face_root, FEAT_PATH))
+
+    face_feats_dict = {}
+    scene_infos = {}
+    for video_idx in range(num_video):
+        video_name = 'IQIYI_VID_VAL_{:0>7d}'.format(video_idx)
+        face_feats_dict[video_name.encode('utf-8')] = [
+            ['{}'.format(frame_idx), [1., 2., 3., 4.], float(rng.rand()), float(rng.rand() * 100.),
+             rng.randn(FACE_DIM).astype(np.float16)] for frame_idx in range(rng.randint(1, 9))]
+        scene_infos[video_name] = [(1, rng.randn(SCENE_DIM).astype(np.float32))]
+
+    with open(os.path.join(face_root, FEAT_PATH, FACE_VAL_NAME), 'wb') as fout:
+        pickle.dump(face_feats_dict, fout)
+    with open(os.path.join(scene_root, SCENE_VAL_NAME), 'wb') as fout:
+        pickle.dump(scene_infos, fout)
+    with open(os.path.join(face_root, VAL_GT_NAME), 'w') as fout:
+        for class_id in range(1, 4):
+            fout.write('{} {}\n'.format(class_id, ' '.join('IQIYI_VID_VAL_{:0>7d}.mp4'.format(video_idx)
+                                                           for video_idx in range(num_video)
+                                                           if video_idx % 4 == class_id)))
+    return face_root, scene_root, face_feats_dict
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_batch_data_loader(tmpdir, shuffle):
+    face_root, scene_root, face_feats_dict = _make_face_scene_roots(tmpdir)
+    dataset = IQiYiFaceSceneDataset(face_root, scene_root, 'val', num_frame=4)
+
+    # the same seed draws the same order of the videos for both loaders
+    torch.manual_seed(0)
+    batches = list(BatchDataLoader(dataset, batch_size=5, shuffle=shuffle, num_workers=0))
+    torch.manual_seed(0)
+    ref_batches = list(DataLoader(dataset, batch_size=5, shuffle=shuffle, num_workers=0))
+
+    assert len(batches) == len(ref_batches) == 5
+    for (face_feats, scene_feats, labels, video_names), (ref_face_feats, ref_scene_feats, ref_labels, ref_video_names) \
+            in zip(batches, ref_batches):
+        assert list(video_names) == list(ref_video_names)
+        assert torch.equal(labels, ref_labels)
+        assert torch.equal(scene_feats, ref_scene_feats)
+        assert face_feats.shape == ref_face_feats.shape and face_feats.dtype == ref_face_feats.dtype
+
+        # the frames are sampled in another way, but every sampled face is one of the faces of its video
+        for video_name, video_face_feats in zip(video_names, face_feats.numpy()):
+            faces = np.array([np.concatenate([face_feat[4].astype(np.float32), [face_feat[3] / 100., face_feat[2]]])
+                              for face_feat in face_feats_dict[video_name.encode('utf-8')]], dtype=np.float32)
+            assert np.isclose(video_face_feats[:, None, :], faces[None, :, :]).all(axis=-1).any(axis=-1).all()
+
+
+def test_mask_at_load(tmpdir):
+    face_root, scene_root, _ = _make_face_scene_roots(tmpdir)
+    face_mask = get_mask_index(3, FACE_DIM, 16)
+    scene_mask = [0, 1, 4, 5, 6]
+    dataset = IQiYiFaceSceneDataset(face_root, scene_root, 'val', num_frame=4)
+    mask_dataset = IQiYiFaceSceneDataset(face_root, scene_root, 'val', num_frame=4, face_mask=face_mask,
+                                         scene_mask=scene_mask)
+    # the quality and det score appended after the face feat are never masked
+    face_index = face_mask + [FACE_DIM, FACE_DIM + 1]
+
+    for indexes in [0, 7, list(range(len(dataset)))]:
+        np.random.seed(0)
+        face_feats, scene_feats, labels, video_names = dataset[indexes]
+        np.random.seed(0)
+        mask_face_feats, mask_scene_feats, mask_labels, mask_video_names = mask_dataset[indexes]
+
+        assert video_names == mask_video_names
+        assert torch.equal(torch.as_tensor(labels), torch.as_tensor(mask_labels))
+        assert np.array_equal(np.asarray(mask_face_feats), np.asarray(face_feats)[..., face_index])
+        scene_feats = np.asarray(scene_feats).reshape(np.shape(scene_feats)[:-1] + (-1, SCENE_DIM))
+        assert np.array_equal(np.asarray(mask_scene_feats),
+                              scene_feats[..., scene_mask].reshape(np.shape(mask_scene_feats)))
+
+
+def test_share_memory_worker(tmpdir):
+    face_root, scene_root, _ = _make_face_scene_roots(tmpdir)
+    dataset = IQiYiFaceSceneDataset(face_root, scene_root, 'val', num_frame=4)
+    shared_dataset = IQiYiFaceSceneDataset(face_root, scene_root, 'val', num_frame=4, share_memory=True)
+
+    # the worker attaches to the shared pack, its videos, labels and scene feats are the ones of the main process
+    ref_batches = list(DataLoader(dataset, batch_size=5, shuffle=False, num_workers=0))
+    batches = list(DataLoader(shared_dataset, batch_size=5, shuffle=False, num_workers=1))
+    assert len(batches) == len(ref_batches)
+    for (_, scene_feats, labels, video_names), (_, ref_scene_feats, ref_labels, ref_video_names) \
+            in zip(batches, ref_batches):
+        assert list(video_names) == list(ref_video_names)
+        assert torch.equal(labels, ref_labels)
+        assert torch.equal(scene_feats, ref_scene_feats)
+
+
+def _make_image_root(image_root, num_video=2, num_image=3, size=(1280, 720)):
+    """
+    smooth frames like the ones of the videos, a draft decode of them is close to the full one
+    """
+    xs, ys = np.meshgrid(np.linspace(0., 1., size[0]), np.linspace(0., 1., size[1]))
+    for video_idx in range(num_video):
+        video_root = os.path.join(image_root, 'IQIYI_VID_VAL_{:0>7d}'.format(video_idx))
+        os.makedirs(video_root)
+        for image_index in range(1, num_image + 1):
+            phase = video_idx + image_index / 4.
+            image = np.stack([xs, ys, (np.sin(6. * xs + phase) + 1.) / 2.], axis=-1) * 255.
+            Image.fromarray(image.astype(np.uint8)).save(os.path.join(video_root, '{}.jpg'.format(image_index)),
+                                                         quality=90)
+    return image_root
+
+
+def test_extract_draft(tmpdir):
+    image_root = _make_image_root(str(tmpdir.mkdir('img')))
+    dataset = IQiYiExtractSceneDataset(str(tmpdir), 'val', image_root=image_root, num_frame=3)
+    draft_dataset = IQiYiExtractSceneDataset(str(tmpdir), 'val', image_root=image_root, num_frame=3, draft=True)
+
+    # the 1280x720 frames are decoded at 1/2, the smallest scale still not smaller than the extract size
+    image_path = dataset.image_paths[0]
+    assert _open_image(image_path).size == (1280, 720)
+    assert _open_image(image_path, EXTRACT_IMAGE_SIZE).size == (640, 360)
+    png_path = os.path.join(str(tmpdir), 'frame.png')
+    Image.open(image_path).save(png_path)
+    assert _open_image(png_path, EXTRACT_IMAGE_SIZE).size == (1280, 720)
+
+    assert len(draft_dataset) == len(dataset) == 6
+    for index in range(len(dataset)):
+        image_data, video_name, image_index = dataset[index]
+        draft_image_data, draft_video_name, draft_image_index = draft_dataset[index]
+        assert (draft_video_name, draft_image_index) == (video_name, image_index)
+        assert draft_image_data.shape == image_data.shape
+        assert (draft_image_data - image_data).abs().mean().item() < .01
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import os
+import random
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from datasets import IQiYiExtractSceneDataset
+from scene_extraction import load_extract_model, get_cosine_report
+from utils import init_logging
+
+logger = logging.getLogger(__name__)
+
+"""
+compare the full size decoding of the scene frames with the JPEG draft mode decoding:
+the images/sec of decoding and transforming the frames, the pixel diff of the inputs and the cosine similarity of the
+scene feats of the eval model
+"""
+
+
+def load_inputs(dataset, indexes, batch_size, num_workers):
+    data_loader = DataLoader(Subset(dataset, indexes), batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    all_image_data = []
+    start = time.time()
+    for image_data, _, _ in data_loader:
+        all_image_data.append(image_data)
+    return torch.cat(all_image_data, dim=0), len(indexes) / max(time.time() - start, 1e-6)
+
+
+def get_feats(model, inputs, batch_size):
+    with torch.no_grad():
+        return torch.cat([model(inputs[start:start + batch_size]).float()
+                          for start in range(0, len(inputs), batch_size)], dim=0)
+
+
+def main(args):
+    full_dataset = IQiYiExtractSceneDataset(args.data_root, args.tvt, image_root=args.image_root,
+                                            cache_root=args.cache_root, num_frame=args.num_frame)
+    draft_dataset = IQiYiExtractSceneDataset(args.data_root, args.tvt, image_root=args.image_root,
+                                             cache_root=args.cache_root, num_frame=args.num_frame, draft=True)
+    assert len(full_dataset) > 0 and full_dataset.image_paths == draft_dataset.image_paths
+
+    indexes = sorted(random.Random(args.seed).sample(range(len(full_dataset)), min(args.num_image, len(full_dataset))))
+    logger.info('benchmark on {} frames of {}'.format(len(indexes), len(full_dataset)))
+
+    # the files are read once before timing, so both paths decode from the page cache
+    load_inputs(full_dataset, indexes, args.batch_size, args.num_workers)
+    full_inputs, full_speed = load_inputs(full_dataset, indexes, args.batch_size, args.num_workers)
+    draft_inputs, draft_speed = load_inputs(draft_dataset, indexes, args.batch_size, args.num_workers)
+
+    report = {'full_images_per_sec': full_speed, 'draft_images_per_sec': draft_speed,
+              'speed_up': draft_speed / full_speed,
+              'input_mean_abs_diff': (draft_inputs - full_inputs).abs().mean().item(),
+              'input_max_abs_diff': (draft_inputs - full_inputs).abs().max().item()}
+
+    if not args.skip_feat:
+        model = load_extract_model(args.epoch, args.num_classes, eval_mode=True)
+        feat_report = get_cosine_report(get_feats(model, draft_inputs, args.batch_size),
+                                        get_feats(model, full_inputs, args.batch_size))
+        report.update(('feat_{}'.format(key), value) for key, value in feat_report.items())
+
+    for key, value in sorted(report.items(), key=lambda item: item[0]):
+        logger.info('    {:25s}: {:6f}'.format(str(key), value))
+        print('    {:25s}: {:6f}'.format(str(key), value))
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Template')
+    parser.add_argument('--data_root', default='/data/materials', type=str,
+                        help='path to load data (default: /data/materials/)')
+    parser.add_argument('--image_root', default='/home/dcq/img', type=str,
+                        help='path to load the frames (default: /home/dcq/img)')
+    parser.add_argument('--cache_root', default='./dataset_cache/', type=str,
+                        help='path to cache the image manifest (default: ./dataset_cache/)')
+    parser.add_argument('--tvt', default='val', type=str, help='train, val or test to take the frames from '
+                                                               '(default: val)')
+    parser.add_argument('--log_root', default='/data/logs/', type=str,
+                        help='path to save log (default: /data/logs/)')
+    parser.add_argument('--num_classes', default=10035, type=int, help='number of classes (default: 10035)')
+    parser.add_argument('--epoch', default=20, type=int, help='epoch of the fine tune model (default: 20)')
+    parser.add_argument('--num_frame', default=1, type=int, help='frames taken from every video (default: 1)')
+    parser.add_argument('--num_image', default=1024, type=int, help='frames to benchmark on (default: 1024)')
+    parser.add_argument('--batch_size', default=64, type=int, help='size of batch (default: 64)')
+    parser.add_argument('--num_workers', default=0, type=int,
+                        help='workers to decode the frames, 0 times the decoding in one process (default: 0)')
+    parser.add_argument('--skip_feat', action='store_true', help='only compare the speed and the inputs')
+    parser.add_argument('--seed', default=0, type=int, help='seed to sample the frames (default: 0)')
+
+    args = parser.parse_args()
+
+    SEED = args.seed
+    random.seed(SEED)
+    np.random.seed(SEED)
+    torch.manual_seed(SEED)
+
+    log_path = os.path.join(args.log_root, 'log.txt')
+    init_logging(log_path)
+
+    main(args)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import os
+
+from datasets.iqiyi_dataset import FEAT_PATH, FACE_TRAIN_NAME, FACE_VAL_NAME, FACE_TEST_NAME
+from utils import check_exists, init_logging, convert_face_pickle_to_store, load_face_stats, get_face_stats_path
+
+logger = logging.getLogger(__name__)
+
+FACE_PICKLE_NAMES = {'train': FACE_TRAIN_NAME, 'val': FACE_VAL_NAME, 'test': FACE_TEST_NAME, }
+
+
+def main(data_root, tvt_list):
+    for tvt in tvt_list:
+        file_path = os.path.join(data_root, FEAT_PATH, FACE_PICKLE_NAMES[tvt])
+        if not check_exists(file_path):
+            logger.warning('skip converting {}, the pickle does not exist'.format(file_path))
+            continue
+        store_root = convert_face_pickle_to_store(file_path)
+        print('convert {} to {}'.format(file_path, store_root))
+        load_face_stats(file_path)
+        print('index the face stats of {} in {}'.format(file_path, get_face_stats_path(file_path)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Template')
+    parser.add_argument('--data_root', default='/data/materials', type=str,
+                        help='path to load data (default: /data/materials/)')
+    parser.add_argument('--log_root', default='/data/logs/', type=str,
+                        help='path to save log (default: /data/logs/)')
+    parser.add_argument('--tvt', default='train,val,test', type=str,
+                        help='splits to convert, separated by comma (default: train,val,test)')
+
+    args = parser.parse_args()
+
+    log_path = os.path.join(args.log_root, 'log.txt')
+    init_logging(log_path)
+
+    tvt_list = [tvt for tvt in args.tvt.split(',') if tvt]
+    assert all(tvt in FACE_PICKLE_NAMES for tvt in tvt_list)
+
+    main(args.data_root, tvt_list)
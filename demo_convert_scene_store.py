@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import os
+
+from datasets.iqiyi_dataset import SCENE_TRAIN_NAME, SCENE_VAL_NAME, SCENE_TEST_NAME
+from utils import check_exists, init_logging, convert_scene_pickle_to_store
+
+logger = logging.getLogger(__name__)
+
+SCENE_PICKLE_NAMES = {'train': SCENE_TRAIN_NAME, 'val': SCENE_VAL_NAME, 'test': SCENE_TEST_NAME, }
+
+
+def main(data_root, tvt_list):
+    for tvt in tvt_list:
+        file_path = os.path.join(data_root, SCENE_PICKLE_NAMES[tvt])
+        if not check_exists(file_path):
+            logger.warning('skip converting {}, the pickle does not exist'.format(file_path))
+            continue
+        store_root = convert_scene_pickle_to_store(file_path)
+        print('convert {} to {}'.format(file_path, store_root))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Template')
+    parser.add_argument('--data_root', default='./scene_feat/', type=str,
+                        help='path to load data (default: ./scene_feat/)')
+    parser.add_argument('--log_root', default='/data/logs/', type=str,
+                        help='path to save log (default: /data/logs/)')
+    parser.add_argument('--tvt', default='train,val,test', type=str,
+                        help='splits to convert, separated by comma (default: train,val,test)')
+
+    args = parser.parse_args()
+
+    log_path = os.path.join(args.log_root, 'log.txt')
+    init_logging(log_path)
+
+    tvt_list = [tvt for tvt in args.tvt.split(',') if tvt]
+    assert all(tvt in SCENE_PICKLE_NAMES for tvt in tvt_list)
+
+    main(args.data_root, tvt_list)
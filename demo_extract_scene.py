@@ -7,75 +7,52 @@
 import argparse
 import logging
 import os
-import pickle
 import random
-import time
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
 
 from datasets import IQiYiExtractSceneDataset
-from models import ArcFaceSEResNeXtModel
-from utils import check_exists, init_logging
+from scene_extraction import load_extract_model, get_extract_infos, get_extract_fingerprint, get_extract_indexes, \
+    extract_partial_store
+from utils import check_exists, init_logging, get_scene_store_root, load_scene_store, close_partial_scene_store
 
 logger = logging.getLogger(__name__)
 
 
-def main(args):
-    if not check_exists(args.save_dir):
-        os.makedirs(args.save_dir)
-    load_path = './checkpoints/demo_arcface_fine_tune_model_{:0>4d}.pth'.format(args.epoch)
-
-    dataset = IQiYiExtractSceneDataset(args.data_root, args.tvt, image_root='/home/dcq/img', num_frame=1)
+def load_extract_dataset(args):
+    dataset = IQiYiExtractSceneDataset(args.data_root, args.tvt, image_root='/home/dcq/img', num_frame=1,
+                                       cache_root=args.cache_root, draft=args.draft)
     if len(dataset) <= 0:
         logger.error('the size of the dataset for extract scene feat cannot be {}'.format(len(dataset)))
     else:
         logger.info('the size of the dataset for extract scene feat is {}'.format(len(dataset)))
-    data_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4, pin_memory=True)
-
-    log_step = len(data_loader) // 100 if len(data_loader) > 100 else 1
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-    logger.info('extract scene feat on {}'.format(device))
-
-    model = ArcFaceSEResNeXtModel(args.num_classes, include_top=False)
-    state_dict = torch.load(load_path, map_location='cpu')
-    model.load_state_dict(state_dict)
-
-    model = model.to(device)
+    return dataset
 
-    all_video_names = []
-    all_image_index = []
-    all_scene_feat = []
 
-    start = time.time()
-    with torch.no_grad():
-        for batch_idx, (image_data, video_names, image_indexes) in enumerate(data_loader):
-            image_data = image_data.to(device)
-
-            outputs = model(image_data)
-
-            all_video_names += list(video_names)
-            all_image_index += image_indexes.tolist()
-            all_scene_feat.append(outputs.cpu())
-
-            if batch_idx % log_step == 0:
-                end = time.time()
-                log_info = '[{}/{} ({:.0f}%)] Time: {}' \
-                    .format(batch_idx * args.batch_size, len(dataset),
-                            100.0 * batch_idx / len(data_loader), (end - start))
-                logger.info(log_info)
-                print(log_info)
-                start = time.time()
+def main(args):
+    if not check_exists(args.save_dir):
+        os.makedirs(args.save_dir)
 
-    all_scene_feat = torch.cat(all_scene_feat, dim=0).numpy()
-    scene_infos = {}
+    dataset = load_extract_dataset(args)
+    store_root = get_scene_store_root(os.path.join(args.save_dir, 'scene_infos_{}.pickle'.format(args.tvt)))
+    extract_infos = get_extract_infos(args.epoch, args.int8, args.optimize, args.draft, args.eval)
+    image_stamps, scene_store, extract_indexes = get_extract_indexes(dataset, store_root, extract_infos,
+                                                                     args.incremental)
+    if len(extract_indexes) == 0:
+        return
 
-    for idx, video_name in enumerate(all_video_names):
-        scene_infos.setdefault(video_name, []).append((all_image_index[idx], all_scene_feat[idx]))
+    fingerprint = get_extract_fingerprint(dataset, image_stamps, extract_indexes, extract_infos)
 
-    with open(os.path.join(args.save_dir, 'scene_infos_{}.pickle'.format(args.tvt)), 'wb') as fout:
-        pickle.dump(scene_infos, fout)
+    # the train mode model of the baseline unless eval or optimize, the int8 model is traced already
+    model = load_extract_model(args.epoch, args.num_classes, int8=args.int8, optimize=args.optimize,
+                               channels_last=args.channels_last, eval_mode=args.eval)
+    device = torch.device('cuda:0' if torch.cuda.is_available() and not args.int8 else 'cpu')
+    all_scene_feat = extract_partial_store(model, dataset, store_root, extract_indexes, fingerprint, device,
+                                           args.feat_dim, args.batch_size, args.num_workers, args.checkpoint_step,
+                                           trace=args.optimize, channels_last=args.optimize and args.channels_last)
+    close_partial_scene_store(store_root, all_scene_feat, dataset.video_names, dataset.image_indexes, image_stamps,
+                              scene_store, extract_infos)
 
 
 if __name__ == '__main__':
@@ -83,17 +60,37 @@ if __name__ == '__main__':
     parser.add_argument('--data_root', default='/data/materials', type=str,
                         help='path to load data (default: /data/materials/)')
     parser.add_argument('--save_dir', default='./scene_feat/', type=str,
-                        help='path to save scene feat (default: ./scene_feat/)')
+                        help='path to save the scene store scene_infos_{tvt}_store (default: ./scene_feat/)')
     parser.add_argument('--log_root', default='/data/logs/', type=str,
                         help='path to save log (default: /data/logs/)')
+    parser.add_argument('--cache_root', default='./dataset_cache/', type=str,
+                        help='path to cache the image manifest (default: ./dataset_cache/)')
     parser.add_argument('--device', default=None, type=str, help='indices of GPUs to enable (default: all)')
     parser.add_argument('--num_classes', default=10035, type=int, help='number of classes (default: 10035)')
     parser.add_argument('--batch_size', default=512, type=int, help='bat of feature (default: 512)')
     parser.add_argument('--tvt', default='test', type=str, help='train, val or test to extract feat (default: train)')
     parser.add_argument('--epoch', default=20, type=int, help='train, val or test to extract feat (default: train)')
+    parser.add_argument('--num_workers', default=4, type=int, help='workers to decode the frames (default: 4)')
+    parser.add_argument('--feat_dim', default=2048, type=int, help='dim of scene feature (default: 2048)')
+    parser.add_argument('--checkpoint_step', default=10, type=int,
+                        help='batches between two saves of the progress (default: 10)')
+    parser.add_argument('--draft', action='store_true',
+                        help='decode the JPEG frames near 224x224 with the draft mode of PIL')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only extract the new or changed frames and merge them into the scene store')
+    parser.add_argument('--eval', action='store_true',
+                        help='extract with the BatchNorm2d on their running stats instead of the batch stats')
+    parser.add_argument('--optimize', action='store_true',
+                        help='fold the BatchNorm2d into the convs, fuse the SE modules and trace the model')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='run the optimized model in channels last memory format')
+    parser.add_argument('--int8', action='store_true',
+                        help='run the int8 model saved by demo_quantize_scene.py on cpu')
 
     args = parser.parse_args()
 
+    assert not (args.int8 and args.optimize)
+
     if args.device:
         os.environ["CUDA_VISIBLE_DEVICES"] = args.device
 
@@ -114,7 +111,7 @@ if __name__ == '__main__':
 
     main(args)
 
-    with open(os.path.join(args.save_dir, 'scene_infos_{}.pickle'.format(args.tvt)), 'rb') as fin:
-        scene_infos = pickle.load(fin, encoding='bytes')
+    scene_store = load_scene_store(
+        get_scene_store_root(os.path.join(args.save_dir, 'scene_infos_{}.pickle'.format(args.tvt))))
 
-    assert isinstance(scene_infos, dict)
+    assert scene_store['feat'].shape[:2] == scene_store['image_indexes'].shape
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+import argparse
+import bisect
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+
+import numpy as np
+import torch
+
+from datasets import IQiYiExtractSceneDataset
+from scene_extraction import INT8_MODEL_PATH, load_extract_model, get_extract_infos, get_extract_fingerprint, \
+    get_video_ends, get_extract_indexes, extract_partial_store
+from utils import check_exists, init_logging, get_scene_store_root, open_partial_scene_store, save_scene_progress, \
+    close_partial_scene_store, PARTIAL_STORE_SUFFIX, SCENE_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+"""
+extract the scene feats on cpu with one process for every shard of the videos, each process pinned to its own cores,
+and merge the shards into one scene store with the same video order as demo_extract_scene.py.
+the shards batch the frames unlike a single process, so only the eval model (--eval, --optimize or --int8) extracts
+the same feats, the train mode model of demo_extract_scene.py is refused
+"""
+
+SHARD_STORE_SUFFIX = '.shard{:0>2d}'
+
+
+def get_shard_indexes(extract_indexes, video_names, num_shards):
+    """
+    split the frames to extract into num_shards contiguous shards of about the same size, never inside a video
+    """
+    video_ends = get_video_ends([video_names[image_idx] for image_idx in extract_indexes])
+    shard_ends = sorted(set(video_ends[min(bisect.bisect_left(video_ends, len(extract_indexes) * shard_idx
+                                                              / num_shards), len(video_ends) - 1)]
+                            for shard_idx in range(1, num_shards + 1)))
+    return [extract_indexes[shard_start:shard_end] for shard_start, shard_end in zip([0] + shard_ends, shard_ends)]
+
+
+def get_shard_cpus(num_shards):
+    """
+    the cores for every shard, the shards share all the cores when there are less cores than shards
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    return [cpus[len(cpus) * shard_idx // num_shards:len(cpus) * (shard_idx + 1) // num_shards] or cpus
+            for shard_idx in range(num_shards)]
+
+
+def extract_shard(args, dataset, shard_root, image_stamps, shard_indexes, extract_infos, cpus, num_threads):
+    init_logging(os.path.join(args.log_root, 'log_{}.txt'.format(os.path.basename(shard_root))))
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads)
+    logger.info('extract shard {} on cores {} with {} threads'.format(shard_root, cpus, num_threads))
+
+    SEED = 0
+    random.seed(SEED)
+    np.random.seed(SEED)
+    torch.manual_seed(SEED)
+
+    fingerprint = get_extract_fingerprint(dataset, image_stamps, shard_indexes, extract_infos)
+    model = load_extract_model(args.epoch, args.num_classes, int8=args.int8, optimize=args.optimize,
+                               channels_last=args.channels_last, eval_mode=args.eval)
+    extract_partial_store(model, dataset, shard_root, shard_indexes, fingerprint, torch.device('cpu'), args.feat_dim,
+                          args.batch_size, args.num_workers, args.checkpoint_step, trace=args.optimize,
+                          channels_last=args.optimize and args.channels_last)
+
+
+def merge_shards(args, dataset, store_root, image_stamps, scene_store, extract_indexes, extract_infos,
+                 all_shard_indexes):
+    """
+    copy the frame feats of the shards one after another into the partial store and close it
+    """
+    fingerprint = get_extract_fingerprint(dataset, image_stamps, extract_indexes, extract_infos)
+    all_scene_feat, _ = open_partial_scene_store(store_root, len(extract_indexes), args.feat_dim, fingerprint)
+
+    row = 0
+    for shard_idx, shard_indexes in enumerate(all_shard_indexes):
+        shard_partial_root = store_root + SHARD_STORE_SUFFIX.format(shard_idx) + PARTIAL_STORE_SUFFIX
+        shard_feats = np.load(os.path.join(shard_partial_root, 'feat.npy'), mmap_mode='r')
+        assert shard_feats.shape == (len(shard_indexes), args.feat_dim)
+        for start in range(0, len(shard_feats), SCENE_CHUNK_SIZE):
+            chunk_feats = shard_feats[start:start + SCENE_CHUNK_SIZE]
+            all_scene_feat[row:row + len(chunk_feats)] = chunk_feats
+            row += len(chunk_feats)
+        del shard_feats
+
+    save_scene_progress(store_root, all_scene_feat, row, fingerprint)
+    close_partial_scene_store(store_root, all_scene_feat, dataset.video_names, dataset.image_indexes, image_stamps,
+                              scene_store, extract_infos)
+
+    for shard_idx in range(len(all_shard_indexes)):
+        shutil.rmtree(store_root + SHARD_STORE_SUFFIX.format(shard_idx) + PARTIAL_STORE_SUFFIX)
+
+
+def main(args):
+    if not (args.eval or args.optimize or args.int8):
+        # the batch stats of the train mode model would depend on how the frames are sharded
+        raise RuntimeError('the shards only extract with the eval model, add --eval, --optimize or --int8')
+
+    if not check_exists(args.save_dir):
+        os.makedirs(args.save_dir)
+
+    dataset = IQiYiExtractSceneDataset(args.data_root, args.tvt, image_root='/home/dcq/img', num_frame=1,
+                                       cache_root=args.cache_root, draft=args.draft)
+    logger.info('the size of the dataset for extract scene feat is {}'.format(len(dataset)))
+    store_root = get_scene_store_root(os.path.join(args.save_dir, 'scene_infos_{}.pickle'.format(args.tvt)))
+    extract_infos = get_extract_infos(args.epoch, args.int8, args.optimize, args.draft, args.eval)
+    image_stamps, scene_store, extract_indexes = get_extract_indexes(dataset, store_root, extract_infos,
+                                                                     args.incremental)
+    if len(extract_indexes) == 0:
+        return
+
+    all_shard_indexes = get_shard_indexes(extract_indexes, dataset.video_names, args.num_shards)
+    all_shard_cpus = get_shard_cpus(len(all_shard_indexes))
+
+    # spawn instead of fork, the children do not inherit the thread pools of the parent
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for shard_idx, (shard_indexes, cpus) in enumerate(zip(all_shard_indexes, all_shard_cpus)):
+        # the decode workers run on the cores of the shard too
+        num_threads = args.num_threads if args.num_threads > 0 else max(len(cpus) - args.num_workers, 1)
+        shard_root = store_root + SHARD_STORE_SUFFIX.format(shard_idx)
+        logger.info('shard {} with {} frames on cores {}'.format(shard_idx, len(shard_indexes), cpus))
+        process = context.Process(target=extract_shard, args=(args, dataset, shard_root, image_stamps,
+                                                              shard_indexes, extract_infos, cpus, num_threads))
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+    for shard_idx, process in enumerate(processes):
+        if process.exitcode != 0:
+            raise RuntimeError('shard {} of {} exits with code {}, rerun to resume it'
+                               .format(shard_idx, store_root, process.exitcode))
+
+    merge_shards(args, dataset, store_root, image_stamps, scene_store, extract_indexes, extract_infos,
+                 all_shard_indexes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Template')
+    parser.add_argument('--data_root', default='/data/materials', type=str,
+                        help='path to load data (default: /data/materials/)')
+    parser.add_argument('--save_dir', default='./scene_feat/', type=str,
+                        help='path to save scene feat (default: ./scene_feat/)')
+    parser.add_argument('--log_root', default='/data/logs/', type=str,
+                        help='path to save log (default: /data/logs/)')
+    parser.add_argument('--cache_root', default='./dataset_cache/', type=str,
+                        help='path to cache the image manifest (default: ./dataset_cache/)')
+    parser.add_argument('--num_classes', default=10035, type=int, help='number of classes (default: 10035)')
+    parser.add_argument('--batch_size', default=64, type=int, help='size of batch of every shard (default: 64)')
+    parser.add_argument('--tvt', default='test', type=str, help='train, val or test to extract feat (default: test)')
+    parser.add_argument('--epoch', default=20, type=int, help='epoch of the fine tune model (default: 20)')
+    parser.add_argument('--num_shards', default=8, type=int, help='processes to extract the shards (default: 8)')
+    parser.add_argument('--num_threads', default=0, type=int,
+                        help='intra op threads of every shard (default: its cores minus its decode workers)')
+    parser.add_argument('--num_workers', default=1, type=int,
+                        help='workers to decode the frames of every shard (default: 1)')
+    parser.add_argument('--feat_dim', default=2048, type=int, help='dim of scene feature (default: 2048)')
+    parser.add_argument('--checkpoint_step', default=10, type=int,
+                        help='batches between two saves of the progress (default: 10)')
+    parser.add_argument('--draft', action='store_true',
+                        help='decode the JPEG frames near 224x224 with the draft mode of PIL')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only extract the new or changed frames and merge them into the scene store')
+    parser.add_argument('--eval', action='store_true',
+                        help='extract with the BatchNorm2d on their running stats instead of the batch stats')
+    parser.add_argument('--optimize', action='store_true',
+                        help='fold the BatchNorm2d into the convs, fuse the SE modules and trace the model, '
+                             'the feats of an eval model do not depend on how the frames are sharded')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='run the optimized model in channels last memory format')
+    parser.add_argument('--int8', action='store_true',
+                        help='run the int8 model saved by demo_quantize_scene.py (default: {})'.format(INT8_MODEL_PATH))
+
+    args = parser.parse_args()
+
+    assert not (args.int8 and args.optimize)
+
+    log_path = os.path.join(args.log_root, 'log.txt')
+    if check_exists(log_path):
+        os.remove(log_path)
+
+    init_logging(log_path)
+
+    main(args)
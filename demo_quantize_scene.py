@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import os
+import random
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from datasets import IQiYiExtractSceneDataset
+from models import prepare_quantized_model, convert_quantized_model, save_quantized_model, load_quantized_model
+from scene_extraction import INT8_MODEL_PATH, load_extract_model, get_cosine_report
+from utils import init_logging
+
+logger = logging.getLogger(__name__)
+
+
+def extract_feats(model, data_loader):
+    all_feats = []
+    start = time.time()
+    with torch.no_grad():
+        for image_data, _, _ in data_loader:
+            all_feats.append(model(image_data).float())
+    all_feats = torch.cat(all_feats, dim=0)
+    return all_feats, (time.time() - start) / max(len(all_feats), 1)
+
+
+def main(args):
+    dataset = IQiYiExtractSceneDataset(args.data_root, args.tvt, image_root=args.image_root, num_frame=args.num_frame,
+                                       cache_root=args.cache_root)
+    assert len(dataset) > 0
+
+    # disjoint frames for the calibration and the parity check
+    indexes = list(range(len(dataset)))
+    random.Random(args.seed).shuffle(indexes)
+    calib_indexes = sorted(indexes[:args.calib_num])
+    parity_indexes = sorted(indexes[args.calib_num:args.calib_num + args.parity_num])
+    logger.info('calibrate on {} frames and check on {} frames of {}'.format(
+        len(calib_indexes), len(parity_indexes), len(dataset)))
+
+    model = load_extract_model(args.epoch, args.num_classes, eval_mode=True)
+    example_inputs = (dataset[calib_indexes[0]][0].unsqueeze(0),)
+
+    prepared_model = prepare_quantized_model(model, example_inputs, args.engine)
+    calib_loader = DataLoader(Subset(dataset, calib_indexes), batch_size=args.batch_size, shuffle=False,
+                              num_workers=4)
+    with torch.no_grad():
+        for batch_idx, (image_data, _, _) in enumerate(calib_loader):
+            logger.info('Calibrate: {}/{}'.format(batch_idx, len(calib_loader)))
+            prepared_model(image_data)
+    quantized_model = convert_quantized_model(prepared_model)
+
+    save_path = args.save_path if args.save_path else INT8_MODEL_PATH.format(args.epoch)
+    save_quantized_model(quantized_model, save_path, example_inputs)
+    logger.info('save int8 model with engine {} in {}'.format(torch.backends.quantized.engine, save_path))
+
+    if len(parity_indexes) == 0:
+        return None
+
+    # the saved model against the float32 eval model
+    parity_loader = DataLoader(Subset(dataset, parity_indexes), batch_size=args.batch_size, shuffle=False,
+                               num_workers=4)
+    ref_feats, ref_time = extract_feats(model, parity_loader)
+    int8_feats, int8_time = extract_feats(load_quantized_model(save_path), parity_loader)
+
+    report = get_cosine_report(int8_feats, ref_feats)
+    report['float32_ms'] = ref_time * 1000
+    report['int8_ms'] = int8_time * 1000
+    for key, value in sorted(report.items(), key=lambda item: item[0]):
+        logger.info('    {:20s}: {:6f}'.format(str(key), value))
+        print('    {:20s}: {:6f}'.format(str(key), value))
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Template')
+    parser.add_argument('--data_root', default='/data/materials', type=str,
+                        help='path to load data (default: /data/materials/)')
+    parser.add_argument('--image_root', default='/home/dcq/img', type=str,
+                        help='path to load the frames (default: /home/dcq/img)')
+    parser.add_argument('--tvt', default='train', type=str, help='train, val or test to take the frames from '
+                                                                 '(default: train)')
+    parser.add_argument('--save_path', default=None, type=str,
+                        help='path to save the int8 model (default: {})'.format(INT8_MODEL_PATH))
+    parser.add_argument('--log_root', default='/data/logs/', type=str,
+                        help='path to save log (default: /data/logs/)')
+    parser.add_argument('--cache_root', default='./dataset_cache/', type=str,
+                        help='path to cache the image manifest (default: ./dataset_cache/)')
+    parser.add_argument('--num_classes', default=10035, type=int, help='number of classes (default: 10035)')
+    parser.add_argument('--epoch', default=20, type=int, help='epoch of the fine tune model (default: 20)')
+    parser.add_argument('--num_frame', default=1, type=int, help='frames taken from every video (default: 1)')
+    parser.add_argument('--calib_num', default=1024, type=int, help='frames to calibrate on (default: 1024)')
+    parser.add_argument('--parity_num', default=512, type=int,
+                        help='other frames to compare the int8 feats with the float32 feats (default: 512)')
+    parser.add_argument('--batch_size', default=64, type=int, help='size of batch (default: 64)')
+    parser.add_argument('--engine', default=None, type=str,
+                        help='quantized engine, x86, fbgemm or qnnpack (default: the first supported)')
+    parser.add_argument('--seed', default=0, type=int, help='seed to sample the frames (default: 0)')
+
+    args = parser.parse_args()
+
+    SEED = args.seed
+    random.seed(SEED)
+    np.random.seed(SEED)
+    torch.manual_seed(SEED)
+
+    log_path = os.path.join(args.log_root, 'log.txt')
+    init_logging(log_path)
+
+    main(args)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import os
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from datasets import BatchDataLoader, get_multi_view_dataset
+from datasets.iqiyi_dataset import VAL_GT_NAME
+from evaluation_map import load_rankings, evaluate_map, get_rankings_from_scores
+from models import get_seed_manifest_path, load_multi_view_models, run_multi_view_ensemble
+from scene_extraction import get_cosine_report
+from utils import check_exists, init_logging, get_scene_store_root, load_scene_store, load_seed_manifest
+
+logger = logging.getLogger(__name__)
+
+"""
+compare the val scene feats extracted by two models, like the float32 and the int8 one:
+the cosine similarity of the feats of every frame and the val mAP of the multi view ensembles on each of them
+"""
+
+
+def get_store_cosine_report(ref_root, other_root, tvt='val', chunk_size=1024):
+    ref_store = load_scene_store(get_scene_store_root(os.path.join(ref_root, 'scene_infos_{}.pickle'.format(tvt))))
+    other_store = load_scene_store(get_scene_store_root(os.path.join(other_root,
+                                                                     'scene_infos_{}.pickle'.format(tvt))))
+
+    other_rows = {video_name: row for row, video_name in enumerate(other_store['video_names'].tolist())}
+    ref_rows = np.array([row for row, video_name in enumerate(ref_store['video_names'].tolist())
+                         if video_name in other_rows], dtype=np.int64)
+    if len(ref_rows) < len(ref_store['video_names']):
+        logger.warning('{} videos of {} are not in {}'.format(
+            len(ref_store['video_names']) - len(ref_rows), ref_root, other_root))
+    other_rows = np.array([other_rows[video_name] for video_name in ref_store['video_names'][ref_rows].tolist()],
+                          dtype=np.int64)
+
+    all_feats = []
+    all_ref_feats = []
+    for start in range(0, len(ref_rows), chunk_size):
+        ref_chunk = ref_rows[start:start + chunk_size]
+        other_chunk = other_rows[start:start + chunk_size]
+        # only the frames with the same image index
+        same_frames = ref_store['image_indexes'][ref_chunk] == other_store['image_indexes'][other_chunk]
+        all_ref_feats.append(ref_store['feat'][ref_chunk][same_frames].astype(np.float32))
+        all_feats.append(other_store['feat'][other_chunk][same_frames].astype(np.float32))
+
+    return get_cosine_report(np.concatenate(all_feats), np.concatenate(all_ref_feats))
+
+
+def get_ensemble_map(args, model_type, seeds, scene_root, gt_id2videos, id_num):
+    # the same models and frames for every scene root, like demo_test_multi_view_ensemble.py on val
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+    models, input_indexes = load_multi_view_models(model_type, seeds, args.epoch, args.num_classes)
+    dataset = get_multi_view_dataset(model_type, args.face_root, scene_root, 'val', args.num_frame, args.compact,
+                                     args.cache_root)
+    if args.batch_mode and model_type == 'face_scene':
+        data_loader = BatchDataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4)
+    else:
+        data_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4)
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    outputs, video_names = run_multi_view_ensemble(model_type, models, input_indexes, data_loader, device,
+                                                   args.grouped, args.scene_feat_dim)
+    class_ids = [int(cid) for cid in gt_id2videos if 0 < int(cid) < outputs.size(1)]
+    return evaluate_map(gt_id2videos, get_rankings_from_scores(outputs, video_names, class_ids=class_ids), id_num)
+
+
+def main(args):
+    report = get_store_cosine_report(args.ref_root, args.other_root)
+
+    gt_path = os.path.join(args.face_root, VAL_GT_NAME)
+    assert check_exists(gt_path)
+    gt_id2videos, id_num = load_rankings(gt_path)
+
+    for model_type in [model_type for model_type in args.model_types.split(',') if model_type]:
+        if args.use_seed_manifest:
+            seeds = load_seed_manifest(get_seed_manifest_path(model_type), model_type)
+        else:
+            seeds = args.face_scene_seeds if model_type == 'face_scene' else args.scene_seeds
+            seeds = [int(seed) for seed in seeds.split(',') if seed]
+
+        ref_map = get_ensemble_map(args, model_type, seeds, args.ref_root, gt_id2videos, id_num)
+        other_map = get_ensemble_map(args, model_type, seeds, args.other_root, gt_id2videos, id_num)
+        report['{}_ref_map'.format(model_type)] = ref_map
+        report['{}_other_map'.format(model_type)] = other_map
+        report['{}_map_diff'.format(model_type)] = other_map - ref_map
+
+    for key, value in sorted(report.items(), key=lambda item: item[0]):
+        logger.info('    {:20s}: {:6f}'.format(str(key), value))
+        print('    {:20s}: {:6f}'.format(str(key), value))
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Template')
+    parser.add_argument('--ref_root', default='./scene_feat', type=str,
+                        help='path of the reference val scene feat, like the float32 one (default: ./scene_feat/)')
+    parser.add_argument('--other_root', default='./scene_feat_int8', type=str,
+                        help='path of the val scene feat to compare, with the gt files like the reference one '
+                             '(default: ./scene_feat_int8/)')
+    parser.add_argument('--model_types', default='face_scene,scene', type=str,
+                        help='ensembles to take the val mAP of, separated by comma (default: face_scene,scene)')
+    parser.add_argument('--face_scene_seeds', default='0,1,2,4,5,6,8,9,10,12,15', type=str,
+                        help='seeds of the face scene models (default: 0,1,2,4,5,6,8,9,10,12,15)')
+    parser.add_argument('--scene_seeds', default='1,2,3,4,6,8,10,11,12,14,15', type=str,
+                        help='seeds of the scene models (default: 1,2,3,4,6,8,10,11,12,14,15)')
+    parser.add_argument('--use_seed_manifest', action='store_true',
+                        help='take the seeds from the seed manifests of demo_select_seeds.py')
+    parser.add_argument('--face_root', default='/data/materials', type=str,
+                        help='path to load data (default: /data/materials/)')
+    parser.add_argument('--log_root', default='/data/logs/', type=str,
+                        help='path to save log (default: /data/logs/)')
+    parser.add_argument('--cache_root', default='./dataset_cache/', type=str,
+                        help='path to cache the preprocessed dataset (default: ./dataset_cache/)')
+    parser.add_argument('--device', default=None, type=str, help='indices of GPUs to enable (default: all)')
+    parser.add_argument('--epoch', type=int, default=100, help="the epoch num for train (default: 100)")
+    parser.add_argument('--num_classes', default=10035, type=int, help='number of classes (default: 10035)')
+    parser.add_argument('--scene_feat_dim', default=2048, type=int, help='dim of scene feature (default: 2048)')
+    parser.add_argument('--num_frame', default=40, type=int, help='size of video length (default: 40)')
+    parser.add_argument('--batch_size', default=16384, type=int, help='size of batch (default: 16384)')
+    parser.add_argument('--batch_mode', action='store_true', help='sample and gather a whole batch at once')
+    parser.add_argument('--compact', action='store_true',
+                        help='keep the face feats in float16 until they reach the model, the scene feats stay float32')
+    parser.add_argument('--grouped', action='store_true', help='stack all the models and run them as batched matmuls')
+
+    args = parser.parse_args()
+
+    if args.device:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.device
+
+    log_path = os.path.join(args.log_root, 'log.txt')
+    init_logging(log_path)
+
+    main(args)
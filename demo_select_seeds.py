@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import os
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from datasets import BatchDataLoader, get_multi_view_dataset
+from datasets.iqiyi_dataset import VAL_GT_NAME
+from evaluation_map import load_rankings, get_candidate_hits, get_candidate_map
+from models import get_grouped_model, select_grouped_inputs, load_multi_view_models, get_seed_manifest_path
+from utils import check_exists, init_logging, select_multi_view_inputs, get_result_store_root, load_result_store, \
+    open_result_store, close_result_store, merge_class_topk, write_seed_manifest, RESULT_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+FACE_SCENE_SEED_RESULT_ROOT = './multi_view_face_scene_seed_result_val'
+SCENE_SEED_RESULT_ROOT = './multi_view_scene_seed_result_val'
+
+"""
+every seed is run once on val and its softmax outputs are cached as a result store, then the seeds are chosen
+greedily by the mAP of their summed outputs until it is within tolerance of the mAP of all the seeds.
+the mAP of every class is taken over its candidates: the top candidate_num videos of all the seeds,
+the other videos are taken to never reach the top 100 of the class
+"""
+
+
+def get_seed_store_root(seed_result_root, seed):
+    return get_result_store_root(seed_result_root, 'seed_{}'.format(seed))
+
+
+def cache_seed_outputs(args, seeds, seed_result_root):
+    """
+    run the seeds without a cached result store in one pass over val and save the outputs of every seed apart
+    """
+    seeds = [seed for seed in seeds if args.refresh
+             or not check_exists(os.path.join(get_seed_store_root(seed_result_root, seed), 'scores.npy'))]
+    if len(seeds) == 0:
+        return
+    logger.info('run {} models of seeds {} on val'.format(args.model_type, seeds))
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    models, input_indexes = load_multi_view_models(args.model_type, seeds, args.epoch, args.num_classes)
+    models = [model.to(device) for model in models]
+    if args.grouped:
+        grouped_model, grouped_index = get_grouped_model(args.model_type, models, input_indexes, device)
+    input_indexes = [tuple(torch.tensor(index, dtype=torch.long, device=device) for index in input_index)
+                     for input_index in input_indexes]
+
+    dataset = get_multi_view_dataset(args.model_type, args.face_root, args.scene_root, args.tvt, args.num_frame,
+                                     args.compact, args.cache_root)
+    if args.batch_mode and args.model_type == 'face_scene':
+        data_loader = BatchDataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4)
+    else:
+        data_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4)
+
+    metric_func = torch.nn.Softmax(-1)
+
+    all_scores = [open_result_store(get_seed_store_root(seed_result_root, seed), (len(dataset), args.num_classes),
+                                    np.dtype(args.result_dtype)) for seed in seeds]
+    all_video_names = []
+
+    with torch.no_grad():
+        for batch_idx, batch_data in enumerate(data_loader):
+            logger.info('Test Model: {}/{}'.format(batch_idx, len(data_loader)))
+
+            inputs = tuple(feats.to(device).float() for feats in batch_data[:-2])
+            video_names = batch_data[-1]
+
+            if args.grouped:
+                outputs = metric_func(grouped_model(*select_grouped_inputs(inputs, grouped_index,
+                                                                           args.scene_feat_dim)))
+            else:
+                outputs = [metric_func(model(*select_multi_view_inputs(inputs, input_index, args.scene_feat_dim)))
+                           for model, input_index in zip(models, input_indexes)]
+
+            row = len(all_video_names)
+            for scores, output in zip(all_scores, outputs):
+                scores[row:row + len(video_names)] = output.cpu().numpy()
+            all_video_names += video_names
+
+    for seed, scores in zip(seeds, all_scores):
+        close_result_store(get_seed_store_root(seed_result_root, seed), scores, all_video_names)
+
+
+def load_seed_stores(seeds, seed_result_root):
+    seed_stores = [load_result_store(get_seed_store_root(seed_result_root, seed)) for seed in seeds]
+    video_names = seed_stores[0]['video_names']
+    for seed, seed_store in zip(seeds, seed_stores):
+        if not np.array_equal(seed_store['video_names'], video_names):
+            raise RuntimeError('the videos of seed {} differ from seed {}, run again with --refresh'
+                               .format(seed, seeds[0]))
+    return video_names.tolist(), seed_stores
+
+
+def get_seed_candidates(seed_stores, class_ids, candidate_num):
+    """
+    the (num_class, num_candidate) top videos of every class by the outputs of all the seeds
+    """
+    num_video = seed_stores[0]['scores'].shape[0]
+    topk_values = None
+    topk_indexes = None
+    for start in range(0, num_video, RESULT_CHUNK_SIZE):
+        chunk = sum(torch.from_numpy(seed_store['scores'][start:start + RESULT_CHUNK_SIZE].astype(np.float32))
+                    for seed_store in seed_stores)
+        topk_values, topk_indexes = merge_class_topk(topk_values, topk_indexes, chunk, start, candidate_num)
+    return topk_indexes.numpy().T[class_ids]
+
+
+def gather_seed_outputs(seed_stores, candidates, class_ids):
+    """
+    the (num_seed, num_class, num_candidate) outputs of every seed on the candidates of every class
+    """
+    # read the memmaps in row order
+    order = np.argsort(candidates, axis=None, kind='stable')
+    rows = candidates.reshape(-1)[order]
+    class_idxes = np.repeat(np.array(class_ids, dtype=np.int64), candidates.shape[1])[order]
+
+    seed_outputs = torch.empty((len(seed_stores),) + candidates.shape, dtype=torch.float32)
+    for seed_idx, seed_store in enumerate(seed_stores):
+        outputs = np.empty(rows.shape, dtype=np.float32)
+        outputs[order] = seed_store['scores'][rows, class_idxes]
+        seed_outputs[seed_idx] = torch.from_numpy(outputs.reshape(candidates.shape))
+    return seed_outputs
+
+
+def select_seeds_forward(seed_outputs, map_func, target_map):
+    """
+    add the seed with the best mAP together with the chosen ones until target_map is reached
+    """
+    selected = []
+    remaining = list(range(seed_outputs.size(0)))
+    output_sum = torch.zeros_like(seed_outputs[0])
+    history = []
+    while len(remaining) > 0:
+        maps = [map_func(output_sum + seed_outputs[seed_idx]) for seed_idx in remaining]
+        best_idx = int(np.argmax(maps))
+        seed_idx = remaining.pop(best_idx)
+        selected.append(seed_idx)
+        output_sum += seed_outputs[seed_idx]
+        history.append((list(selected), maps[best_idx]))
+        if maps[best_idx] >= target_map:
+            break
+    return selected, history
+
+
+def select_seeds_backward(seed_outputs, map_func, target_map):
+    """
+    drop the seed whose removal keeps the best mAP while it stays over target_map
+    """
+    selected = list(range(seed_outputs.size(0)))
+    output_sum = seed_outputs.sum(dim=0)
+    history = [(list(selected), map_func(output_sum))]
+    while len(selected) > 1:
+        maps = [map_func(output_sum - seed_outputs[seed_idx]) for seed_idx in selected]
+        best_idx = int(np.argmax(maps))
+        if maps[best_idx] < target_map:
+            break
+        output_sum -= seed_outputs[selected.pop(best_idx)]
+        history.append((list(selected), maps[best_idx]))
+    return selected, history
+
+
+def main(args):
+    seeds = [int(seed) for seed in args.seeds.split(',') if seed]
+
+    seed_result_root = args.seed_result_root
+    if seed_result_root is None:
+        seed_result_root = FACE_SCENE_SEED_RESULT_ROOT if args.model_type == 'face_scene' else SCENE_SEED_RESULT_ROOT
+    if not check_exists(seed_result_root):
+        os.makedirs(seed_result_root)
+
+    cache_seed_outputs(args, seeds, seed_result_root)
+    video_names, seed_stores = load_seed_stores(seeds, seed_result_root)
+
+    gt_path = os.path.join(args.face_root, VAL_GT_NAME)
+    assert check_exists(gt_path)
+    gt_id2videos, id_num = load_rankings(gt_path)
+    class_ids = sorted(int(cid) for cid in gt_id2videos if 0 < int(cid) < args.num_classes)
+
+    candidates = get_seed_candidates(seed_stores, class_ids, min(args.candidate_num, len(video_names)))
+    hits, gt_lens = get_candidate_hits(video_names, candidates, class_ids, gt_id2videos)
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    seed_outputs = gather_seed_outputs(seed_stores, candidates, class_ids).to(device)
+    hits, gt_lens = hits.to(device), gt_lens.to(device)
+
+    def map_func(outputs):
+        return get_candidate_map(outputs, hits, gt_lens, id_num)
+
+    full_map = map_func(seed_outputs.sum(dim=0))
+    target_map = full_map - args.tolerance
+    logger.info('mAP of all the {} seeds: {:.6f}, target: {:.6f}'.format(len(seeds), full_map, target_map))
+
+    if args.strategy == 'forward':
+        selected, history = select_seeds_forward(seed_outputs, map_func, target_map)
+    else:
+        selected, history = select_seeds_backward(seed_outputs, map_func, target_map)
+
+    history = [([seeds[seed_idx] for seed_idx in seed_idxes], mean_ap) for seed_idxes, mean_ap in history]
+    for step_seeds, mean_ap in history:
+        print('mAP: {:.6f} SEEDS = {}'.format(mean_ap, ','.join(str(seed) for seed in step_seeds)))
+
+    selected_seeds = sorted(seeds[seed_idx] for seed_idx in selected)
+    manifest_path = args.manifest_path if args.manifest_path else get_seed_manifest_path(args.model_type)
+    write_seed_manifest(manifest_path, args.model_type, selected_seeds, map=history[-1][1], full_map=full_map,
+                        full_seeds=seeds, tolerance=args.tolerance, strategy=args.strategy, epoch=args.epoch,
+                        candidate_num=args.candidate_num, history=history)
+
+    return selected_seeds, history
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Template')
+    parser.add_argument('--model_type', default='face_scene', type=str,
+                        help='face_scene or scene models to select (default: face_scene)')
+    parser.add_argument('--seeds', default='0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15', type=str,
+                        help='seeds of the models to select from, separated by comma (default: 0,1,...,15)')
+    parser.add_argument('--strategy', default='forward', type=str,
+                        help='forward to add seeds or backward to drop seeds (default: forward)')
+    parser.add_argument('--tolerance', default=0.001, type=float,
+                        help='mAP the chosen seeds may lose to all the seeds (default: 0.001)')
+    parser.add_argument('--candidate_num', default=500, type=int,
+                        help='top videos of every class kept as candidates (default: 500)')
+    parser.add_argument('--manifest_path', default=None, type=str,
+                        help='path to save the seed manifest (default: seed_manifest.json in the checkpoint root)')
+    parser.add_argument('--seed_result_root', default=None, type=str,
+                        help='path to cache the val outputs of every seed '
+                             '(default: ./multi_view_{model_type}_seed_result_val/)')
+    parser.add_argument('--refresh', action='store_true', help='run the seeds again even if their outputs are cached')
+    parser.add_argument('--result_dtype', default='float32', type=str,
+                        help='dtype of the cached scores, float32 or float16 (default: float32)')
+    parser.add_argument('--face_root', default='/data/materials', type=str,
+                        help='path to load data (default: /data/materials/)')
+    parser.add_argument('--scene_root', default='./scene_feat', type=str,
+                        help='path to load scene feat (default: ./scene_feat/)')
+    parser.add_argument('--log_root', default='/data/logs/', type=str,
+                        help='path to save log (default: /data/logs/)')
+    parser.add_argument('--cache_root', default='./dataset_cache/', type=str,
+                        help='path to cache the preprocessed dataset (default: ./dataset_cache/)')
+    parser.add_argument('--device', default=None, type=str, help='indices of GPUs to enable (default: all)')
+    parser.add_argument('--epoch', type=int, default=100, help="the epoch num for train (default: 100)")
+    parser.add_argument('--num_classes', default=10035, type=int, help='number of classes (default: 10035)')
+    parser.add_argument('--scene_feat_dim', default=2048, type=int, help='dim of scene feature (default: 2048)')
+    parser.add_argument('--num_frame', default=40, type=int, help='size of video length (default: 40)')
+    parser.add_argument('--batch_size', default=16384, type=int, help='size of batch (default: 16384)')
+    parser.add_argument('--batch_mode', action='store_true', help='sample and gather a whole batch at once')
+    parser.add_argument('--compact', action='store_true',
+                        help='keep the face feats in float16 until they reach the model, the scene feats stay float32')
+    parser.add_argument('--grouped', action='store_true', help='stack all the models and run them as batched matmuls')
+    parser.set_defaults(tvt='val')
+
+    args = parser.parse_args()
+
+    assert args.model_type in ['face_scene', 'scene', ]
+    assert args.strategy in ['forward', 'backward', ]
+
+    if args.device:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.device
+
+    SEED = 0
+    random.seed(SEED)
+    np.random.seed(SEED)
+    torch.manual_seed(SEED)
+    torch.cuda.manual_seed(SEED)
+
+    log_path = os.path.join(args.log_root, 'log.txt')
+    init_logging(log_path)
+
+    main(args)
@@ -14,14 +14,15 @@ import numpy as np
 import torch
 from torch.utils.data import DataLoader
 
-from datasets import IQiYiFaceSceneDataset
+from datasets import IQiYiFaceSceneDataset, BatchDataLoader
 from models import ArcFaceSceneModel
-from utils import check_exists, init_logging, sep_cat_qds_select_face_scene_transforms
+from utils import check_exists, init_logging, sep_cat_qds_select_face_scene_transforms, get_result_store_root, \
+    write_result_store
 
 logger = logging.getLogger(__name__)
 
 
-def main(face_root, scene_root, seed, epoch):
+def main(face_root, scene_root, seed, epoch, batch_mode=False, compact=False, share_memory=False, cache_root=None):
     mask_path = './checkpoints/multi_view_face_scene/mask_index_file_{}.pickle'.format(seed)
     assert check_exists(mask_path)
 
@@ -34,8 +35,12 @@ def main(face_root, scene_root, seed, epoch):
 
     dataset = IQiYiFaceSceneDataset(face_root, scene_root, 'test', num_frame=40,
                                     transform=sep_cat_qds_select_face_scene_transforms, face_mask=face_mask_index,
-                                    scene_mask=scene_mask_index)
-    data_loader = DataLoader(dataset, batch_size=16384, shuffle=False, num_workers=4)
+                                    scene_mask=scene_mask_index, feat_dtype=np.float16 if compact else np.float32,
+                                    share_memory=share_memory, cache_root=cache_root)
+    if batch_mode:
+        data_loader = BatchDataLoader(dataset, batch_size=16384, shuffle=False, num_workers=4)
+    else:
+        data_loader = DataLoader(dataset, batch_size=16384, shuffle=False, num_workers=4)
 
     model = ArcFaceSceneModel(len(face_mask_index) + 2, len(scene_mask_index), 10034 + 1, )
     metric_func = torch.nn.Softmax(-1)
@@ -49,7 +54,7 @@ def main(face_root, scene_root, seed, epoch):
 
     logger.info('test model on {}'.format(device))
 
-    model.eval()
+    model.optimize_for_inference()
     all_outputs = []
     all_video_names = []
 
@@ -57,8 +62,8 @@ def main(face_root, scene_root, seed, epoch):
         for batch_idx, (feats1, feats2, _, video_names) in enumerate(data_loader):
             logger.info('Test Model: {}/{}'.format(batch_idx, len(data_loader)))
 
-            feats1 = feats1.to(device)
-            feats2 = feats2.to(device)
+            feats1 = feats1.to(device).float()
+            feats2 = feats2.to(device).float()
             output = model(feats1, feats2)
             output = metric_func(output)
             all_outputs.append(output.cpu())
@@ -80,9 +85,17 @@ if __name__ == '__main__':
                         help='path to save log (default: /data/logs/)')
     parser.add_argument('--result_root', default='/data/result/', type=str,
                         help='path to save result (default: /data/result/)')
+    parser.add_argument('--result_dtype', default='float32', type=str,
+                        help='dtype of the saved scores, float32 or float16 (default: float32)')
     parser.add_argument('--device', default=None, type=str, help='indices of GPUs to enable (default: all)')
     parser.add_argument('--epoch', type=int, default=100, help="the epoch num for train (default: 100)")
     parser.add_argument('--seed', type=int, default=0, help="random seed for multi view (default: 0)")
+    parser.add_argument('--batch_mode', action='store_true', help='sample and gather a whole batch at once')
+    parser.add_argument('--compact', action='store_true',
+                        help='keep the face feats in float16 until they reach the model, the scene feats stay float32')
+    parser.add_argument('--share_memory', action='store_true', help='keep the dataset arrays in shared memory')
+    parser.add_argument('--cache_root', default='./dataset_cache/', type=str,
+                        help='path to cache the preprocessed dataset (default: ./dataset_cache/)')
 
     args = parser.parse_args()
 
@@ -104,11 +117,11 @@ if __name__ == '__main__':
 
     init_logging(log_path)
 
-    all_outputs, all_video_names = main(args.face_root, args.scene_root, args.seed, args.epoch)
+    all_outputs, all_video_names = main(args.face_root, args.scene_root, args.seed, args.epoch, args.batch_mode,
+                                        args.compact, args.share_memory, args.cache_root)
 
-    pickle_file_data = (1, all_video_names, all_outputs.numpy())
-    with open('./multi_view_face_scene_result/multi_view_face_scene_{}.pickle'.format(args.seed), 'wb') as fout:
-        pickle.dump(pickle_file_data, fout)
+    store_root = get_result_store_root('./multi_view_face_scene_result', 'multi_view_face_scene_{}'.format(args.seed))
+    write_result_store(store_root, all_video_names, all_outputs, dtype=np.dtype(args.result_dtype))
 
     # top100_value, top100_idxes = torch.topk(all_outputs, 100, dim=0)
     # with open(result_log_path, 'w', encoding='utf-8') as f_result_log:
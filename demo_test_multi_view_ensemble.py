@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import os
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from datasets import BatchDataLoader, get_multi_view_dataset
+from models import load_multi_view_models, run_multi_view_ensemble
+from utils import check_exists, init_logging, get_result_store_root, write_result_store, load_seed_manifest
+
+logger = logging.getLogger(__name__)
+
+FACE_SCENE_RESULT_ROOT = './multi_view_face_scene_result'
+SCENE_RESULT_ROOT = './multi_view_scene_result'
+
+
+def main(args):
+    if args.seed_manifest:
+        seeds = load_seed_manifest(args.seed_manifest, args.model_type)
+    else:
+        seeds = [int(seed) for seed in args.seeds.split(',') if seed]
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    logger.info('test {} models of seeds {} on {}'.format(args.model_type, seeds, device))
+
+    models, input_indexes = load_multi_view_models(args.model_type, seeds, args.epoch, args.num_classes)
+    dataset = get_multi_view_dataset(args.model_type, args.face_root, args.scene_root, args.tvt, args.num_frame,
+                                     args.compact, args.cache_root)
+    if args.batch_mode and args.model_type == 'face_scene':
+        data_loader = BatchDataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4)
+    else:
+        data_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4)
+
+    all_outputs, all_video_names = run_multi_view_ensemble(args.model_type, models, input_indexes, data_loader,
+                                                           device, args.grouped, args.scene_feat_dim)
+    return len(models), all_outputs, all_video_names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Template')
+    parser.add_argument('--model_type', default='face_scene', type=str,
+                        help='face_scene or scene models to test (default: face_scene)')
+    parser.add_argument('--seeds', default='0,1,2,4,5,6,8,9,10,12,15', type=str,
+                        help='seeds of the models to test, separated by comma (default: 0,1,2,4,5,6,8,9,10,12,15)')
+    parser.add_argument('--seed_manifest', default=None, type=str,
+                        help='seed manifest of demo_select_seeds.py to take the seeds from instead (default: None)')
+    parser.add_argument('--face_root', default='/data/materials', type=str,
+                        help='path to load data (default: /data/materials/)')
+    parser.add_argument('--scene_root', default='./scene_feat', type=str,
+                        help='path to load scene feat (default: ./scene_feat/)')
+    parser.add_argument('--tvt', default='test', type=str, help='val or test to run the models on (default: test)')
+    parser.add_argument('--result_root', default=None, type=str,
+                        help='path to save result (default: ./multi_view_{model_type}_result/)')
+    parser.add_argument('--result_dtype', default='float32', type=str,
+                        help='dtype of the saved scores, float32 or float16 (default: float32)')
+    parser.add_argument('--log_root', default='/data/logs/', type=str,
+                        help='path to save log (default: /data/logs/)')
+    parser.add_argument('--cache_root', default='./dataset_cache/', type=str,
+                        help='path to cache the preprocessed dataset (default: ./dataset_cache/)')
+    parser.add_argument('--device', default=None, type=str, help='indices of GPUs to enable (default: all)')
+    parser.add_argument('--epoch', type=int, default=100, help="the epoch num for train (default: 100)")
+    parser.add_argument('--num_classes', default=10035, type=int, help='number of classes (default: 10035)')
+    parser.add_argument('--scene_feat_dim', default=2048, type=int, help='dim of scene feature (default: 2048)')
+    parser.add_argument('--num_frame', default=40, type=int, help='size of video length (default: 40)')
+    parser.add_argument('--batch_size', default=16384, type=int, help='size of batch (default: 16384)')
+    parser.add_argument('--batch_mode', action='store_true', help='sample and gather a whole batch at once')
+    parser.add_argument('--compact', action='store_true',
+                        help='keep the face feats in float16 until they reach the model, the scene feats stay float32')
+    parser.add_argument('--grouped', action='store_true', help='stack all the models and run them as batched matmuls')
+
+    args = parser.parse_args()
+
+    assert args.model_type in ['face_scene', 'scene', ]
+    assert args.tvt in ['val', 'test', ]
+
+    if args.device:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.device
+
+    SEED = 0
+    random.seed(SEED)
+    np.random.seed(SEED)
+    torch.manual_seed(SEED)
+    torch.cuda.manual_seed(SEED)
+
+    log_path = os.path.join(args.log_root, 'log.txt')
+    init_logging(log_path)
+
+    result_root = args.result_root
+    if result_root is None:
+        result_root = FACE_SCENE_RESULT_ROOT if args.model_type == 'face_scene' else SCENE_RESULT_ROOT
+        if args.tvt != 'test':
+            result_root = '{}_{}'.format(result_root, args.tvt)
+    if not check_exists(result_root):
+        os.makedirs(result_root)
+
+    output_num, all_outputs, all_video_names = main(args)
+
+    store_root = get_result_store_root(result_root, 'multi_view_{}_ensemble'.format(args.model_type))
+    write_result_store(store_root, all_video_names, all_outputs, output_num, dtype=np.dtype(args.result_dtype))
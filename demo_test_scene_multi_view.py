@@ -9,17 +9,19 @@ import logging
 import os
 import pickle
 
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
 
 from datasets import IQiYiSceneFeatDataset
 from models import ArcSceneFeatModel
-from utils import check_exists, init_logging, default_sep_select_scene_feat_transforms
+from utils import check_exists, init_logging, default_sep_select_scene_feat_transforms, get_result_store_root, \
+    write_result_store
 
 logger = logging.getLogger(__name__)
 
 
-def main(data_root, seed, epoch):
+def main(data_root, seed, epoch, cache_root=None):
     mask_path = './checkpoints/multi_view_scene/scene_mask_index_file_{}.pickle'.format(seed)
     assert check_exists(mask_path)
 
@@ -30,7 +32,7 @@ def main(data_root, seed, epoch):
     assert check_exists(model_path)
 
     dataset = IQiYiSceneFeatDataset(data_root, 'test', mask_index=mask_index,
-                                    transform=default_sep_select_scene_feat_transforms)
+                                    transform=default_sep_select_scene_feat_transforms, cache_root=cache_root)
 
     data_loader = DataLoader(dataset, batch_size=16384, shuffle=False, num_workers=4)
 
@@ -46,7 +48,7 @@ def main(data_root, seed, epoch):
 
     logger.info('test model on {}'.format(device))
 
-    model.eval()
+    model.optimize_for_inference()
 
     all_outputs = []
     all_video_names = []
@@ -73,8 +75,12 @@ if __name__ == '__main__':
                         help='path to save log (default: /data/logs/)')
     parser.add_argument('--result_root', default='/data/result/', type=str,
                         help='path to save result (default: /data/result/)')
+    parser.add_argument('--result_dtype', default='float32', type=str,
+                        help='dtype of the saved scores, float32 or float16 (default: float32)')
     parser.add_argument('--epoch', type=int, default=100, help="the epoch num for train (default: 100)")
     parser.add_argument('--seed', type=int, default=0, help="random seed for multi view (default: 0)")
+    parser.add_argument('--cache_root', default='./dataset_cache/', type=str,
+                        help='path to cache the preprocessed dataset (default: ./dataset_cache/)')
 
     args = parser.parse_args()
 
@@ -90,11 +96,10 @@ if __name__ == '__main__':
 
     init_logging(log_path)
 
-    all_outputs, all_video_names = main(args.data_root, args.seed, args.epoch)
+    all_outputs, all_video_names = main(args.data_root, args.seed, args.epoch, args.cache_root)
 
-    pickle_file_data = (1, all_video_names, all_outputs.numpy())
-    with open('./multi_view_scene_result/multi_view_scene_{}.pickle'.format(args.seed), 'wb') as fout:
-        pickle.dump(pickle_file_data, fout)
+    store_root = get_result_store_root('./multi_view_scene_result', 'multi_view_scene_{}'.format(args.seed))
+    write_result_store(store_root, all_video_names, all_outputs, dtype=np.dtype(args.result_dtype))
 
     # top100_value, top100_idxes = torch.topk(all_outputs, 100, dim=0)
     # with open(result_log_path, 'w', encoding='utf-8') as f_result_log:
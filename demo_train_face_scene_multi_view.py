@@ -14,9 +14,10 @@ import torch
 from torch import optim
 from torch.utils.data import DataLoader
 
-from datasets import IQiYiFaceSceneDataset
-from models import FocalLoss, ArcMarginProduct, ArcFaceSceneModel
-from utils import check_exists, save_model, get_mask_index, sep_cat_qds_select_face_scene_transforms
+from datasets import IQiYiFaceSceneDataset, BatchDataLoader
+from models import FocalLoss, ArcMarginProduct, ArcFaceSceneModel, train_multi_view_models
+from utils import check_exists, save_model, get_mask_index, sep_cat_qds_select_face_scene_transforms, \
+    sep_cat_qds_face_scene_transforms
 
 
 def main(args):
@@ -36,8 +37,12 @@ def main(args):
 
     dataset = IQiYiFaceSceneDataset(args.face_root, args.scene_root, 'train+val-noise', num_frame=args.num_frame,
                                     transform=sep_cat_qds_select_face_scene_transforms, face_mask=face_mask_index,
-                                    scene_mask=scene_mask_index)
-    data_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=4)
+                                    scene_mask=scene_mask_index, feat_dtype=np.float16 if args.compact else np.float32,
+                                    share_memory=args.share_memory, cache_root=args.cache_root)
+    if args.batch_mode:
+        data_loader = BatchDataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=4)
+    else:
+        data_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=4)
 
     log_step = len(data_loader) // 10 if len(data_loader) > 10 else 1
 
@@ -54,8 +59,8 @@ def main(args):
     for epoch_idx in range(args.epoch):
         total_loss = .0
         for batch_idx, (face_feats, scene_feats, labels, _) in enumerate(data_loader):
-            face_feats = face_feats.to(device)
-            scene_feats = scene_feats.to(device)
+            face_feats = face_feats.to(device).float()
+            scene_feats = scene_feats.to(device).float()
             labels = labels.to(device)
 
             optimizer.zero_grad()
@@ -85,6 +90,30 @@ def main(args):
     save_model(model, args.save_dir, 'demo_arcface_face+scene_nan_{}_model'.format(model_id), args.epoch)
 
 
+def main_multi_seed(args):
+    """
+    train the models of all the seeds on one unmasked data pipeline, see train_multi_view_models
+    """
+    if not check_exists(args.save_dir):
+        os.makedirs(args.save_dir)
+
+    seeds = [int(seed) for seed in args.seeds.split(',') if seed]
+
+    dataset = IQiYiFaceSceneDataset(args.face_root, args.scene_root, 'train+val-noise', num_frame=args.num_frame,
+                                    transform=sep_cat_qds_face_scene_transforms,
+                                    feat_dtype=np.float16 if args.compact else np.float32,
+                                    share_memory=args.share_memory, cache_root=args.cache_root)
+    if args.batch_mode:
+        data_loader = BatchDataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=4)
+    else:
+        data_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=4)
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    train_multi_view_models('face_scene', seeds, data_loader, args.save_dir, args.epoch, args.learning_rate,
+                            args.num_classes, args.face_feat_dim, args.scene_feat_dim, device)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='PyTorch Template')
     parser.add_argument('--face_root', default='/data/materials', type=str,
@@ -102,6 +131,16 @@ if __name__ == '__main__':
     parser.add_argument('--batch_size', default=4096, type=int, help='dim of feature (default: 4096)')
     parser.add_argument('--num_frame', default=40, type=int, help='size of video length (default: 40)')
     parser.add_argument('--seed', default=0, type=int, help='seed for all random module (default: 0)')
+    parser.add_argument('--seeds', default=None, type=str,
+                        help='seeds to train on one data pipeline, separated by comma, the models start from the '
+                             'weights of the single seed runs but share the shuffle and the dropout rng of --seed, '
+                             'so they do not match the single seed runs (default: None)')
+    parser.add_argument('--batch_mode', action='store_true', help='sample and gather a whole batch at once')
+    parser.add_argument('--compact', action='store_true',
+                        help='keep the face feats in float16 until they reach the model, the scene feats stay float32')
+    parser.add_argument('--share_memory', action='store_true', help='keep the dataset arrays in shared memory')
+    parser.add_argument('--cache_root', default='./dataset_cache/', type=str,
+                        help='path to cache the preprocessed dataset (default: ./dataset_cache/)')
 
     args = parser.parse_args()
 
@@ -115,4 +154,7 @@ if __name__ == '__main__':
     torch.cuda.manual_seed(SEED)
     torch.cuda.manual_seed_all(SEED)
 
-    main(args)
+    if args.seeds:
+        main_multi_seed(args)
+    else:
+        main(args)
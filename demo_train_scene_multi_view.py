@@ -15,8 +15,9 @@ from torch import optim
 from torch.utils.data import DataLoader
 
 from datasets import IQiYiSceneFeatDataset
-from models import FocalLoss, ArcMarginProduct, ArcSceneFeatModel
-from utils import check_exists, save_model, get_mask_index, default_sep_select_scene_feat_transforms
+from models import FocalLoss, ArcMarginProduct, ArcSceneFeatModel, train_multi_view_models
+from utils import check_exists, save_model, get_mask_index, default_sep_select_scene_feat_transforms, \
+    default_scene_feat_transforms
 
 
 def main(args):
@@ -32,7 +33,7 @@ def main(args):
         pickle.dump(mask_index, fout)
 
     dataset = IQiYiSceneFeatDataset(args.data_root, 'train+val-noise', mask_index=mask_index,
-                                    transform=default_sep_select_scene_feat_transforms)
+                                    transform=default_sep_select_scene_feat_transforms, cache_root=args.cache_root)
 
     data_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=4)
 
@@ -81,6 +82,26 @@ def main(args):
     save_model(model, args.save_dir, 'demo_arcface_scene_multi_view_{}_model'.format(model_id), args.epoch)
 
 
+def main_multi_seed(args):
+    """
+    train the models of all the seeds on one unmasked data pipeline, see train_multi_view_models
+    """
+    if not check_exists(args.save_dir):
+        os.makedirs(args.save_dir)
+
+    seeds = [int(seed) for seed in args.seeds.split(',') if seed]
+
+    dataset = IQiYiSceneFeatDataset(args.data_root, 'train+val-noise', transform=default_scene_feat_transforms,
+                                    cache_root=args.cache_root)
+
+    data_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=4)
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    train_multi_view_models('scene', seeds, data_loader, args.save_dir, args.epoch, args.learning_rate,
+                            args.num_classes, scene_feat_dim=args.feat_dim, device=device)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='PyTorch Template')
     parser.add_argument('--data_root', default='./scene_feat/', type=str,
@@ -94,6 +115,12 @@ if __name__ == '__main__':
     parser.add_argument('--feat_dim', default=2048, type=int, help='dim of feature (default: 2048)')
     parser.add_argument('--learning_rate', type=float, default=0.1, help="learning rate for model (default: 0.1)")
     parser.add_argument('--seed', default=0, type=int, help='seed for all random module (default: 0)')
+    parser.add_argument('--seeds', default=None, type=str,
+                        help='seeds to train on one data pipeline, separated by comma, the models start from the '
+                             'weights of the single seed runs but share the shuffle and the dropout rng of --seed, '
+                             'so they do not match the single seed runs (default: None)')
+    parser.add_argument('--cache_root', default='./dataset_cache/', type=str,
+                        help='path to cache the preprocessed dataset (default: ./dataset_cache/)')
 
     args = parser.parse_args()
 
@@ -107,4 +134,7 @@ if __name__ == '__main__':
     torch.cuda.manual_seed(SEED)
     torch.cuda.manual_seed_all(SEED)
 
-    main(args)
+    if args.seeds:
+        main_multi_seed(args)
+    else:
+        main(args)
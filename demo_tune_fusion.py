@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import argparse
+import itertools
+import logging
+import os
+
+import numpy as np
+import torch
+
+from datasets.iqiyi_dataset import FEAT_PATH, FACE_VAL_NAME, VAL_GT_NAME
+from evaluation_map import load_rankings, get_candidate_hits, get_candidate_map
+from utils import check_exists, init_logging, load_face_stats, merge_multi_view_result, merge_class_topk, \
+    RESULT_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+FACE_SCENE_VAL_RESULT_ROOT = './multi_view_face_scene_result_val'
+SCENE_VAL_RESULT_ROOT = './multi_view_scene_result_val'
+
+"""
+fused like main.py: a face scene output of split i is blended with its scene output by SCENE_BALANCE_WEIGHT[i],
+a video over all the split points keeps its face scene output, a video without face (split 0) that only has
+the scene output gets SCENE_BALANCE_WEIGHT[0][1] * scene output, and the better of its two rows if it has both.
+the mAP of every class is taken over its candidates: the top candidate_num videos by the face scene output
+and by the scene output, the other videos are taken to never reach the top 100 of the class.
+so the reported mAP is an approximation of the mAP of main.py, exact only when no other video reaches the top 100
+"""
+
+
+def load_fusion_inputs(face_scene_root, scene_root, face_path):
+    face_stats = load_face_stats(face_path)
+    stats_idx_dict = {video_name: idx for idx, video_name in enumerate(face_stats['video_names'].tolist())}
+
+    face_scene_output_num, face_scene_video_names, face_scene_output_sum \
+        = merge_multi_view_result(face_scene_root, is_save=False)
+    scene_output_num, scene_video_names, scene_output_sum \
+        = merge_multi_view_result(scene_root, is_save=False)
+
+    # the face scene videos come first, then the videos without face that only have the scene output
+    face_scene_name_set = set(face_scene_video_names)
+    scene_only_names = [video_name for video_name in scene_video_names if video_name not in face_scene_name_set
+                        and video_name in stats_idx_dict
+                        and face_stats['frame_num'][stats_idx_dict[video_name]] == 0]
+    video_names = face_scene_video_names + scene_only_names
+    video_idx_dict = {video_name: idx for idx, video_name in enumerate(video_names)}
+
+    stats_idxes = np.array([stats_idx_dict.get(video_name, -1) for video_name in video_names], dtype=np.int64)
+    # the videos without stats are in none of the splits
+    frame_nums = np.where(stats_idxes >= 0, face_stats['frame_num'][stats_idxes], -1)
+    norms = np.where(stats_idxes >= 0, face_stats['mean_norm'][stats_idxes], np.inf).astype(np.float32)
+
+    scene_rows = np.full(len(video_names), -1, dtype=np.int64)
+    scene_video_idxes = np.full(len(scene_video_names), -1, dtype=np.int64)
+    for scene_row, video_name in enumerate(scene_video_names):
+        if video_name in video_idx_dict:
+            scene_rows[video_idx_dict[video_name]] = scene_row
+            scene_video_idxes[scene_row] = video_idx_dict[video_name]
+
+    return {'video_names': video_names, 'num_face_scene': len(face_scene_video_names),
+            'face_scene_outputs': face_scene_output_sum, 'face_scene_output_num': face_scene_output_num,
+            'scene_outputs': scene_output_sum, 'scene_output_num': scene_output_num,
+            'scene_rows': scene_rows, 'scene_video_idxes': scene_video_idxes,
+            'frame_nums': frame_nums, 'norms': norms}
+
+
+def _get_topk_video_idxes(outputs, output_num, row_video_idxes, k):
+    topk_values = None
+    topk_indexes = None
+    for start in range(0, outputs.shape[0], RESULT_CHUNK_SIZE):
+        chunk = torch.from_numpy(outputs[start:start + RESULT_CHUNK_SIZE] / output_num)
+        chunk[torch.from_numpy(row_video_idxes[start:start + RESULT_CHUNK_SIZE] < 0)] = -float('inf')
+        topk_values, topk_indexes = merge_class_topk(topk_values, topk_indexes, chunk, start, k)
+    return row_video_idxes[topk_indexes.numpy()].T
+
+
+def get_fusion_candidates(fusion_inputs, class_ids, candidate_num):
+    """
+    the (num_class, num_candidate) video indexes of every class, the repeats are pointed to -1
+    """
+    num_video = len(fusion_inputs['video_names'])
+    face_scene_idxes = np.arange(fusion_inputs['num_face_scene'], dtype=np.int64)
+    candidates = np.concatenate([
+        _get_topk_video_idxes(fusion_inputs['face_scene_outputs'], fusion_inputs['face_scene_output_num'],
+                              face_scene_idxes, candidate_num),
+        _get_topk_video_idxes(fusion_inputs['scene_outputs'], fusion_inputs['scene_output_num'],
+                              fusion_inputs['scene_video_idxes'], candidate_num)], axis=1)[class_ids]
+    candidates[(candidates < 0) | (candidates >= num_video)] = -1
+
+    candidates = np.sort(candidates, axis=1)
+    candidates[:, 1:][candidates[:, 1:] == candidates[:, :-1]] = -1
+    return candidates
+
+
+def gather_candidate_inputs(fusion_inputs, candidates, class_ids):
+    valid = candidates >= 0
+    video_idxes = np.where(valid, candidates, 0)
+    class_idxes = np.array(class_ids, dtype=np.int64)[:, None]
+
+    has_face_scene = valid & (video_idxes < fusion_inputs['num_face_scene'])
+    face_scene_rows = np.where(has_face_scene, video_idxes, 0)
+    face_scene_outputs = fusion_inputs['face_scene_outputs'][face_scene_rows, class_idxes] \
+        / fusion_inputs['face_scene_output_num']
+
+    scene_rows = fusion_inputs['scene_rows'][video_idxes]
+    has_scene = valid & (scene_rows >= 0)
+    scene_outputs = fusion_inputs['scene_outputs'][np.where(has_scene, scene_rows, 0), class_idxes] \
+        / fusion_inputs['scene_output_num']
+
+    return {'valid': torch.from_numpy(valid),
+            'has_face_scene': torch.from_numpy(has_face_scene),
+            'has_scene': torch.from_numpy(has_scene),
+            'face_scene_outputs': torch.from_numpy(np.where(has_face_scene, face_scene_outputs, 0.)
+                                                   .astype(np.float32)),
+            'scene_outputs': torch.from_numpy(np.where(has_scene, scene_outputs, 0.).astype(np.float32)),
+            'frame_nums': torch.from_numpy(fusion_inputs['frame_nums'][video_idxes]),
+            'norms': torch.from_numpy(fusion_inputs['norms'][video_idxes])}
+
+
+def get_split_ids(candidate_inputs, split_points):
+    """
+    0 for the videos without face, i + 1 for a norm under split_points[i], -1 for the videos in none of the splits
+    """
+    split_points = torch.tensor(sorted(split_points), dtype=torch.float32, device=candidate_inputs['norms'].device)
+    split_ids = torch.searchsorted(split_points, candidate_inputs['norms'], right=True) + 1
+    split_ids[split_ids > len(split_points)] = -1
+    split_ids[candidate_inputs['frame_nums'] < 0] = -1
+    split_ids[candidate_inputs['frame_nums'] == 0] = 0
+    return split_ids
+
+
+def get_fusion_layout(candidate_inputs, split_points):
+    """
+    the flat indexes and the outputs of the candidates blended in every split, so a setting of weights only
+    scales and writes them back over the face scene outputs
+    """
+    split_ids = get_split_ids(candidate_inputs, split_points).view(-1)
+    face_scene_outputs = candidate_inputs['face_scene_outputs'].view(-1)
+    scene_outputs = candidate_inputs['scene_outputs'].view(-1)
+    has_face_scene = candidate_inputs['has_face_scene'].view(-1)
+    has_scene = candidate_inputs['has_scene'].view(-1)
+
+    base_outputs = face_scene_outputs.masked_fill(~candidate_inputs['valid'].view(-1), -float('inf'))
+    blend_splits = []
+    for split_idx in range(len(split_points) + 1):
+        idxes = torch.nonzero(has_face_scene & has_scene & (split_ids == split_idx)).view(-1)
+        blend_splits.append((idxes, face_scene_outputs[idxes], scene_outputs[idxes]))
+    scene_only_idxes = torch.nonzero(candidate_inputs['valid'].view(-1) & ~has_face_scene).view(-1)
+
+    return {'shape': candidate_inputs['valid'].shape, 'base_outputs': base_outputs, 'blend_splits': blend_splits,
+            'scene_only_idxes': scene_only_idxes, 'scene_only_outputs': scene_outputs[scene_only_idxes]}
+
+
+def fuse_candidate_outputs(fusion_layout, balance_weights):
+    outputs = fusion_layout['base_outputs'].clone()
+    for split_idx, (idxes, face_scene_outputs, scene_outputs) in enumerate(fusion_layout['blend_splits']):
+        balance_weight = balance_weights[split_idx]
+        blend_outputs = face_scene_outputs * balance_weight[0] + scene_outputs * balance_weight[1]
+        if split_idx == 0:
+            # the video without face also has its scene only row
+            blend_outputs = torch.max(blend_outputs, scene_outputs * balance_weight[1])
+        outputs[idxes] = blend_outputs
+    outputs[fusion_layout['scene_only_idxes']] = fusion_layout['scene_only_outputs'] * balance_weights[0][1]
+
+    return outputs.view(fusion_layout['shape'])
+
+
+def parse_split_points(split_points_str):
+    """
+    candidates separated by ';', a candidate is comma separated points or start:stop:step for one point
+    """
+    all_split_points = []
+    for item in split_points_str.split(';'):
+        if ':' in item:
+            start, stop, step = [float(value) for value in item.split(':')]
+            all_split_points += [(round(point, 6),) for point in np.arange(start, stop + step / 2, step).tolist()]
+        elif item:
+            all_split_points.append(tuple(float(value) for value in item.split(',')))
+    return all_split_points
+
+
+def main(args):
+    face_path = os.path.join(args.face_root, FEAT_PATH, FACE_VAL_NAME)
+    gt_path = os.path.join(args.face_root, VAL_GT_NAME)
+    assert check_exists(gt_path)
+
+    gt_id2videos, id_num = load_rankings(gt_path)
+    fusion_inputs = load_fusion_inputs(args.face_scene_root, args.scene_root, face_path)
+    num_classes = fusion_inputs['face_scene_outputs'].shape[1]
+    class_ids = sorted(int(cid) for cid in gt_id2videos if 0 < int(cid) < num_classes)
+    logger.info('tune the fusion on {} videos and {} classes'.format(
+        len(fusion_inputs['video_names']), len(class_ids)))
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    candidates = get_fusion_candidates(fusion_inputs, class_ids, args.candidate_num)
+    candidate_inputs = gather_candidate_inputs(fusion_inputs, candidates, class_ids)
+    candidate_inputs = {key: value.to(device) for key, value in candidate_inputs.items()}
+    hits, gt_lens = get_candidate_hits(fusion_inputs['video_names'], candidates, class_ids, gt_id2videos)
+    hits, gt_lens = hits.to(device), gt_lens.to(device)
+
+    weight_values = [float(value) for value in args.weights.split(',') if value]
+    weight_pairs = list(itertools.product(weight_values, weight_values))
+
+    results = []
+    for split_points in parse_split_points(args.split_points):
+        fusion_layout = get_fusion_layout(candidate_inputs, split_points)
+        for balance_weights in itertools.product(weight_pairs, repeat=len(split_points) + 1):
+            outputs = fuse_candidate_outputs(fusion_layout, balance_weights)
+            results.append((get_candidate_map(outputs, hits, gt_lens, id_num), split_points, balance_weights))
+        logger.info('split points {} done, {} settings scored'.format(split_points, len(results)))
+
+    results.sort(key=lambda item: -item[0])
+    print('approximate mAP over the top {} candidates of every class and output, not the exact mAP'
+          .format(args.candidate_num))
+    for mean_ap, split_points, balance_weights in results[:args.report_num]:
+        print('mAP: {:.6f} SPLIT_POINTS = {} SCENE_BALANCE_WEIGHT = {}'.format(
+            mean_ap, split_points, balance_weights))
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Template')
+    parser.add_argument('--face_root', default='/data/materials', type=str,
+                        help='path to load data (default: /data/materials/)')
+    parser.add_argument('--face_scene_root', default=FACE_SCENE_VAL_RESULT_ROOT, type=str,
+                        help='path of the face scene val results (default: {})'.format(FACE_SCENE_VAL_RESULT_ROOT))
+    parser.add_argument('--scene_root', default=SCENE_VAL_RESULT_ROOT, type=str,
+                        help='path of the scene val results (default: {})'.format(SCENE_VAL_RESULT_ROOT))
+    parser.add_argument('--log_root', default='/data/logs/', type=str,
+                        help='path to save log (default: /data/logs/)')
+    parser.add_argument('--device', default=None, type=str, help='indices of GPUs to enable (default: all)')
+    parser.add_argument('--split_points', default='8.0:9.6:0.1', type=str,
+                        help='split points to try, separated by ";", start:stop:step for one point '
+                             '(default: 8.0:9.6:0.1)')
+    parser.add_argument('--weights', default='0,0.2,0.5,0.8,0.95,1', type=str,
+                        help='values of the face and scene weights to try (default: 0,0.2,0.5,0.8,0.95,1)')
+    parser.add_argument('--candidate_num', default=300, type=int,
+                        help='top videos of every class and output kept as candidates, the mAP is only taken over them '
+                             '(default: 300)')
+    parser.add_argument('--report_num', default=10, type=int, help='number of the best settings to print')
+
+    args = parser.parse_args()
+
+    if args.device:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.device
+
+    log_path = os.path.join(args.log_root, 'log.txt')
+    init_logging(log_path)
+
+    main(args)
@@ -1,45 +1,152 @@
 # -*- coding: utf-8 -*-
-def calculate_map(gt_path, my_path):
+import argparse
+
+import numpy as np
+import torch
+
+__all__ = ['load_rankings', 'get_rankings_from_topk', 'get_rankings_from_scores', 'evaluate_map', 'calculate_map',
+           'get_candidate_hits', 'get_candidate_map']
+
+TOP_K = 100
+
+
+def load_rankings(file_path):
+    """
+    the lines of a gt or result file as {class id: [video, ...]} and the number of lines
+    """
     id2videos = dict()
-    with open(gt_path, 'r') as fin:
+    with open(file_path, 'r') as fin:
         lines = fin.readlines()
         for line in lines:
             terms = line.strip().split(' ')
             id2videos[terms[0]] = terms[1:]
-    id_num = len(lines)
+    return id2videos, len(lines)
 
-    my_id2videos = dict()
-    with open(my_path, 'r') as fin:
-        lines = fin.readlines()
-        assert (len(lines) <= id_num)
-        for line in lines:
-            terms = line.strip().split(' ')
-            tmp_list = []
-            for video in terms[1:]:
-                if video not in tmp_list:
-                    tmp_list.append(video)
-            my_id2videos[terms[0]] = tmp_list
-
-    ap_total = 0.
-    for cid in id2videos:
-        videos = id2videos[cid]
-        if cid not in my_id2videos:
-            continue
-        my_videos = my_id2videos[cid]
-        # recall number upper bound
-        assert (len(my_videos) <= 100)
-        ap = 0.
-        ind = 0.
-        for ind_video, my_video in enumerate(my_videos):
-            if my_video in videos:
-                ind += 1
-                ap += ind / (ind_video + 1)
-        ap_total += ap / len(videos)
-
-    return ap_total / id_num
+
+def get_rankings_from_topk(topk_indexes, video_names, class_ids=None, suffix='.mp4'):
+    """
+    the rankings of the (k, num_classes) video indexes of the top k, like the lines of result.txt
+    """
+    topk_indexes = np.asarray(topk_indexes)
+    if class_ids is None:
+        class_ids = range(1, topk_indexes.shape[1])
+    return {str(class_id): ['{}{}'.format(video_names[idx], suffix) for idx in topk_indexes[:, class_id]]
+            for class_id in class_ids}
+
+
+def get_rankings_from_scores(scores, video_names, k=TOP_K, class_ids=None, suffix='.mp4'):
+    scores = torch.as_tensor(scores)
+    _, topk_indexes = torch.topk(scores, min(k, scores.size(0)), dim=0)
+    return get_rankings_from_topk(topk_indexes.numpy(), video_names, class_ids, suffix)
+
+
+def evaluate_map(gt_id2videos, my_id2videos, id_num=None, per_class=False):
+    """
+    the mAP of calculate_map over the rankings of all the classes at once: the videos become integer ids,
+    the repeated predictions of a class are dropped and the hits are counted with cumulative sums,
+    the sum of AP is divided by id_num (default: the number of gt classes),
+    a gt class without any video has no AP and is skipped, it still counts in id_num,
+    with per_class it returns (mAP, {class id: AP}, the number of classes evaluated)
+    """
+    if id_num is None:
+        id_num = len(gt_id2videos)
+    assert (len(my_id2videos) <= id_num)
+
+    class_ids = [cid for cid in gt_id2videos if cid in my_id2videos and len(gt_id2videos[cid]) > 0]
+    if len(class_ids) == 0:
+        return (0., {}, 0) if per_class else 0.
+
+    video_ids = dict()
+    my_ids = [[video_ids.setdefault(video, len(video_ids)) for video in my_id2videos[cid]] for cid in class_ids]
+    gt_ids = [[video_ids.setdefault(video, len(video_ids)) for video in gt_id2videos[cid]] for cid in class_ids]
+    num_video = len(video_ids)
+
+    preds = np.full((len(class_ids), max(1, max(len(ids) for ids in my_ids))), -1, dtype=np.int64)
+    for class_idx, ids in enumerate(my_ids):
+        preds[class_idx, :len(ids)] = ids
+
+    # a prediction is a repeat if the stable sort puts it right after the same video
+    order = np.argsort(preds, axis=1, kind='stable')
+    sorted_preds = np.take_along_axis(preds, order, axis=1)
+    sorted_repeats = np.zeros(preds.shape, dtype=bool)
+    sorted_repeats[:, 1:] = sorted_preds[:, 1:] == sorted_preds[:, :-1]
+    repeats = np.empty(preds.shape, dtype=bool)
+    np.put_along_axis(repeats, order, sorted_repeats, axis=1)
+    valid = (preds >= 0) & ~repeats
+
+    # recall number upper bound
+    assert (np.sum(valid, axis=1).max() <= TOP_K)
+
+    class_codes = np.arange(len(class_ids), dtype=np.int64)[:, None] * num_video
+    gt_codes = np.concatenate([class_idx * num_video + np.array(ids, dtype=np.int64)
+                               for class_idx, ids in enumerate(gt_ids)])
+    hits = valid & np.isin(class_codes + preds, gt_codes)
+
+    ranks = np.cumsum(valid, axis=1)
+    hit_nums = np.cumsum(hits, axis=1)
+    precisions = np.divide(hit_nums, ranks, out=np.zeros(preds.shape, dtype=np.float64), where=hits)
+    aps = precisions.sum(axis=1) / np.array([len(ids) for ids in gt_ids], dtype=np.float64)
+
+    mean_ap = aps.sum() / id_num
+    if per_class:
+        return mean_ap, dict(zip(class_ids, aps.tolist())), len(class_ids)
+    return mean_ap
+
+
+def get_candidate_hits(video_names, candidates, class_ids, gt_id2videos):
+    """
+    mark the (num_class, num_candidate) video indexes of every class that are its gt videos, a candidate -1 is none,
+    and the gt numbers of the classes for get_candidate_map
+    """
+    video_idx_dict = {video_name: idx for idx, video_name in enumerate(video_names)}
+    num_video = len(video_idx_dict)
+    gt_codes = []
+    for class_idx, class_id in enumerate(class_ids):
+        for video in gt_id2videos[str(class_id)]:
+            video_name = video.replace('.mp4', '')
+            if video_name in video_idx_dict:
+                gt_codes.append(class_idx * num_video + video_idx_dict[video_name])
+    codes = np.arange(len(class_ids), dtype=np.int64)[:, None] * num_video + candidates
+    hits = (candidates >= 0) & np.isin(codes, np.array(gt_codes, dtype=np.int64))
+    gt_lens = np.array([len(gt_id2videos[str(class_id)]) for class_id in class_ids], dtype=np.float64)
+    return torch.from_numpy(hits), torch.from_numpy(gt_lens)
+
+
+def get_candidate_map(outputs, hits, gt_lens, id_num):
+    """
+    the mAP of (num_class, num_candidate) outputs of every class over its candidates, hits marks the gt candidates
+    and gt_lens are the gt numbers of the classes, the candidates out of the top k never count,
+    a class without any gt video has the AP 0. like a class of evaluate_map that is skipped
+    """
+    _, topk_idxes = torch.topk(outputs, min(TOP_K, outputs.size(1)), dim=1)
+    topk_hits = torch.gather(hits, 1, topk_idxes).float()
+    hit_nums = torch.cumsum(topk_hits, dim=1)
+    ranks = torch.arange(1, topk_hits.size(1) + 1, dtype=torch.float32, device=outputs.device)
+    aps = torch.sum(topk_hits * hit_nums / ranks, dim=1).double() / gt_lens.clamp(min=1)
+    return aps.sum().item() / id_num
+
+
+def calculate_map(gt_path, my_path, per_class=False):
+    gt_id2videos, id_num = load_rankings(gt_path)
+    my_id2videos, my_num = load_rankings(my_path)
+    assert (my_num <= id_num)
+    return evaluate_map(gt_id2videos, my_id2videos, id_num, per_class)
 
 
 if __name__ == '__main__':
-    gt_val_path = '/data/materials/val_gt.txt'
-    my_val_path = '/data/result/result.txt'
-    print('mAP: {}'.format(calculate_map(gt_val_path, my_val_path)))
+    parser = argparse.ArgumentParser(description='PyTorch Template')
+    parser.add_argument('--gt_path', default='/data/materials/val_gt.txt', type=str,
+                        help='path of the gt (default: /data/materials/val_gt.txt)')
+    parser.add_argument('--result_path', default='/data/result/result.txt', type=str,
+                        help='path of the result (default: /data/result/result.txt)')
+    parser.add_argument('--per_class', action='store_true', help='print the AP of every class')
+    args = parser.parse_args()
+
+    if args.per_class:
+        mean_ap, class_aps, class_num = calculate_map(args.gt_path, args.result_path, per_class=True)
+        for cid, ap in sorted(class_aps.items(), key=lambda item: int(item[0])):
+            print('{} {:.6f}'.format(cid, ap))
+        print('evaluated classes: {}'.format(class_num))
+        print('mAP: {}'.format(mean_ap))
+    else:
+        print('mAP: {}'.format(calculate_map(args.gt_path, args.result_path)))
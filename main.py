@@ -4,6 +4,7 @@
 # @User    : legendong
 # @File    : main.py
 # @Software: PyCharm
+import argparse
 import logging
 import os
 import random
@@ -12,7 +13,7 @@ import time
 import numpy as np
 import torch
 
-from utils import init_logging, merge_multi_view_result, split_name_by_l2norm
+from utils import init_logging, merge_multi_view_result, split_name_by_l2norm, merge_class_topk, RESULT_CHUNK_SIZE
 
 logger = logging.getLogger(__name__)
 
@@ -20,56 +21,105 @@ FACE_TEST_NAME = 'face_test.pickle'
 SPLIT_POINTS = (8.867,)
 SCENE_BALANCE_WEIGHT = ((0., 0.95), (0.2, 0.8),)
 
+FACE_SCENE_RESULT_ROOT = './multi_view_face_scene_result'
+SCENE_RESULT_ROOT = './multi_view_scene_result'
+TOP_K = 100
 
-def main():
+
+def get_split_ids(video_names, split_names):
+    """
+    the split index of every video, -1 for the videos in none of the splits
+    """
+    name_split_dict = {}
+    for split_idx, split in enumerate(split_names):
+        for video_name in split:
+            name_split_dict[video_name] = split_idx
+    return np.array([name_split_dict.get(video_name, -1) for video_name in video_names], dtype=np.int64)
+
+
+def get_scene_rows(video_names, scene_name_idx_dict):
+    """
+    the row of every video in the scene outputs, -1 for the videos without scene output
+    """
+    return np.array([scene_name_idx_dict.get(video_name, -1) for video_name in video_names], dtype=np.int64)
+
+
+def iter_fused_outputs(is_save=False, chunk_size=RESULT_CHUNK_SIZE):
+    """
+    yield the fused outputs and their video names chunk by chunk, the merged results stay on disk as memmaps
+    and are only saved in the result roots when is_save,
+    a face scene output in split i is blended with its scene output by SCENE_BALANCE_WEIGHT[i],
+    then the videos of split 0 that only have a scene output follow
+    """
     split_names = split_name_by_l2norm(os.path.join('/data/materials', 'feat', FACE_TEST_NAME), SPLIT_POINTS)
 
     face_scene_output_num, face_scene_video_names, face_scene_output_sum \
-        = merge_multi_view_result('./multi_view_face_scene_result', is_save=False)
-    face_scene_outputs = torch.from_numpy(face_scene_output_sum / face_scene_output_num)
+        = merge_multi_view_result(FACE_SCENE_RESULT_ROOT, is_save=is_save)
 
     scene_output_num, scene_video_names, scene_output_sum \
-        = merge_multi_view_result('./multi_view_scene_result', is_save=False)
-    scene_outputs = torch.from_numpy(scene_output_sum / scene_output_num)
-
-    scene_name_output_dict = {}
-    for idx, video_name in enumerate(scene_video_names):
-        scene_name_output_dict[video_name] = scene_outputs[idx]
-
-    new_all_outputs = []
-    new_all_video_names = []
-    for name_idx, video_name in enumerate(face_scene_video_names):
-        temp_output = face_scene_outputs[name_idx]
-        for split_idx, split in enumerate(split_names):
-            if video_name in split:
-                if video_name in scene_name_output_dict:
-                    balance_weight = SCENE_BALANCE_WEIGHT[split_idx]
-                    scene_output = scene_name_output_dict[video_name]
-                    temp_output = temp_output * balance_weight[0] + scene_output * balance_weight[1]
-                    logger.info('video {} use scene output to calc by weight ({})'
-                                .format(video_name, ', '.join([str(weight) for weight in balance_weight])))
-                else:
-                    logger.warning('video {} should in name_output_dict but not'.format(video_name))
-        new_all_outputs.append(temp_output.view(1, -1))
-        new_all_video_names.append(video_name)
-    for video_name in split_names[0]:
-        if video_name in scene_name_output_dict:
-            balance_weight = SCENE_BALANCE_WEIGHT[0]
-            scene_output = scene_name_output_dict[video_name]
-            temp_output = scene_output * balance_weight[1]
-            logger.info('video {} use scene output to calc by weight ({})'
-                        .format(video_name, ', '.join([str(weight) for weight in balance_weight])))
-            new_all_outputs.append(temp_output.view(1, -1))
-            new_all_video_names.append(video_name)
-        else:
-            logger.warning('video {} should in name_output_dict but not'.format(video_name))
-
-    new_all_outputs = torch.cat(new_all_outputs, dim=0)
-
-    return new_all_outputs, new_all_video_names
+        = merge_multi_view_result(SCENE_RESULT_ROOT, is_save=is_save)
+
+    scene_name_idx_dict = {video_name: idx for idx, video_name in enumerate(scene_video_names)}
+
+    split_ids = get_split_ids(face_scene_video_names, split_names)
+    scene_rows = get_scene_rows(face_scene_video_names, scene_name_idx_dict)
+
+    for video_idx in np.nonzero((split_ids >= 0) & (scene_rows < 0))[0]:
+        logger.warning('video {} should in name_output_dict but not'.format(face_scene_video_names[video_idx]))
+    for split_idx, balance_weight in enumerate(SCENE_BALANCE_WEIGHT):
+        logger.info('{} videos in split {} use scene output to calc by weight ({})'
+                    .format(np.sum((split_ids == split_idx) & (scene_rows >= 0)), split_idx,
+                            ', '.join([str(weight) for weight in balance_weight])))
+
+    for start in range(0, len(face_scene_video_names), chunk_size):
+        end = min(start + chunk_size, len(face_scene_video_names))
+        outputs = torch.from_numpy(face_scene_output_sum[start:end] / face_scene_output_num)
+        chunk_split_ids = split_ids[start:end]
+        chunk_scene_rows = scene_rows[start:end]
+
+        for split_idx, balance_weight in enumerate(SCENE_BALANCE_WEIGHT):
+            chunk_idxes = np.nonzero((chunk_split_ids == split_idx) & (chunk_scene_rows >= 0))[0]
+            if len(chunk_idxes) == 0:
+                continue
+            scene_outputs = torch.from_numpy(scene_output_sum[chunk_scene_rows[chunk_idxes]] / scene_output_num)
+            chunk_idxes = torch.from_numpy(chunk_idxes)
+            outputs[chunk_idxes] = outputs[chunk_idxes] * balance_weight[0] + scene_outputs * balance_weight[1]
+
+        yield outputs, face_scene_video_names[start:end]
+
+    # the videos of split 0 have no face, only the scene output is left for them
+    scene_only_rows = get_scene_rows(split_names[0], scene_name_idx_dict)
+    for video_idx in np.nonzero(scene_only_rows < 0)[0]:
+        logger.warning('video {} should in name_output_dict but not'.format(split_names[0][video_idx]))
+    scene_only_names = [split_names[0][video_idx] for video_idx in np.nonzero(scene_only_rows >= 0)[0]]
+    scene_only_rows = scene_only_rows[scene_only_rows >= 0]
+
+    balance_weight = SCENE_BALANCE_WEIGHT[0]
+    for start in range(0, len(scene_only_rows), chunk_size):
+        outputs = torch.from_numpy(scene_output_sum[scene_only_rows[start:start + chunk_size]] / scene_output_num)
+        yield outputs * balance_weight[1], scene_only_names[start:start + chunk_size]
+
+
+def main(is_save=False):
+    """
+    keep only the running top k videos of every class, the fused outputs of all the videos are never held at once
+    """
+    topk_values = None
+    topk_indexes = None
+    all_video_names = []
+    for outputs, video_names in iter_fused_outputs(is_save):
+        topk_values, topk_indexes = merge_class_topk(topk_values, topk_indexes, outputs, len(all_video_names), TOP_K)
+        all_video_names += video_names
+
+    return topk_indexes, all_video_names
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Template')
+    parser.add_argument('--save_merged', action='store_true',
+                        help='save the merged results in the result roots as multi_view_merged_store')
+    args = parser.parse_args()
+
     os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
     SEED = int(time.time())
@@ -87,9 +137,8 @@ if __name__ == '__main__':
 
     init_logging(log_path)
 
-    all_outputs, all_video_names = main()
+    top100_idxes, all_video_names = main(args.save_merged)
 
-    top100_value, top100_idxes = torch.topk(all_outputs, 100, dim=0)
     with open(result_log_path, 'w', encoding='utf-8') as f_result_log:
         with open(result_path, 'w', encoding='utf-8') as f_result:
             for label_idx in range(1, 10034 + 1):
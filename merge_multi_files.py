@@ -19,6 +19,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='PyTorch Template')
     parser.add_argument('--merge_type', default='face', type=str,
                         help='the pickle to merge (default: face)')
+    parser.add_argument('--weights', default='', type=str,
+                        help='weights of the results as name=weight, separated by comma (default: 1. for all)')
     args = parser.parse_args()
 
     log_root = '/data/logs/'
@@ -35,7 +37,14 @@ if __name__ == '__main__':
     else:
         raise RuntimeError
 
-    output_num, all_video_names, output_sum = merge_multi_view_result(pickle_root, is_save=True)
+    weights = None
+    if args.weights:
+        weights = {}
+        for name_weight in args.weights.split(','):
+            result_name, weight = name_weight.split('=')
+            weights[result_name] = float(weight)
+
+    output_num, all_video_names, output_sum = merge_multi_view_result(pickle_root, is_save=True, weights=weights)
 
     # all_outputs = output_sum / output_num
     #
@@ -7,3 +7,6 @@
 from .losses import *
 from .metrics import *
 from .models import *
+from .grouped_models import *
+from .quantization import *
+from .ensemble import *
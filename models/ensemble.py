@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import pickle
+
+import torch
+from torch import optim
+
+from models.grouped_models import get_grouped_model, select_grouped_inputs
+from models.losses import FocalLoss
+from models.metrics import ArcMarginProduct
+from models.models import ArcFaceSceneModel, ArcSceneFeatModel
+from utils import check_exists, save_model, get_mask_index, select_multi_view_inputs
+
+__all__ = ['get_multi_view_paths', 'get_seed_manifest_path', 'train_multi_view_models', 'load_multi_view_models',
+           'run_multi_view_ensemble', ]
+
+logger = logging.getLogger(__name__)
+
+"""
+the multi view models of several seeds trained on one data pipeline, or loaded for inference and run as one ensemble,
+their softmax outputs summed
+"""
+
+FACE_SCENE_CHECKPOINT_ROOT = './checkpoints/multi_view_face_scene'
+SCENE_CHECKPOINT_ROOT = './checkpoints/multi_view_scene'
+SEED_MANIFEST_NAME = 'seed_manifest.json'
+
+
+def get_multi_view_paths(model_type, seed, epoch):
+    if model_type == 'face_scene':
+        mask_path = os.path.join(FACE_SCENE_CHECKPOINT_ROOT, 'mask_index_file_{}.pickle'.format(seed))
+        model_path = os.path.join(FACE_SCENE_CHECKPOINT_ROOT,
+                                  'demo_arcface_face+scene_nan_{}_model_{:0>4d}.pth'.format(seed, epoch))
+    elif model_type == 'scene':
+        mask_path = os.path.join(SCENE_CHECKPOINT_ROOT, 'scene_mask_index_file_{}.pickle'.format(seed))
+        model_path = os.path.join(SCENE_CHECKPOINT_ROOT,
+                                  'demo_arcface_scene_multi_view_{}_model_{:0>4d}.pth'.format(seed, epoch))
+    else:
+        raise RuntimeError
+    return mask_path, model_path
+
+
+def get_seed_manifest_path(model_type):
+    """
+    the seed manifest written by demo_select_seeds.py next to the models it chose from
+    """
+    checkpoint_root = FACE_SCENE_CHECKPOINT_ROOT if model_type == 'face_scene' else SCENE_CHECKPOINT_ROOT
+    return os.path.join(checkpoint_root, SEED_MANIFEST_NAME)
+
+
+def train_multi_view_models(model_type, seeds, data_loader, save_dir, epoch, learning_rate=0.1, num_classes=10035,
+                            face_feat_dim=512 + 2, scene_feat_dim=2048, device=torch.device('cpu')):
+    """
+    train the models of all the seeds on one unmasked data pipeline, every model selects its own view of each batch,
+    every model starts from the weights of its single seed run, but the shuffle and the dropout of all the models are
+    drawn from the global rng, so the trained models do not match the single seed runs
+    """
+    log_step = len(data_loader) // 10 if len(data_loader) > 10 else 1
+
+    models = []
+    input_indexes = []
+    optimizers = []
+    lr_schedulers = []
+    for seed in seeds:
+        if model_type == 'face_scene':
+            face_mask_index = get_mask_index(seed, face_feat_dim - 2, 16)
+            print(face_mask_index)
+
+            scene_mask_index = get_mask_index(seed, scene_feat_dim, 16)
+            print(scene_mask_index)
+
+            with open(os.path.join(save_dir, 'mask_index_file_{}.pickle'.format(seed)), 'wb') as fout:
+                pickle.dump((face_mask_index, scene_mask_index), fout)
+
+            face_index = face_mask_index + [face_feat_dim - 2, face_feat_dim - 1]
+            input_indexes.append((torch.tensor(face_index, dtype=torch.long, device=device),
+                                  torch.tensor(scene_mask_index, dtype=torch.long, device=device)))
+        elif model_type == 'scene':
+            mask_index = get_mask_index(seed, scene_feat_dim, 32)
+            print(mask_index)
+
+            with open(os.path.join(save_dir, 'scene_mask_index_file_{}.pickle'.format(seed)), 'wb') as fout:
+                pickle.dump(mask_index, fout)
+
+            input_indexes.append((torch.tensor(mask_index, dtype=torch.long, device=device),))
+        else:
+            raise RuntimeError
+
+        # the same init as the single seed run, the global rng stays as it is for the data pipeline
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            if model_type == 'face_scene':
+                model = ArcFaceSceneModel(len(face_mask_index) + 2, len(scene_mask_index), num_classes, )
+            else:
+                model = ArcSceneFeatModel(len(mask_index), num_classes, )
+        model = model.to(device)
+        models.append(model)
+
+        optimizer = optim.SGD(model.parameters(), lr=learning_rate, momentum=0.9, weight_decay=1e-5)
+        optimizers.append(optimizer)
+        lr_schedulers.append(torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epoch))
+
+    metric_func = ArcMarginProduct()
+    loss_func = FocalLoss(gamma=2.)
+
+    for epoch_idx in range(epoch):
+        total_losses = [.0] * len(seeds)
+        sample_num = 0
+        for batch_idx, batch_data in enumerate(data_loader):
+            inputs = tuple(feats.to(device).float() for feats in batch_data[:-2])
+            labels = batch_data[-2].to(device)
+
+            local_losses = []
+            for model, optimizer, input_index in zip(models, optimizers, input_indexes):
+                optimizer.zero_grad()
+
+                outputs = model(*select_multi_view_inputs(inputs, input_index, scene_feat_dim))
+                outputs_metric = metric_func(outputs, labels)
+                local_loss = loss_func(outputs_metric, labels)
+
+                local_loss.backward()
+                optimizer.step()
+
+                local_losses.append(local_loss.item())
+
+            total_losses = [total_loss + local_loss for total_loss, local_loss in zip(total_losses, local_losses)]
+
+            if batch_idx % log_step == 0 and batch_idx != 0:
+                print('Epoch: {} [{}/{} ({:.0f}%)] Loss: {}'
+                      .format(epoch_idx, sample_num, len(data_loader.dataset),
+                              100.0 * batch_idx / len(data_loader),
+                              ' '.join('{:.6f}'.format(local_loss) for local_loss in local_losses)))
+            sample_num += len(labels)
+
+        log = {'epoch': epoch_idx,
+               'lr': optimizers[0].param_groups[0]['lr']}
+        for seed, total_loss in zip(seeds, total_losses):
+            log['loss_{:0>2d}'.format(seed)] = total_loss / len(data_loader)
+
+        for key, value in sorted(log.items(), key=lambda item: item[0]):
+            print('    {:20s}: {:6f}'.format(str(key), value))
+
+        for lr_scheduler in lr_schedulers:
+            lr_scheduler.step()
+
+    model_name = 'demo_arcface_face+scene_nan_{}_model' if model_type == 'face_scene' \
+        else 'demo_arcface_scene_multi_view_{}_model'
+    for seed, model in zip(seeds, models):
+        save_model(model, save_dir, model_name.format(seed), epoch)
+
+    return models
+
+
+def load_multi_view_models(model_type, seeds, epoch, num_classes=10035, face_dim=512):
+    """
+    load the model of every seed and the feat indexes it takes from the unmasked inputs,
+    the face indexes keep the quality and det score appended after the face feat
+    """
+    models = []
+    input_indexes = []
+    for seed in seeds:
+        mask_path, model_path = get_multi_view_paths(model_type, seed, epoch)
+        assert check_exists(mask_path)
+        assert check_exists(model_path)
+
+        with open(mask_path, 'rb') as fin:
+            mask_index = pickle.load(fin, encoding='bytes')
+
+        if model_type == 'face_scene':
+            face_mask_index, scene_mask_index = mask_index
+            model = ArcFaceSceneModel(len(face_mask_index) + 2, len(scene_mask_index), num_classes)
+            input_indexes.append((list(face_mask_index) + [face_dim, face_dim + 1], list(scene_mask_index)))
+        else:
+            model = ArcSceneFeatModel(len(mask_index), num_classes)
+            input_indexes.append((list(mask_index),))
+
+        logger.info('load model from {}'.format(model_path))
+        state_dict = torch.load(model_path, map_location='cpu')
+        model.load_state_dict(state_dict)
+        model.optimize_for_inference()
+        models.append(model)
+
+    return models, input_indexes
+
+
+def run_multi_view_ensemble(model_type, models, input_indexes, data_loader, device, grouped=False, scene_dim=2048):
+    """
+    the softmax outputs of all the models summed over the batches of data_loader and the video names,
+    with grouped all the models run in one forward of the grouped model
+    """
+    models = [model.to(device) for model in models]
+    if grouped:
+        grouped_model, grouped_index = get_grouped_model(model_type, models, input_indexes, device)
+    input_indexes = [tuple(torch.tensor(index, dtype=torch.long, device=device) for index in input_index)
+                     for input_index in input_indexes]
+
+    metric_func = torch.nn.Softmax(-1)
+
+    all_outputs = []
+    all_video_names = []
+
+    with torch.no_grad():
+        for batch_idx, batch_data in enumerate(data_loader):
+            logger.info('Test Model: {}/{}'.format(batch_idx, len(data_loader)))
+
+            inputs = tuple(feats.to(device).float() for feats in batch_data[:-2])
+            video_names = batch_data[-1]
+
+            if grouped:
+                # all the models in one forward, (G, B, C) -> (B, C)
+                output = grouped_model(*select_grouped_inputs(inputs, grouped_index, scene_dim))
+                output_sum = metric_func(output).sum(dim=0)
+            else:
+                # one pass over the data, every model adds its softmax to the same sum
+                output_sum = None
+                for model, input_index in zip(models, input_indexes):
+                    output = metric_func(model(*select_multi_view_inputs(inputs, input_index, scene_dim)))
+                    if output_sum is None:
+                        output_sum = output
+                    else:
+                        output_sum.add_(output)
+
+            all_outputs.append(output_sum.cpu())
+            all_video_names += video_names
+
+    return torch.cat(all_outputs, dim=0), all_video_names
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from models.layer import GroupedMultiModalAttentionLayer, GroupedNanAttentionLayer, grouped_sequential
+from models.models import ArcSceneFeatModel, ArcFaceSceneModel
+
+__all__ = ['GroupedArcSceneFeatModel', 'GroupedArcFaceSceneModel', 'select_grouped_inputs', 'get_grouped_model', ]
+
+"""
+the grouped models stack the trained weights of several models with the same shape into one module,
+the inputs are stacked to (G, B, ...) and the outputs are (G, B, out_features), only for inference
+"""
+
+
+def _grouped_arc_weight(models):
+    return torch.stack([F.normalize(model.weight.detach()) for model in models], dim=0).transpose(1, 2).contiguous()
+
+
+class GroupedArcSceneFeatModel(nn.Module):
+    def __init__(self, models):
+        super(GroupedArcSceneFeatModel, self).__init__()
+        assert all(isinstance(model, ArcSceneFeatModel) for model in models)
+        self.num_group = len(models)
+        self.in_features = models[0].in_features
+        self.out_features = models[0].out_features
+
+        self.fc = grouped_sequential([model.fc for model in models])
+        self.register_buffer('weight', _grouped_arc_weight(models))
+
+    def forward(self, x):
+        output = self.fc(x)
+        output = x + output
+        output = torch.bmm(F.normalize(output, dim=-1), self.weight)
+
+        return output
+
+
+class GroupedArcFaceSceneModel(nn.Module):
+    def __init__(self, models):
+        super(GroupedArcFaceSceneModel, self).__init__()
+        assert all(isinstance(model, ArcFaceSceneModel) for model in models)
+        self.num_group = len(models)
+        self.face_dim = models[0].face_dim
+        self.scene_dim = models[0].scene_dim
+        self.out_features = models[0].out_features
+
+        self.mma_layer = GroupedMultiModalAttentionLayer([model.mma_layer for model in models])
+        self.nan_layer = GroupedNanAttentionLayer([model.nan_layer for model in models])
+
+        self.scene_fc = grouped_sequential([model.scene_fc for model in models])
+        self.final_fc = grouped_sequential([model.final_fc for model in models])
+        self.register_buffer('weight', _grouped_arc_weight(models))
+
+    def forward(self, feat1, feat2, ):
+        feat1 = self.mma_layer(feat1)
+        x_1 = self.nan_layer(feat1)
+        x_2 = self.scene_fc(feat2)
+
+        x = torch.cat([x_1, x_2], dim=-1)
+
+        output = self.final_fc(x)
+        output = x + output
+
+        output = torch.bmm(F.normalize(output, dim=-1), self.weight)
+
+        return output
+
+
+def _select_grouped_scene_feats(feats, index, scene_dim=2048):
+    num_group, index_dim = index.size()
+    feats = feats.view(feats.size(0), -1, scene_dim).index_select(-1, index.view(-1))
+    feats = feats.view(feats.size(0), -1, num_group, index_dim).permute(2, 0, 1, 3)
+    return feats.reshape(num_group, feats.size(1), -1)
+
+
+def select_grouped_inputs(inputs, grouped_index, scene_dim=2048):
+    """
+    gather the inputs of all the grouped models at once, every index is (G, D') and every output is (G, B, ...)
+    """
+    if len(inputs) == 2:
+        face_feats, scene_feats = inputs
+        face_index, scene_index = grouped_index
+        num_group, index_dim = face_index.size()
+        face_feats = face_feats.index_select(-1, face_index.view(-1))
+        face_feats = face_feats.view(face_feats.size(0), face_feats.size(1), num_group, index_dim).permute(2, 0, 1, 3)
+        return face_feats, _select_grouped_scene_feats(scene_feats, scene_index, scene_dim)
+
+    feats, = inputs
+    index, = grouped_index
+    return _select_grouped_scene_feats(feats, index, scene_dim),
+
+
+def get_grouped_model(model_type, models, input_indexes, device):
+    if model_type == 'face_scene':
+        grouped_model = GroupedArcFaceSceneModel(models)
+    else:
+        grouped_model = GroupedArcSceneFeatModel(models)
+    grouped_index = tuple(torch.tensor(index, dtype=torch.long, device=device) for index in zip(*input_indexes))
+    return grouped_model.to(device).eval(), grouped_index
@@ -7,3 +7,5 @@
 
 from .channel_attention_layer import *
 from .nan_attention_layer import *
+from .grouped_layer import *
+from .fused_layer import *
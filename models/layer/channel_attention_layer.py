@@ -9,6 +9,8 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
+from .fused_layer import fuse_sequential
+
 __all__ = ['MultiModalAttentionLayer']
 
 
@@ -57,6 +59,15 @@ class MultiModalAttentionLayer(nn.Module):
             self.W_phi = conv1x1(self.inplanes, self.planes)
             nn.init.constant_(self.W_phi.weight, .0)
 
+    def optimize_for_inference(self):
+        """
+        fold the BatchNorm1d of W_z, W_theta and W_phi into their convs, only for inference
+        """
+        for name in ['W_z', 'W_theta', 'W_phi']:
+            if isinstance(getattr(self, name), nn.Sequential):
+                setattr(self, name, fuse_sequential(getattr(self, name)))
+        return self.eval()
+
     def forward(self, x):
         # print(x.size())
 
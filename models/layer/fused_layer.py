@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import copy
+from collections import OrderedDict
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from ..se_resnext import Bottleneck
+
+__all__ = ['fuse_bn', 'fuse_sequential', 'FusedSEModule', 'FusedSEBottleneck']
+
+"""
+the fused layers fold the running stats of an eval BatchNorm into the Linear or Conv before it,
+they give the same outputs as the eval modules and only work for inference
+"""
+
+_FUSE_PAIRS = ((nn.Linear, nn.BatchNorm1d), (nn.Conv1d, nn.BatchNorm1d), (nn.Conv2d, nn.BatchNorm2d))
+
+
+def _can_fuse(module, bn):
+    return any(isinstance(module, module_type) and isinstance(bn, bn_type) for module_type, bn_type in _FUSE_PAIRS)
+
+
+def fuse_bn(module, bn):
+    """
+    a copy of the Linear or Conv module with bn folded in its weight and bias
+    """
+    assert _can_fuse(module, bn)
+    with torch.no_grad():
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        if bn.affine:
+            scale = bn.weight * scale
+        shift = -bn.running_mean * scale
+        if bn.affine:
+            shift = shift + bn.bias
+        bias = shift if module.bias is None else module.bias * scale + shift
+
+        # a copy instead of a new module, the init of a new one would take from the global random state
+        fused_module = copy.deepcopy(module)
+        fused_module.weight = nn.Parameter(module.weight * scale.view((-1,) + (1,) * (module.weight.dim() - 1)))
+        fused_module.bias = nn.Parameter(bias)
+
+    return fused_module.eval()
+
+
+def fuse_sequential(sequential):
+    """
+    fold every BatchNorm into the Linear or Conv before it, drop the Dropout and fuse the SE bottlenecks,
+    the names of the kept modules do not change
+    """
+    modules = OrderedDict()
+    last_name = None
+    for name, module in sequential.named_children():
+        if isinstance(module, nn.Dropout):
+            continue
+        if isinstance(module, nn.Sequential):
+            module = fuse_sequential(module)
+        elif isinstance(module, Bottleneck):
+            module = FusedSEBottleneck(module)
+        if last_name is not None and _can_fuse(modules[last_name], module):
+            modules[last_name] = fuse_bn(modules[last_name], module)
+            continue
+        modules[name] = module
+        last_name = name
+    return nn.Sequential(modules).eval()
+
+
+class FusedSEModule(nn.Module):
+    """
+    the squeeze and excitation of SEModule as two matmuls on the pooled (B, C) and its scaling fused with the
+    residual add of the bottleneck
+    """
+
+    def __init__(self, se_module):
+        super(FusedSEModule, self).__init__()
+        self.register_buffer('fc1_weight', se_module.fc1.weight.detach().flatten(1).clone())
+        self.register_buffer('fc1_bias', se_module.fc1.bias.detach().clone())
+        self.register_buffer('fc2_weight', se_module.fc2.weight.detach().flatten(1).clone())
+        self.register_buffer('fc2_bias', se_module.fc2.bias.detach().clone())
+
+    def forward(self, x, residual):
+        scale = torch.mean(x, dim=(2, 3))
+        scale = F.relu(F.linear(scale, self.fc1_weight, self.fc1_bias), inplace=True)
+        scale = torch.sigmoid(F.linear(scale, self.fc2_weight, self.fc2_bias))
+        return torch.addcmul(residual, x, scale.view(scale.size(0), scale.size(1), 1, 1))
+
+
+class FusedSEBottleneck(nn.Module):
+    """
+    an eval SE bottleneck with every BatchNorm2d folded into its conv and the SE module fused
+    """
+
+    def __init__(self, block):
+        super(FusedSEBottleneck, self).__init__()
+        self.conv1 = fuse_bn(block.conv1, block.bn1)
+        self.conv2 = fuse_bn(block.conv2, block.bn2)
+        self.conv3 = fuse_bn(block.conv3, block.bn3)
+        self.se_module = FusedSEModule(block.se_module)
+        self.downsample = fuse_sequential(block.downsample) if block.downsample is not None else None
+
+    def forward(self, x):
+        out = F.relu(self.conv1(x), inplace=True)
+        out = F.relu(self.conv2(out), inplace=True)
+        out = self.conv3(out)
+
+        residual = x if self.downsample is None else self.downsample(x)
+        out = self.se_module(out, residual)
+
+        return F.relu(out, inplace=True)
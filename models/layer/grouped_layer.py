@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from .channel_attention_layer import MultiModalAttentionLayer
+from .nan_attention_layer import NanAttentionLayer
+
+__all__ = ['GroupedLinear', 'GroupedConv1x1', 'GroupedBatchNorm', 'GroupedPReLU', 'GroupedMultiModalAttentionLayer',
+           'GroupedNanAttentionLayer', 'grouped_sequential']
+
+"""
+the grouped layers stack the weights of G layers with the same shape and run them as batched matmuls,
+every input and output gets a leading group dim G, they only work for inference
+"""
+
+
+def _stack(tensors):
+    return torch.stack([tensor.detach() for tensor in tensors], dim=0)
+
+
+class GroupedLinear(nn.Module):
+    def __init__(self, linears):
+        super(GroupedLinear, self).__init__()
+        # (G, in, out) for x (G, B, in) @ weight
+        self.register_buffer('weight', _stack([linear.weight for linear in linears]).transpose(1, 2).contiguous())
+        if linears[0].bias is not None:
+            self.register_buffer('bias', _stack([linear.bias for linear in linears]).unsqueeze(1))
+        else:
+            self.bias = None
+
+    def forward(self, x):
+        if self.bias is None:
+            return torch.bmm(x, self.weight)
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+class GroupedConv1x1(nn.Module):
+    def __init__(self, convs):
+        super(GroupedConv1x1, self).__init__()
+        assert all(conv.kernel_size == (1,) for conv in convs)
+        # (G, 1, out, in) for (G, B, in, L)
+        self.register_buffer('weight', _stack([conv.weight.squeeze(-1) for conv in convs]).unsqueeze(1))
+        if convs[0].bias is not None:
+            self.register_buffer('bias', _stack([conv.bias for conv in convs]).view(len(convs), 1, -1, 1))
+        else:
+            self.bias = None
+
+    def forward(self, x):
+        if self.bias is None:
+            return torch.matmul(self.weight, x)
+        return torch.matmul(self.weight, x) + self.bias
+
+
+class GroupedBatchNorm(nn.Module):
+    """
+    BatchNorm1d with its running stats as a per channel affine, the channel dim is 2 in (G, B, C) or (G, B, C, L)
+    """
+
+    def __init__(self, bns):
+        super(GroupedBatchNorm, self).__init__()
+        scales = []
+        shifts = []
+        for bn in bns:
+            scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+            scales.append(scale)
+            shifts.append(bn.bias.detach() - bn.running_mean * scale)
+        self.register_buffer('scale', _stack(scales))
+        self.register_buffer('shift', _stack(shifts))
+
+    def forward(self, x):
+        shape = (self.scale.size(0), 1, self.scale.size(1)) + (1,) * (x.dim() - 3)
+        return torch.addcmul(self.shift.view(shape), x, self.scale.view(shape))
+
+
+class GroupedPReLU(nn.Module):
+    def __init__(self, prelus):
+        super(GroupedPReLU, self).__init__()
+        self.register_buffer('weight', _stack([prelu.weight for prelu in prelus]))
+
+    def forward(self, x):
+        weight = self.weight.view((self.weight.size(0), 1, -1) + (1,) * (x.dim() - 3))
+        return torch.where(x >= 0, x, x * weight)
+
+
+def _grouped_module(modules):
+    module = modules[0]
+    if isinstance(module, nn.Linear):
+        return GroupedLinear(modules)
+    if isinstance(module, nn.Conv1d):
+        return GroupedConv1x1(modules)
+    if isinstance(module, nn.BatchNorm1d):
+        return GroupedBatchNorm(modules)
+    if isinstance(module, nn.PReLU):
+        return GroupedPReLU(modules)
+    if isinstance(module, nn.Dropout):
+        return None
+    if isinstance(module, nn.Sequential):
+        return grouped_sequential(modules)
+    raise NotImplementedError('no grouped layer for {}'.format(type(module).__name__))
+
+
+def grouped_sequential(sequentials):
+    grouped_modules = []
+    for modules in zip(*sequentials):
+        grouped_module = _grouped_module(list(modules))
+        if grouped_module is not None:
+            grouped_modules.append(grouped_module)
+    return nn.Sequential(*grouped_modules)
+
+
+class GroupedMultiModalAttentionLayer(nn.Module):
+    def __init__(self, layers):
+        super(GroupedMultiModalAttentionLayer, self).__init__()
+        assert all(isinstance(layer, MultiModalAttentionLayer) for layer in layers)
+
+        self.W_g = _grouped_module([layer.W_g for layer in layers])
+        self.W_z = _grouped_module([layer.W_z for layer in layers])
+        self.W_theta = _grouped_module([layer.W_theta for layer in layers])
+        self.W_phi = _grouped_module([layer.W_phi for layer in layers])
+
+    def forward(self, x):
+        # x -> (g, b, c, l)
+        g_x = self.W_g(x)
+        theta_x = self.W_theta(x)
+        phi_x = self.W_phi(x).transpose(-1, -2)
+
+        f_x = torch.matmul(theta_x, phi_x)
+        f_x = F.softmax(f_x, dim=-1)
+
+        y = torch.matmul(f_x, g_x)
+        y = self.W_z(y)
+
+        return y + x
+
+
+class GroupedNanAttentionLayer(nn.Module):
+    def __init__(self, layers):
+        super(GroupedNanAttentionLayer, self).__init__()
+        assert all(isinstance(layer, NanAttentionLayer) for layer in layers)
+
+        self.num_attn = layers[0].num_attn
+        # (G, 1, 1, D) for xs (G, B, D, E)
+        self.register_buffer('q', _stack([layer.q for layer in layers]))
+        self.fcs = nn.ModuleList([GroupedLinear([layer.fcs[i] for layer in layers]) for i in range(self.num_attn - 1)])
+
+    @staticmethod
+    def _attention(q, xs):
+        e = F.softmax(torch.matmul(q, xs), dim=-1)
+        return torch.sum(xs * e, dim=-1)
+
+    def forward(self, xs):
+        G, B, E, D = xs.shape
+        xs = xs.transpose(-1, -2)
+
+        r = self._attention(self.q, xs)
+
+        for i in range(self.num_attn - 1):
+            q = torch.tanh(self.fcs[i](r)).view(G, B, 1, D)
+            r = self._attention(q, xs)
+
+        return r
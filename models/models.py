@@ -10,7 +10,7 @@ import torch.nn.functional as F
 from torch import nn
 from torch.nn import Parameter
 
-from models.layer import MultiModalAttentionLayer, NanAttentionLayer
+from models.layer import MultiModalAttentionLayer, NanAttentionLayer, fuse_sequential
 from models.se_resnext import se_resnext50_32x4d
 
 __all__ = ['BaseModel', 'ArcFaceModel', 'ArcFaceSEResNeXtModel', 'ArcSceneFeatModel', 'ArcFaceSceneModel', ]
@@ -18,6 +18,23 @@ __all__ = ['BaseModel', 'ArcFaceModel', 'ArcFaceSEResNeXtModel', 'ArcSceneFeatMo
 SENEXT_PATH = './model_zoo/se_resnext50_32x4d-a260b3a4.pth'
 
 
+def _get_arc_weight(model):
+    if model.inference:
+        return model.weight
+    return F.normalize(model.weight)
+
+
+def _cache_arc_weight(model):
+    """
+    replace the weight by its normalized copy, so the eval forward does not normalize it again
+    """
+    if not model.inference:
+        weight = F.normalize(model.weight.detach())
+        del model.weight
+        model.register_buffer('weight', weight)
+        model.inference = True
+
+
 class BaseModel(nn.Module):
     def __init__(self, in_features, out_features):
         super(BaseModel, self).__init__()
@@ -64,14 +81,23 @@ class ArcFaceModel(nn.Module):
 
         self.weight = Parameter(torch.FloatTensor(self.out_features, self.in_features))
         nn.init.xavier_uniform_(self.weight)
+        self.inference = False
 
     def forward(self, x):
         output = self.fc(x)
         output = x + output
-        output = F.linear(F.normalize(output), F.normalize(self.weight))
+        output = F.linear(F.normalize(output), _get_arc_weight(self))
 
         return output
 
+    def optimize_for_inference(self):
+        """
+        cache the normalized weight, fold the BatchNorm1d into fc and drop the Dropout, only for inference
+        """
+        self.fc = fuse_sequential(self.fc)
+        _cache_arc_weight(self)
+        return self.eval()
+
 
 class ArcFaceSEResNeXtModel(nn.Module):
     def __init__(self, num_classes=1000, include_top=True):
@@ -97,6 +123,7 @@ class ArcFaceSEResNeXtModel(nn.Module):
 
         self.weight = Parameter(torch.FloatTensor(self.num_classes, 2048))
         nn.init.xavier_uniform_(self.weight)
+        self.inference = False
 
     def forward(self, x):
         output = self.base_model(x)
@@ -104,9 +131,20 @@ class ArcFaceSEResNeXtModel(nn.Module):
         output = output.view(output.size(0), -1)
 
         if self.include_top:
-            output = F.linear(F.normalize(output), F.normalize(self.weight))
+            output = F.linear(F.normalize(output), _get_arc_weight(self))
         return output
 
+    def optimize_for_inference(self, channels_last=False):
+        """
+        cache the normalized weight, fold every BatchNorm2d into its conv and fuse the SE modules,
+        channels_last keeps the conv weights in channels last memory format, only for inference
+        """
+        self.base_model = fuse_sequential(self.base_model)
+        _cache_arc_weight(self)
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+        return self.eval()
+
 
 class ArcSceneFeatModel(nn.Module):
     def __init__(self, in_features, out_features, ):
@@ -130,14 +168,23 @@ class ArcSceneFeatModel(nn.Module):
 
         self.weight = Parameter(torch.FloatTensor(self.out_features, self.in_features))
         nn.init.xavier_uniform_(self.weight)
+        self.inference = False
 
     def forward(self, x):
         output = self.fc(x)
         output = x + output
-        output = F.linear(F.normalize(output), F.normalize(self.weight))
+        output = F.linear(F.normalize(output), _get_arc_weight(self))
 
         return output
 
+    def optimize_for_inference(self):
+        """
+        cache the normalized weight, fold the BatchNorm1d into fc and drop the Dropout, only for inference
+        """
+        self.fc = fuse_sequential(self.fc)
+        _cache_arc_weight(self)
+        return self.eval()
+
 
 class ArcFaceSceneModel(nn.Module):
     def __init__(self, face_dim, scene_dim, out_features):
@@ -177,6 +224,7 @@ class ArcFaceSceneModel(nn.Module):
 
         self.weight = Parameter(torch.FloatTensor(self.out_features, self.face_dim + self.scene_dim // 16))
         nn.init.xavier_uniform_(self.weight)
+        self.inference = False
 
     def forward(self, feat1, feat2, ):
         feat1 = self.mma_layer(feat1)
@@ -188,6 +236,17 @@ class ArcFaceSceneModel(nn.Module):
         output = self.final_fc(x)
         output = x + output
 
-        output = F.linear(F.normalize(output), F.normalize(self.weight))
+        output = F.linear(F.normalize(output), _get_arc_weight(self))
 
         return output
+
+    def optimize_for_inference(self):
+        """
+        cache the normalized weight, fold the BatchNorm1d into the convs and fcs and drop the Dropout,
+        only for inference
+        """
+        self.mma_layer.optimize_for_inference()
+        self.scene_fc = fuse_sequential(self.scene_fc)
+        self.final_fc = fuse_sequential(self.final_fc)
+        _cache_arc_weight(self)
+        return self.eval()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import copy
+
+import torch
+
+__all__ = ['get_quantized_engine', 'prepare_quantized_model', 'convert_quantized_model', 'save_quantized_model',
+           'load_quantized_model']
+
+"""
+post training int8 quantization of an eval model with the fx graph mode of torch.ao.quantization,
+the conv + bn + relu are fused by the prepare step and the quantized model only runs on cpu
+"""
+
+QUANTIZED_ENGINES = ('x86', 'fbgemm', 'qnnpack')
+
+
+def get_quantized_engine(engine=None):
+    """
+    set the quantized engine, the first supported one of QUANTIZED_ENGINES when engine is None
+    """
+    supported_engines = torch.backends.quantized.supported_engines
+    if not engine:
+        engine = next((name for name in QUANTIZED_ENGINES if name in supported_engines), None)
+    if engine not in supported_engines:
+        raise RuntimeError('quantized engine {} is not in {}'.format(engine, supported_engines))
+    torch.backends.quantized.engine = engine
+    return engine
+
+
+def prepare_quantized_model(model, example_inputs, engine=None):
+    """
+    a copy of the model with observers, run the calibration data through it before convert_quantized_model
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx
+
+    engine = get_quantized_engine(engine)
+    model = copy.deepcopy(model).cpu().eval()
+    return prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs)
+
+
+def convert_quantized_model(prepared_model):
+    from torch.ao.quantization.quantize_fx import convert_fx
+
+    return convert_fx(prepared_model).eval()
+
+
+def save_quantized_model(model, save_path, example_inputs):
+    """
+    save the quantized model as torchscript with its engine, so loading it needs no model code
+    """
+    with torch.no_grad():
+        traced_model = torch.jit.trace(model, example_inputs)
+    torch.jit.save(traced_model, save_path, _extra_files={'engine': torch.backends.quantized.engine})
+    return save_path
+
+
+def load_quantized_model(load_path):
+    extra_files = {'engine': ''}
+    model = torch.jit.load(load_path, map_location='cpu', _extra_files=extra_files)
+    engine = extra_files['engine']
+    get_quantized_engine(engine.decode() if isinstance(engine, bytes) else engine)
+    return model.eval()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import copy
+
+import os
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from models import ArcSceneFeatModel, ArcFaceSceneModel, GroupedArcSceneFeatModel, GroupedArcFaceSceneModel, \
+    select_grouped_inputs, prepare_quantized_model, convert_quantized_model, save_quantized_model, \
+    load_quantized_model
+from models.layer import fuse_sequential
+from models.se_resnext import se_resnext50_32x4d
+from utils import get_mask_index, select_multi_view_inputs
+
+"""
+the folded BatchNorm, the int8 models and the grouped models against the eval models they are built from
+"""
+
+
+def _randomize(model, seed):
+    """
+    random weights and running stats, the init of the models zeros some of them
+    """
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for param in model.parameters():
+            param.copy_(torch.randn(param.size(), generator=generator) * .1)
+        for module in model.modules():
+            if isinstance(module, nn.modules.batchnorm._BatchNorm):
+                module.running_mean.copy_(torch.randn(module.running_mean.size(), generator=generator) * .1)
+                module.running_var.copy_(torch.rand(module.running_var.size(), generator=generator) + .5)
+    return model.eval()
+
+
+def test_fuse_sequential_se_resnext():
+    se_resnext = se_resnext50_32x4d(num_classes=1000)
+    model = _randomize(nn.Sequential(se_resnext.layer0, se_resnext.layer1), 0)
+    fused_model = fuse_sequential(copy.deepcopy(model))
+    inputs = torch.randn(2, 3, 64, 64, generator=torch.Generator().manual_seed(1))
+
+    with torch.no_grad():
+        assert torch.allclose(fused_model(inputs), model(inputs), rtol=1e-4, atol=1e-4)
+    assert not any(isinstance(module, nn.BatchNorm2d) for module in fused_model.modules())
+
+
+def test_optimize_for_inference():
+    generator = torch.Generator().manual_seed(2)
+    scene_model = _randomize(ArcSceneFeatModel(64, 10), 3)
+    face_scene_model = _randomize(ArcFaceSceneModel(32, 64, 10), 4)
+    scene_feats = torch.randn(5, 64, generator=generator)
+    face_feats = torch.randn(5, 40, 32, generator=generator)
+
+    with torch.no_grad():
+        assert torch.allclose(copy.deepcopy(scene_model).optimize_for_inference()(scene_feats),
+                              scene_model(scene_feats), atol=1e-5)
+        assert torch.allclose(copy.deepcopy(face_scene_model).optimize_for_inference()(face_feats, scene_feats),
+                              face_scene_model(face_feats, scene_feats), atol=1e-5)
+
+
+def test_quantized_model(tmpdir):
+    se_resnext = se_resnext50_32x4d(num_classes=1000)
+    model = _randomize(nn.Sequential(se_resnext.layer0, se_resnext.layer1, nn.AdaptiveAvgPool2d(1), nn.Flatten()), 8)
+    generator = torch.Generator().manual_seed(9)
+    calib_inputs = [torch.randn(4, 3, 64, 64, generator=generator) for _ in range(4)]
+    inputs = torch.randn(8, 3, 64, 64, generator=generator)
+
+    prepared_model = prepare_quantized_model(model, (calib_inputs[0], ))
+    with torch.no_grad():
+        for calib_input in calib_inputs:
+            prepared_model(calib_input)
+    quantized_model = convert_quantized_model(prepared_model)
+    save_path = save_quantized_model(quantized_model, os.path.join(str(tmpdir), 'model_int8.pt'), (inputs, ))
+    loaded_model = load_quantized_model(save_path)
+
+    with torch.no_grad():
+        outputs = model(inputs)
+        quantized_outputs = quantized_model(inputs)
+        assert torch.equal(loaded_model(inputs), quantized_outputs)
+    # the eval model it is quantized from stays as it is
+    assert any(isinstance(module, nn.BatchNorm2d) for module in model.modules())
+    assert F.cosine_similarity(quantized_outputs, outputs, dim=-1).min().item() > .98
+
+
+def test_grouped_scene_feat_model():
+    models = [_randomize(ArcSceneFeatModel(64, 10), seed) for seed in range(3)]
+    scene_feats = torch.randn(3, 5, 64, generator=torch.Generator().manual_seed(5))
+
+    with torch.no_grad():
+        outputs = GroupedArcSceneFeatModel(models).eval()(scene_feats)
+        for group_idx, model in enumerate(models):
+            assert torch.allclose(outputs[group_idx], model(scene_feats[group_idx]), atol=1e-5)
+
+
+def test_grouped_face_scene_model():
+    models = [_randomize(ArcFaceSceneModel(32, 64, 10), seed) for seed in range(3)]
+    generator = torch.Generator().manual_seed(6)
+    face_feats = torch.randn(3, 5, 40, 32, generator=generator)
+    scene_feats = torch.randn(3, 5, 64, generator=generator)
+
+    with torch.no_grad():
+        outputs = GroupedArcFaceSceneModel(models).eval()(face_feats, scene_feats)
+        for group_idx, model in enumerate(models):
+            assert torch.allclose(outputs[group_idx], model(face_feats[group_idx], scene_feats[group_idx]),
+                                  atol=1e-5)
+
+
+def test_select_grouped_inputs():
+    generator = torch.Generator().manual_seed(7)
+    face_feats = torch.randn(5, 40, 32 + 2, generator=generator)
+    scene_feats = torch.randn(5, 2 * 64, generator=generator)
+    input_indexes = [(torch.tensor(get_mask_index(seed, 32, 4) + [32, 33]), torch.tensor(get_mask_index(seed, 64, 8)))
+                     for seed in range(3)]
+    grouped_index = tuple(torch.stack(index) for index in zip(*input_indexes))
+
+    grouped_face_feats, grouped_scene_feats = select_grouped_inputs((face_feats, scene_feats), grouped_index, 64)
+    grouped_feats, = select_grouped_inputs((scene_feats, ), grouped_index[1:], 64)
+    for group_idx, input_index in enumerate(input_indexes):
+        model_face_feats, model_scene_feats = select_multi_view_inputs((face_feats, scene_feats), input_index, 64)
+        assert torch.equal(grouped_face_feats[group_idx], model_face_feats)
+        assert torch.equal(grouped_scene_feats[group_idx], model_scene_feats)
+        assert torch.equal(grouped_feats[group_idx], select_multi_view_inputs((scene_feats, ), input_index[1:], 64)[0])
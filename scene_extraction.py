@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import bisect
+import hashlib
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Subset
+
+from models import ArcFaceSEResNeXtModel, load_quantized_model
+from utils import check_exists, get_files_fingerprint, load_scene_store, open_partial_scene_store, \
+    save_scene_progress, get_image_stamps, get_reused_frames
+
+__all__ = ['load_extract_model', 'get_traced_model', 'get_extract_infos', 'get_extract_fingerprint', 'get_video_ends',
+           'get_extract_indexes', 'extract_partial_store', 'get_cosine_report', ]
+
+logger = logging.getLogger(__name__)
+
+"""
+the fine tune model that extracts the scene feats of the frames, or its int8 model, shared by the extraction demos
+"""
+
+EXTRACT_MODEL_PATH = './checkpoints/demo_arcface_fine_tune_model_{:0>4d}.pth'
+INT8_MODEL_PATH = './checkpoints/demo_arcface_fine_tune_model_{:0>4d}_int8.pt'
+COSINE_QUANTILES = (0.01, 0.05, 0.5)
+
+
+def load_extract_model(epoch, num_classes=10035, int8=False, optimize=False, channels_last=False, eval_mode=False):
+    """
+    the fine tune model in train mode like the scene feats extracted before, eval_mode or optimize (the BatchNorm2d
+    folded into the convs and the SE modules fused) make the BatchNorm2d use their running stats,
+    int8 loads the eval model quantized by demo_quantize_scene.py instead
+    """
+    if int8:
+        # it is traced already and only runs on cpu
+        int8_path = INT8_MODEL_PATH.format(epoch)
+        assert check_exists(int8_path)
+        logger.info('load int8 model from {}'.format(int8_path))
+        return load_quantized_model(int8_path)
+
+    load_path = EXTRACT_MODEL_PATH.format(epoch)
+    assert check_exists(load_path)
+
+    model = ArcFaceSEResNeXtModel(num_classes, include_top=False)
+    state_dict = torch.load(load_path, map_location='cpu')
+    model.load_state_dict(state_dict)
+    if optimize:
+        model.optimize_for_inference(channels_last=channels_last)
+        logger.info('optimize the model for inference, channels last: {}'.format(channels_last))
+    elif eval_mode:
+        model.eval()
+    return model
+
+
+def get_traced_model(model, image_data):
+    """
+    trace the optimized model with the first batch, and freeze it when the torch version can
+    """
+    traced_model = torch.jit.trace(model, image_data)
+    if hasattr(torch.jit, 'freeze'):
+        traced_model = torch.jit.freeze(traced_model)
+    return traced_model
+
+
+def get_extract_infos(epoch, int8=False, optimize=False, draft=False, eval_mode=False):
+    """
+    the model file and the options of an extraction, saved in the scene store it writes
+    """
+    model_path = INT8_MODEL_PATH.format(epoch) if int8 else EXTRACT_MODEL_PATH.format(epoch)
+    return {'model': get_files_fingerprint([model_path]), 'int8': bool(int8), 'optimize': bool(optimize),
+            'draft': bool(draft), 'eval': bool(eval_mode or int8 or optimize)}
+
+
+def get_extract_fingerprint(dataset, image_stamps, extract_indexes, extract_infos):
+    """
+    the extract infos and the frames of an extraction, a partial store is only resumed by the same extraction
+    """
+    md5 = hashlib.md5()
+    md5.update(json.dumps(extract_infos, sort_keys=True).encode())
+    for image_idx in extract_indexes:
+        md5.update('{}\t{}\t{}\t{}\n'.format(dataset.image_paths[image_idx], dataset.image_indexes[image_idx],
+                                             *image_stamps[image_idx]).encode())
+    return md5.hexdigest()
+
+
+def get_video_ends(video_names):
+    return [idx + 1 for idx in range(len(video_names))
+            if idx + 1 == len(video_names) or video_names[idx + 1] != video_names[idx]]
+
+
+def get_extract_indexes(dataset, store_root, extract_infos, incremental=False):
+    """
+    the stamps of all the frames, the scene store before (incremental only) and the indexes of the frames to extract,
+    the frames of the scene store are only reused when it was extracted with the same extract infos
+    """
+    image_stamps = get_image_stamps(dataset.image_paths)
+    scene_store = None
+    if incremental and os.path.isdir(store_root):
+        # only the new frames and the frames with another size or mtime are extracted again
+        scene_store = load_scene_store(store_root)
+        if scene_store['extract_infos'] != extract_infos:
+            # the feats of another model or other options never go into the same store, all of them are replaced
+            logger.warning('scene store {} is of another extraction, extract all the frames again'.format(store_root))
+            scene_store = None
+        elif scene_store['image_stamps'] is None:
+            logger.warning('scene store {} has no image stamps, extract all the frames again'.format(store_root))
+        elif not extract_infos['eval']:
+            # the batch stats of the train mode model, the new frames are not batched like in a full extraction
+            logger.warning('the feats of the train mode model depend on the batches, the frames extracted again '
+                           'differ from a full extraction of {}'.format(store_root))
+    extract_indexes = np.flatnonzero(get_reused_frames(scene_store, dataset.video_names, dataset.image_indexes,
+                                                       image_stamps) < 0)
+    logger.info('extract {} frames of {}'.format(len(extract_indexes), len(dataset)))
+    return image_stamps, scene_store, extract_indexes
+
+
+def extract_partial_store(model, dataset, store_root, extract_indexes, fingerprint, device, feat_dim=2048,
+                          batch_size=512, num_workers=4, checkpoint_step=10, trace=False, channels_last=False):
+    """
+    extract the frames of extract_indexes into the partial store of store_root and return its feats,
+    the feats go to the partial store batch by batch and a rerun goes on from the last video done,
+    with trace the model is traced with the first batch
+    """
+    all_scene_feat, done = open_partial_scene_store(store_root, len(extract_indexes), feat_dim, fingerprint)
+    video_ends = get_video_ends([dataset.video_names[image_idx] for image_idx in extract_indexes])
+
+    data_loader = DataLoader(Subset(dataset, extract_indexes[done:].tolist()), batch_size=batch_size,
+                             shuffle=False, num_workers=num_workers, pin_memory=device.type == 'cuda')
+
+    log_step = len(data_loader) // 100 if len(data_loader) > 100 else 1
+    logger.info('extract scene feat on {}'.format(device))
+
+    model = model.to(device)
+
+    row = done
+    start = time.time()
+    with torch.no_grad():
+        for batch_idx, (image_data, _, _) in enumerate(data_loader):
+            image_data = image_data.to(device)
+            if channels_last:
+                image_data = image_data.contiguous(memory_format=torch.channels_last)
+
+            if trace and batch_idx == 0:
+                model = get_traced_model(model, image_data)
+            outputs = model(image_data)
+
+            all_scene_feat[row:row + len(outputs)] = outputs.cpu().numpy()
+            row += len(outputs)
+
+            if batch_idx % checkpoint_step == 0:
+                # only the videos with all their frames extracted are done
+                video_num = bisect.bisect_right(video_ends, row)
+                save_scene_progress(store_root, all_scene_feat, video_ends[video_num - 1] if video_num > 0 else 0,
+                                    fingerprint)
+
+            if batch_idx % log_step == 0:
+                end = time.time()
+                log_info = '[{}/{} ({:.0f}%)] Time: {}' \
+                    .format(row, len(all_scene_feat), 100.0 * row / len(all_scene_feat), (end - start))
+                logger.info(log_info)
+                print(log_info)
+                start = time.time()
+
+    save_scene_progress(store_root, all_scene_feat, row, fingerprint)
+    return all_scene_feat
+
+
+def get_cosine_report(feats, ref_feats):
+    """
+    the cosine similarity of every feat to its reference feat, its mean, min and quantiles
+    """
+    cosines = F.cosine_similarity(torch.as_tensor(feats).float(), torch.as_tensor(ref_feats).float(), dim=-1)
+    report = {'num': cosines.numel(), 'mean': cosines.mean().item(), 'min': cosines.min().item()}
+    for quantile in COSINE_QUANTILES:
+        report['p{:g}'.format(quantile * 100)] = torch.quantile(cosines.double(), quantile).item()
+    return report
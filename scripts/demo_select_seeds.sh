@@ -0,0 +1,3 @@
+#!/usr/bin/env bash
+python -u demo_select_seeds.py --model_type face_scene --seeds 0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15 --device 0 --grouped
+python -u demo_select_seeds.py --model_type scene --seeds 0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15 --device 0 --grouped
@@ -1,29 +1,6 @@
 #!/usr/bin/env bash
+python -u demo_convert_face_store.py --tvt test
 python -u demo_extract_scene.py --tvt test
-python -u demo_test_face_scene_multi_view.py --seed 0 --device 0
-python -u demo_test_face_scene_multi_view.py --seed 1 --device 0
-python -u demo_test_face_scene_multi_view.py --seed 2 --device 0
-python -u demo_test_face_scene_multi_view.py --seed 4 --device 0
-python -u demo_test_face_scene_multi_view.py --seed 5 --device 0
-python -u demo_test_face_scene_multi_view.py --seed 6 --device 0
-python -u merge_multi_files.py --merge_type face_scene
-python -u demo_test_face_scene_multi_view.py --seed 8 --device 0
-python -u demo_test_face_scene_multi_view.py --seed 9 --device 0
-python -u demo_test_face_scene_multi_view.py --seed 10 --device 0
-python -u demo_test_face_scene_multi_view.py --seed 12 --device 0
-python -u demo_test_face_scene_multi_view.py --seed 15 --device 0
-python -u merge_multi_files.py --merge_type face_scene
-python -u demo_test_scene_multi_view.py --seed 1 --device 0
-python -u demo_test_scene_multi_view.py --seed 2 --device 0
-python -u demo_test_scene_multi_view.py --seed 3 --device 0
-python -u demo_test_scene_multi_view.py --seed 4 --device 0
-python -u demo_test_scene_multi_view.py --seed 6 --device 0
-python -u merge_multi_files.py --merge_type scene
-python -u demo_test_scene_multi_view.py --seed 8 --device 0
-python -u demo_test_scene_multi_view.py --seed 10 --device 0
-python -u demo_test_scene_multi_view.py --seed 11 --device 0
-python -u demo_test_scene_multi_view.py --seed 12 --device 0
-python -u demo_test_scene_multi_view.py --seed 14 --device 0
-python -u demo_test_scene_multi_view.py --seed 15 --device 0
-python -u merge_multi_files.py --merge_type scene
+python -u demo_test_multi_view_ensemble.py --model_type face_scene --seeds 0,1,2,4,5,6,8,9,10,12,15 --device 0 --grouped
+python -u demo_test_multi_view_ensemble.py --model_type scene --seeds 1,2,3,4,6,8,10,11,12,14,15 --device 0 --grouped
 python -u main.py
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+
+import pytest
+
+from evaluation_map import calculate_map, evaluate_map
+
+"""
+evaluate_map against the loop of the first calculate_map, on random rankings with repeats and missing classes
+"""
+
+
+def _loop_calculate_map(gt_path, my_path):
+    id2videos = dict()
+    with open(gt_path, 'r') as fin:
+        lines = fin.readlines()
+        for line in lines:
+            terms = line.strip().split(' ')
+            id2videos[terms[0]] = terms[1:]
+    id_num = len(lines)
+
+    my_id2videos = dict()
+    with open(my_path, 'r') as fin:
+        lines = fin.readlines()
+        assert (len(lines) <= id_num)
+        for line in lines:
+            terms = line.strip().split(' ')
+            tmp_list = []
+            for video in terms[1:]:
+                if video not in tmp_list:
+                    tmp_list.append(video)
+            my_id2videos[terms[0]] = tmp_list
+
+    ap_total = 0.
+    for cid in id2videos:
+        videos = id2videos[cid]
+        if cid not in my_id2videos:
+            continue
+        my_videos = my_id2videos[cid]
+        assert (len(my_videos) <= 100)
+        ap = 0.
+        ind = 0.
+        for ind_video, my_video in enumerate(my_videos):
+            if my_video in videos:
+                ind += 1
+                ap += ind / (ind_video + 1)
+        ap_total += ap / len(videos)
+
+    return ap_total / id_num
+
+
+def _write_rankings(file_path, id2videos):
+    with open(file_path, 'w') as fout:
+        for cid, videos in id2videos.items():
+            fout.write('{} {}\n'.format(cid, ' '.join(videos)))
+    return file_path
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_calculate_map(tmpdir, seed):
+    rand = random.Random(seed)
+    videos = ['IQIYI_VID_VAL_{:0>7d}.mp4'.format(idx) for idx in range(300)]
+    gt_id2videos = {str(cid): rand.sample(videos, rand.randint(1, 20)) for cid in range(1, 41)}
+    # some classes are not predicted, some predictions are repeated or not in the gt
+    my_id2videos = {cid: [rand.choice(gt_videos + videos[:30]) for _ in range(rand.randint(0, 100))]
+                    for cid, gt_videos in gt_id2videos.items() if rand.random() < .9}
+
+    gt_path = _write_rankings(os.path.join(str(tmpdir), 'gt.txt'), gt_id2videos)
+    my_path = _write_rankings(os.path.join(str(tmpdir), 'result.txt'), my_id2videos)
+
+    assert calculate_map(gt_path, my_path) == pytest.approx(_loop_calculate_map(gt_path, my_path), abs=1e-12)
+
+
+def test_evaluate_map_empty_class():
+    gt_id2videos = {'1': ['a.mp4', 'b.mp4'], '2': [], '3': ['c.mp4']}
+    my_id2videos = {'1': ['b.mp4', 'x.mp4', 'a.mp4'], '2': ['a.mp4'], '3': ['c.mp4']}
+
+    mean_ap, class_aps, class_num = evaluate_map(gt_id2videos, my_id2videos, per_class=True)
+    assert class_num == 2 and sorted(class_aps) == ['1', '3']
+    assert mean_ap == pytest.approx(((1. + 2. / 3.) / 2. + 1.) / 3.)
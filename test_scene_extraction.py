@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+from demo_extract_scene_sharded import get_shard_indexes, merge_shards, main as sharded_main, SHARD_STORE_SUFFIX
+from scene_extraction import get_cosine_report, get_extract_fingerprint, get_extract_indexes, extract_partial_store
+from utils import get_image_stamps, close_partial_scene_store, load_scene_store
+
+"""
+the extraction of the scene feats shared by the demos, with stand-in datasets and models
+"""
+
+FEAT_DIM = 8
+NUM_FRAME = 3
+
+
+class _FrameDataset(object):
+    """
+    a stand-in of IQiYiExtractSceneDataset, every frame is a file holding the value its feat is made of
+    """
+
+    def __init__(self):
+        self.video_names = []
+        self.image_indexes = []
+        self.image_paths = []
+
+    def __getitem__(self, index):
+        return torch.tensor([_get_value(self.image_paths[index])], dtype=torch.float32), 0, self.video_names[index]
+
+    def __len__(self):
+        return len(self.image_paths)
+
+
+class _FrameModel(nn.Module):
+    """
+    a stand-in of the extract model, every feat is the value of the frame plus a ramp, it fails at batch crash_batch
+    """
+
+    def __init__(self, crash_batch=-1):
+        super(_FrameModel, self).__init__()
+        self.crash_batch = crash_batch
+        self.values = []
+
+    def forward(self, x):
+        if len(self.values) == self.crash_batch:
+            raise KeyboardInterrupt
+        self.values.append(x[:, 0].tolist())
+        return x + torch.arange(FEAT_DIM, dtype=torch.float32)[None, :] / 4.
+
+
+def _make_dataset(image_root, video_values):
+    dataset = _FrameDataset()
+    for video_name, values in video_values:
+        for image_index, value in enumerate(values):
+            image_path = os.path.join(image_root, '{}_{}.txt'.format(video_name, image_index))
+            if not os.path.exists(image_path) or _get_value(image_path) != value:
+                with open(image_path, 'w') as fout:
+                    fout.write(str(value))
+            dataset.video_names.append(video_name)
+            dataset.image_indexes.append(image_index)
+            dataset.image_paths.append(image_path)
+    return dataset
+
+
+def _get_value(image_path):
+    with open(image_path, 'r') as fin:
+        return int(fin.read())
+
+
+def _check_store(store_root, video_values):
+    scene_store = load_scene_store(store_root)
+    assert scene_store['video_names'].tolist() == [video_name for video_name, _ in video_values]
+    assert scene_store['image_indexes'].tolist() == [list(range(NUM_FRAME))] * len(video_values)
+    values = np.array([values for _, values in video_values], dtype=np.float32)
+    expected_feats = values[:, :, None] + np.arange(FEAT_DIM, dtype=np.float32)[None, None, :] / 4.
+    assert np.array_equal(np.asarray(scene_store['feat'], dtype=np.float32), expected_feats)
+
+
+def _extract(dataset, store_root, extract_infos, incremental=False, num_shards=0):
+    """
+    the steps of demo_extract_scene.py, or of demo_extract_scene_sharded.py with num_shards, with _FrameModel as model,
+    the indexes of the frames extracted
+    """
+    image_stamps, scene_store, extract_indexes = get_extract_indexes(dataset, store_root, extract_infos, incremental)
+
+    if num_shards > 0:
+        all_shard_indexes = get_shard_indexes(extract_indexes, dataset.video_names, num_shards)
+        assert np.array_equal(np.concatenate(all_shard_indexes), extract_indexes)
+        for shard_idx, shard_indexes in enumerate(all_shard_indexes):
+            shard_root = store_root + SHARD_STORE_SUFFIX.format(shard_idx)
+            fingerprint = get_extract_fingerprint(dataset, image_stamps, shard_indexes, extract_infos)
+            extract_partial_store(_FrameModel(), dataset, shard_root, shard_indexes, fingerprint, torch.device('cpu'),
+                                  feat_dim=FEAT_DIM, batch_size=2, num_workers=0)
+        merge_shards(argparse.Namespace(feat_dim=FEAT_DIM), dataset, store_root, image_stamps, scene_store,
+                     extract_indexes, extract_infos, all_shard_indexes)
+    else:
+        fingerprint = get_extract_fingerprint(dataset, image_stamps, extract_indexes, extract_infos)
+        feats = extract_partial_store(_FrameModel(), dataset, store_root, extract_indexes, fingerprint,
+                                      torch.device('cpu'), feat_dim=FEAT_DIM, batch_size=2, num_workers=0)
+        close_partial_scene_store(store_root, feats, dataset.video_names, dataset.image_indexes, image_stamps,
+                                  scene_store, extract_infos)
+    return extract_indexes.tolist()
+
+
+def test_resume_extract(tmpdir):
+    image_root = str(tmpdir.mkdir('img'))
+    store_root = os.path.join(str(tmpdir), 'scene_infos_val_store')
+    video_values = [('v0', [1, 2, 3]), ('v1', [4, 5, 6]), ('v2', [7, 8, 9]), ('v3', [10, 11, 12])]
+    dataset = _make_dataset(image_root, video_values)
+    image_stamps = get_image_stamps(dataset.image_paths)
+    extract_indexes = np.arange(len(dataset))
+    extract_infos = {'model': {'model.pth': {'size': 1, 'mtime': 1}}, 'int8': False, 'optimize': False,
+                     'draft': False, 'eval': True}
+    fingerprint = get_extract_fingerprint(dataset, image_stamps, extract_indexes, extract_infos)
+
+    def extract(model, fingerprint):
+        return extract_partial_store(model, dataset, store_root, extract_indexes, fingerprint, torch.device('cpu'),
+                                     feat_dim=FEAT_DIM, batch_size=2, num_workers=0, checkpoint_step=1)
+
+    # the crash in the fourth batch: the frames of v0 and v1 are done, the first frame of v2 is not
+    with pytest.raises(KeyboardInterrupt):
+        extract(_FrameModel(crash_batch=3), fingerprint)
+    with open(os.path.join(store_root + '.partial', 'progress.json'), 'r') as fin:
+        progress = json.load(fin)
+    assert progress == {'done': 6, 'num_image': 12, 'fingerprint': fingerprint}
+
+    # the rerun goes on from the last video done
+    model = _FrameModel()
+    feats = extract(model, fingerprint)
+    assert model.values == [[7., 8.], [9., 10.], [11., 12.]]
+    close_partial_scene_store(store_root, feats, dataset.video_names, dataset.image_indexes, image_stamps)
+    _check_store(store_root, video_values)
+    assert not os.path.exists(store_root + '.partial')
+
+    # the partial store of another extraction is started over
+    with pytest.raises(KeyboardInterrupt):
+        extract(_FrameModel(crash_batch=3), fingerprint)
+    other_fingerprint = get_extract_fingerprint(dataset, image_stamps, extract_indexes,
+                                                dict(extract_infos, optimize=True))
+    model = _FrameModel()
+    feats = extract(model, other_fingerprint)
+    assert sum(model.values, []) == [float(value) for _, values in video_values for value in values]
+    close_partial_scene_store(store_root, feats, dataset.video_names, dataset.image_indexes, image_stamps)
+    _check_store(store_root, video_values)
+
+
+@pytest.mark.parametrize('num_shards', [0, 1, 2, 3])
+def test_incremental_extract(tmpdir, num_shards):
+    image_root = str(tmpdir.mkdir('img'))
+    store_root = os.path.join(str(tmpdir), 'scene_infos_val_store')
+    extract_infos = {'model': {'model.pth': {'size': 1, 'mtime': 1}}, 'int8': False, 'optimize': False,
+                     'draft': False, 'eval': True}
+
+    video_values = [('v0', [1, 2, 3]), ('v1', [4, 5, 6]), ('v2', [7, 8, 9])]
+    assert _extract(_make_dataset(image_root, video_values), store_root, extract_infos, True,
+                    num_shards) == list(range(9))
+    _check_store(store_root, video_values)
+    assert load_scene_store(store_root)['extract_infos'] == extract_infos
+
+    # a changed frame of v1, a new video v3 and v0 no longer listed: v0 is kept after the listed videos
+    video_values = [('v1', [4, 50, 6]), ('v2', [7, 8, 9]), ('v3', [10, 11, 12])]
+    assert _extract(_make_dataset(image_root, video_values), store_root, extract_infos, True,
+                    num_shards) == [1, 6, 7, 8]
+    _check_store(store_root, video_values + [('v0', [1, 2, 3])])
+
+    # without incremental every frame is extracted again and only the listed videos are kept
+    assert _extract(_make_dataset(image_root, video_values), store_root, extract_infos, False,
+                    num_shards) == list(range(9))
+    _check_store(store_root, video_values)
+
+    # another extraction never reuses the frames, the store only keeps the listed videos
+    video_values = [('v1', [4, 50, 6]), ('v2', [7, 8, 9])]
+    optimize_infos = dict(extract_infos, optimize=True)
+    assert _extract(_make_dataset(image_root, video_values), store_root, optimize_infos, True,
+                    num_shards) == list(range(6))
+    _check_store(store_root, video_values)
+    assert load_scene_store(store_root)['extract_infos'] == optimize_infos
+    assert not os.path.exists(store_root + '.partial')
+    assert not any(os.path.exists(store_root + SHARD_STORE_SUFFIX.format(shard_idx) + '.partial')
+                   for shard_idx in range(num_shards))
+
+
+def test_incremental_extract_train_mode(tmpdir, caplog):
+    image_root = str(tmpdir.mkdir('img'))
+    store_root = os.path.join(str(tmpdir), 'scene_infos_val_store')
+    extract_infos = {'model': {'model.pth': {'size': 1, 'mtime': 1}}, 'int8': False, 'optimize': False,
+                     'draft': False, 'eval': False}
+
+    video_values = [('v0', [1, 2, 3]), ('v1', [4, 5, 6])]
+    _extract(_make_dataset(image_root, video_values), store_root, extract_infos, True)
+    assert not any('train mode' in record.getMessage() for record in caplog.records)
+
+    # the frames are still reused, but the feats of the train mode model depend on the batches
+    video_values = [('v0', [1, 2, 3]), ('v1', [4, 5, 60])]
+    assert _extract(_make_dataset(image_root, video_values), store_root, extract_infos, True) == [5]
+    assert any('train mode' in record.getMessage() for record in caplog.records)
+    _check_store(store_root, video_values)
+
+
+def test_sharded_train_mode():
+    # the batch stats of the train mode model depend on the shards, it is refused before any shard starts
+    with pytest.raises(RuntimeError):
+        sharded_main(argparse.Namespace(eval=False, optimize=False, int8=False))
+
+
+def test_get_cosine_report():
+    rng = np.random.RandomState(0)
+    ref_feats = rng.randn(200, 16).astype(np.float32)
+    feats = ref_feats + rng.randn(200, 16).astype(np.float32) * .3
+
+    cosines = (feats * ref_feats).sum(axis=1) / np.linalg.norm(feats, axis=1) / np.linalg.norm(ref_feats, axis=1)
+    report = get_cosine_report(feats, ref_feats)
+    assert report['num'] == 200
+    assert report['mean'] == pytest.approx(cosines.mean(), abs=1e-5)
+    assert report['min'] == pytest.approx(cosines.min(), abs=1e-5)
+    for key, quantile in [('p1', .01), ('p5', .05), ('p50', .5)]:
+        assert report[key] == pytest.approx(np.quantile(cosines, quantile), abs=1e-5)
+    assert get_cosine_report(ref_feats, ref_feats)['min'] == pytest.approx(1., abs=1e-5)
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import random
+
+import numpy as np
+import pytest
+import torch
+
+import utils
+from utils import load_face_from_pickle, convert_face_pickle_to_store, load_face_from_store, FACE_STORE_COLUMNS, \
+    get_mask_index, get_mask_slices, select_feats_by_mask, share_pack_memory, get_pack_arrays, \
+    write_scene_store, convert_scene_pickle_to_store, load_scene_store, load_scene_infos, get_scene_store_root, \
+    SCENE_STORE_DTYPE, load_or_build_pack, evict_pack_caches, write_result_store, load_result_store, \
+    find_result_stores, merge_result_stores, STORE_SUFFIX, merge_class_topk, build_face_stats, load_face_stats, \
+    get_face_stats_path, split_name_by_l2norm, load_image_manifest
+
+"""
+the stores, packs and caches of utils against the baseline pickle loading and the per video code they replace
+"""
+
+
+def _write_face_pickle(file_path, seed, num_video=6, feat_dim=512):
+    """
+    a face pickle like the ones of the materials: video names in bytes, every face a list of
+    frame, bbox, det score, quality score and float16 feat, some videos without any face
+    """
+    rand = random.Random(seed)
+    rng = np.random.RandomState(seed)
+    face_feats_dict = {}
+    for video_idx in range(num_video):
+        face_feats = []
+        frame_num = 0
+        for _ in range(rand.choice([0, 1, 3, 7])):
+            frame_num += rand.randint(0, 2)
+            x1, y1 = rand.randint(0, 50), rand.randint(0, 50)
+            # scores of a few bits, the same in float32 and float64
+            face_feats.append(['{}'.format(frame_num), [float(x1), float(y1), float(x1 + 20), float(y1 + 30)],
+                               rand.randint(0, 64) / 64., rand.randint(0, 64 * 200) / 64.,
+                               rng.randn(feat_dim).astype(np.float16)])
+        face_feats_dict['IQIYI_VID_VAL_{:0>7d}'.format(video_idx).encode('utf-8')] = face_feats
+    with open(file_path, 'wb') as fout:
+        pickle.dump(face_feats_dict, fout)
+    return file_path
+
+
+def test_face_store_round_trip(tmpdir):
+    file_path = _write_face_pickle(os.path.join(str(tmpdir), 'face_val.pickle'), 0)
+
+    video_infos = load_face_from_pickle(file_path)
+    store_infos = load_face_from_store(convert_face_pickle_to_store(file_path))
+
+    assert [video_info['video_name'] for video_info in store_infos] \
+        == [video_info['video_name'] for video_info in video_infos]
+    for video_info, store_info in zip(video_infos, store_infos):
+        assert video_info['video_ind'] == store_info['video_ind']
+        for column in FACE_STORE_COLUMNS:
+            pickle_column = [frame_info[column] for frame_info in video_info['frame_infos']]
+            assert len(store_info['frame_infos'][column]) == len(pickle_column)
+            if len(pickle_column) > 0:
+                assert np.array_equal(store_info['frame_infos'][column], np.array(pickle_column))
+
+
+def test_select_feats_by_mask():
+    feats = np.random.RandomState(0).randn(3, 5, 2048).astype(np.float32)
+    for seed in [0, 7, 15, 31]:
+        for split_num in [16, 32]:
+            mask_index = get_mask_index(seed, 2048, split_num)
+            assert np.array_equal(select_feats_by_mask(feats, mask_index), feats[..., mask_index])
+
+    # a mask of one run is a view of the feats, the others are copied
+    assert np.shares_memory(select_feats_by_mask(feats, get_mask_index(0, 2048, 16)), feats)
+    assert not np.shares_memory(select_feats_by_mask(feats, get_mask_index(3, 2048, 16)), feats)
+
+    mask_index = [0, 1, 5, 9, 10, 11, 2047]
+    assert get_mask_slices(mask_index) == [slice(0, 2), slice(5, 6), slice(9, 12), slice(2047, 2048)]
+    assert np.array_equal(select_feats_by_mask(feats, mask_index), feats[..., mask_index])
+
+
+def test_share_pack_memory():
+    pack = {'video_names': np.array(['IQIYI_VID_VAL_0000001', 'IQIYI_VID_VAL_12'], dtype='<U21'),
+            'labels': np.array([3, 10034], dtype=np.int64),
+            'face': {'start': np.array([0, 5], dtype=np.int32), 'score': np.array([.5, .25], dtype=np.float16)},
+            'tvt': 'val'}
+    shared_pack = share_pack_memory(pack)
+    assert shared_pack['labels'].is_shared() and shared_pack['face']['score'].is_shared()
+
+    arrays = get_pack_arrays(shared_pack)
+    assert arrays['tvt'] == 'val'
+    for key in ['video_names', 'labels']:
+        assert arrays[key].dtype == pack[key].dtype and np.array_equal(arrays[key], pack[key])
+    for key in ['start', 'score']:
+        assert arrays['face'][key].dtype == pack['face'][key].dtype
+        assert np.array_equal(arrays['face'][key], pack['face'][key])
+
+    # the arrays are views of the shared tensors, the pack is not copied again
+    assert np.shares_memory(arrays['labels'], shared_pack['labels'].numpy())
+    assert np.shares_memory(arrays['video_names'], shared_pack['video_names'][0].numpy())
+
+
+def _write_scene_pickle(file_path, seed, num_video=5, num_frame=3, feat_dim=2048):
+    """
+    a scene pickle like the ones of the extraction: every video name mapped to its (image index, float32 feat) frames
+    """
+    rng = np.random.RandomState(seed)
+    scene_infos = {}
+    for video_idx in range(num_video):
+        scene_infos['IQIYI_VID_VAL_{:0>7d}'.format(video_idx)] = \
+            [(frame_idx * 25 + 1, rng.randn(feat_dim).astype(np.float32)) for frame_idx in range(num_frame)]
+    with open(file_path, 'wb') as fout:
+        pickle.dump(scene_infos, fout)
+    return scene_infos
+
+
+def test_scene_store_round_trip(tmpdir):
+    file_path = os.path.join(str(tmpdir), 'scene_infos_val.pickle')
+    scene_infos = _write_scene_pickle(file_path, 0)
+
+    # the old pickle is read as it is until it is converted
+    assert sorted(load_scene_infos(file_path).keys()) == sorted(scene_infos.keys())
+    store_root = convert_scene_pickle_to_store(file_path)
+    assert store_root == get_scene_store_root(file_path)
+
+    store_infos = load_scene_infos(file_path)
+    scene_store = load_scene_store(store_root)
+    assert list(store_infos.keys()) == list(scene_infos.keys()) == scene_store['video_names'].tolist()
+    assert scene_store['image_stamps'] is None and scene_store['extract_infos'] is None
+    for video_idx, (video_name, frame_infos) in enumerate(scene_infos.items()):
+        feats = np.array([frame_info[1] for frame_info in frame_infos])
+        assert store_infos[video_name].dtype == SCENE_STORE_DTYPE
+        assert np.array_equal(store_infos[video_name], feats.astype(SCENE_STORE_DTYPE))
+        assert scene_store['image_indexes'][video_idx].tolist() == [frame_info[0] for frame_info in frame_infos]
+
+    # the store is written again in place
+    write_scene_store(store_root, ['IQIYI_VID_VAL_0000009'], [[1]], np.ones((1, 1, 2048)))
+    assert list(load_scene_infos(file_path).keys()) == ['IQIYI_VID_VAL_0000009']
+
+
+def test_load_or_build_pack(tmpdir):
+    cache_root = os.path.join(str(tmpdir), 'cache')
+    source_path = os.path.join(str(tmpdir), 'source.txt')
+    with open(source_path, 'w') as fout:
+        fout.write('a')
+
+    builds = []
+
+    def build_func():
+        builds.append(1)
+        return {'labels': np.arange(3), 'face': {'start': np.array([0, 2, 5], dtype=np.int32)}}
+
+    pack = load_or_build_pack(cache_root, 'face_val', [source_path], build_func, num_frame=40)
+    cache_pack = load_or_build_pack(cache_root, 'face_val', [source_path], build_func, num_frame=40)
+    assert len(builds) == 1
+    assert np.array_equal(cache_pack['labels'], pack['labels'])
+    assert np.array_equal(cache_pack['face']['start'], pack['face']['start'])
+
+    # other options, another name or a changed source file are other keys
+    load_or_build_pack(cache_root, 'face_val', [source_path], build_func, num_frame=20)
+    load_or_build_pack(cache_root, 'face_train', [source_path], build_func, num_frame=40)
+    with open(source_path, 'w') as fout:
+        fout.write('ab')
+    load_or_build_pack(cache_root, 'face_val', [source_path], build_func, num_frame=40)
+    assert len(builds) == 4
+    assert len(os.listdir(cache_root)) == 4
+
+    assert load_or_build_pack(None, 'face_val', [source_path], build_func) is not None
+    assert len(builds) == 5
+
+
+def test_evict_pack_caches(tmpdir):
+    cache_root = str(tmpdir)
+    dir_names = ['face_val_{:0>16x}'.format(idx) for idx in range(5)]
+    others = ['face_train_{:0>16x}'.format(0), 'face_val_{:0>16x}.tmp'.format(9)]
+    for mtime, dir_name in enumerate(dir_names + others):
+        os.makedirs(os.path.join(cache_root, dir_name))
+        os.utime(os.path.join(cache_root, dir_name), (mtime, mtime))
+    # the oldest one is used again and becomes the most recently used
+    os.utime(os.path.join(cache_root, dir_names[0]), (100, 100))
+
+    evict_pack_caches(cache_root, 'face_val', num_keep=2)
+    assert sorted(os.listdir(cache_root)) == sorted([dir_names[0], dir_names[4]] + others)
+
+
+def test_merge_result_stores(tmpdir):
+    result_root = str(tmpdir)
+    rng = np.random.RandomState(0)
+    video_names = ['IQIYI_VID_VAL_{:0>7d}'.format(video_idx) for video_idx in range(7)]
+    all_outputs = [rng.rand(len(video_names), 11).astype(np.float32) for _ in range(3)]
+
+    write_result_store(os.path.join(result_root, 'result_0' + STORE_SUFFIX), video_names, all_outputs[0], 2,
+                       chunk_size=3)
+    # the rows of another store in another order, and an old pickle converted on the way
+    order = rng.permutation(len(video_names))
+    write_result_store(os.path.join(result_root, 'result_1' + STORE_SUFFIX), [video_names[row] for row in order],
+                       all_outputs[1][order], 1)
+    with open(os.path.join(result_root, 'result_2.pickle'), 'wb') as fout:
+        pickle.dump((3, video_names, all_outputs[2]), fout)
+
+    store_roots = find_result_stores(result_root)
+    assert [os.path.basename(store_root) for store_root in store_roots] \
+        == ['result_{}{}'.format(idx, STORE_SUFFIX) for idx in range(3)]
+    result_store = load_result_store(store_roots[0])
+    assert result_store['output_num'] == 2 and result_store['video_names'].tolist() == video_names
+    assert np.array_equal(result_store['scores'], all_outputs[0])
+
+    weights = [1., .5, 2.]
+    ref_outputs = sum(np.float32(weight) * outputs for weight, outputs in zip(weights, all_outputs))
+    for save_root in [None, os.path.join(str(tmpdir), 'merged')]:
+        output_num, merged_video_names, output_sum = merge_result_stores(store_roots, save_root, weights, chunk_size=3)
+        assert output_num == 2 + .5 + 6 and merged_video_names == video_names
+        assert np.allclose(output_sum, ref_outputs)
+
+    # a video missing in a store is an error, not a silent zero
+    write_result_store(os.path.join(result_root, 'result_3' + STORE_SUFFIX), video_names[1:], all_outputs[0][1:])
+    with pytest.raises(RuntimeError):
+        merge_result_stores(find_result_stores(result_root))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 37, 100, 1000])
+def test_merge_class_topk(chunk_size):
+    scores = torch.randn(450, 7, generator=torch.Generator().manual_seed(chunk_size))
+
+    topk_values, topk_indexes = None, None
+    for row_start in range(0, scores.size(0), chunk_size):
+        topk_values, topk_indexes = merge_class_topk(topk_values, topk_indexes,
+                                                     scores[row_start:row_start + chunk_size], row_start, k=100)
+
+    full_values, full_indexes = torch.topk(scores, 100, dim=0)
+    assert torch.equal(topk_values, full_values)
+    assert torch.equal(topk_indexes, full_indexes)
+
+
+def _get_video_stats(file_path):
+    """
+    the per video stats computed from the frame infos of the baseline pickle loading
+    """
+    video_stats = {}
+    for video_info in load_face_from_pickle(file_path):
+        frame_infos = video_info['frame_infos']
+        if len(frame_infos) == 0:
+            video_stats[video_info['video_name']] = (0, None, None, None, None)
+            continue
+        norms = np.linalg.norm(np.array([frame_info['feat'] for frame_info in frame_infos], dtype=np.float32), axis=1)
+        video_stats[video_info['video_name']] = (len(frame_infos), np.mean(norms), np.max(norms),
+                                                 np.mean([frame_info['quality_score'] for frame_info in frame_infos]),
+                                                 np.mean([frame_info['det_score'] for frame_info in frame_infos]))
+    return video_stats
+
+
+def _check_face_stats(face_stats, video_stats):
+    assert face_stats['video_names'].tolist() == list(video_stats.keys())
+    for video_idx, (frame_num, mean_norm, max_norm, mean_quality, mean_det) in enumerate(video_stats.values()):
+        assert face_stats['frame_num'][video_idx] == frame_num
+        for key, value in zip(['mean_norm', 'max_norm', 'mean_quality', 'mean_det'],
+                              [mean_norm, max_norm, mean_quality, mean_det]):
+            if value is None:
+                assert np.isnan(face_stats[key][video_idx])
+            else:
+                assert np.isclose(face_stats[key][video_idx], value, rtol=1e-3)
+
+
+def test_face_stats(tmpdir):
+    file_path = _write_face_pickle(os.path.join(str(tmpdir), 'face_val.pickle'), 1, num_video=12)
+    video_stats = _get_video_stats(file_path)
+
+    _check_face_stats(build_face_stats(file_path), video_stats)
+    _check_face_stats(load_face_stats(file_path), video_stats)
+    assert os.path.exists(get_face_stats_path(file_path))
+    _check_face_stats(load_face_stats(file_path), video_stats)
+
+    # the store replaces the pickle as the source, the sidecar is rebuilt from it
+    convert_face_pickle_to_store(file_path)
+    _check_face_stats(load_face_stats(file_path), video_stats)
+
+    split_points = [22., 23.]
+    split_names = [[] for _ in range(len(split_points) + 1)]
+    for video_name, (frame_num, mean_norm, _, _, _) in video_stats.items():
+        if frame_num == 0:
+            split_names[0].append(video_name)
+        elif mean_norm < split_points[-1]:
+            split_names[1 if mean_norm < split_points[0] else 2].append(video_name)
+    assert split_name_by_l2norm(file_path, split_points) == split_names
+
+
+def test_face_stats_out_of_date(tmpdir):
+    file_path = _write_face_pickle(os.path.join(str(tmpdir), 'face_val.pickle'), 2)
+    load_face_stats(file_path)
+
+    _write_face_pickle(file_path, 3, num_video=9)
+    os.utime(file_path, (0, 0))
+    _check_face_stats(load_face_stats(file_path), _get_video_stats(file_path))
+
+
+def _make_image_root(image_root, video_frame_nums):
+    for video_name, frame_num in video_frame_nums.items():
+        os.makedirs(os.path.join(image_root, video_name))
+        for image_index in range(1, frame_num + 1):
+            open(os.path.join(image_root, video_name, '{}.jpg'.format(image_index)), 'w').close()
+    return image_root
+
+
+def _list_image_names(image_root):
+    """
+    the image names of every video dir by listdir, sorted by the image index
+    """
+    image_manifest = {}
+    for video_name in os.listdir(image_root):
+        video_root = os.path.join(image_root, video_name)
+        if os.path.isdir(video_root):
+            image_manifest[video_name] = sorted([image_name for image_name in os.listdir(video_root)
+                                                 if os.path.isfile(os.path.join(video_root, image_name))],
+                                                key=lambda image_name: int(os.path.splitext(image_name)[0]))
+    return image_manifest
+
+
+def test_load_image_manifest(tmpdir, monkeypatch):
+    video_frame_nums = {'IQIYI_VID_VAL_0000001': 12, 'IQIYI_VID_VAL_0000002': 3, 'IQIYI_VID_TRAIN_0000003': 0}
+    image_root = _make_image_root(str(tmpdir.mkdir('img')), video_frame_nums)
+    # the files beside the video dirs and the dirs inside them are not frames
+    open(os.path.join(image_root, 'list.txt'), 'w').close()
+    os.makedirs(os.path.join(image_root, 'IQIYI_VID_VAL_0000002', 'thumbs'))
+    cache_root = str(tmpdir.mkdir('cache'))
+
+    image_manifest = load_image_manifest(image_root, num_workers=2)
+    assert image_manifest == _list_image_names(image_root)
+    assert image_manifest['IQIYI_VID_VAL_0000001'][8:] == ['9.jpg', '10.jpg', '11.jpg', '12.jpg']
+    assert image_manifest['IQIYI_VID_VAL_0000002'] == ['1.jpg', '2.jpg', '3.jpg']
+    assert load_image_manifest(image_root, cache_root) == image_manifest
+
+    # with the manifest file only the video dirs with another mtime are scanned again
+    scanned_roots = []
+    utils_scan_image_names = utils._scan_image_names
+
+    def scan_image_names(video_root):
+        scanned_roots.append(os.path.basename(video_root))
+        return utils_scan_image_names(video_root)
+
+    monkeypatch.setattr(utils, '_scan_image_names', scan_image_names)
+    assert load_image_manifest(image_root, cache_root) == image_manifest
+    assert scanned_roots == []
+
+    video_root = os.path.join(image_root, 'IQIYI_VID_TRAIN_0000003')
+    open(os.path.join(video_root, '1.jpg'), 'w').close()
+    os.utime(video_root, (0, 0))
+    image_manifest = load_image_manifest(image_root, cache_root)
+    assert scanned_roots == ['IQIYI_VID_TRAIN_0000003']
+    assert image_manifest['IQIYI_VID_TRAIN_0000003'] == ['1.jpg']
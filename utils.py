@@ -4,10 +4,14 @@
 # @User    : legendong
 # @File    : utils.py
 # @Software: PyCharm
+import hashlib
+import json
 import logging
 import os
 import pickle
-import uuid
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -21,9 +25,41 @@ __all__ = ['init_logging', 'check_exists', 'load_train_gt_from_txt', 'load_val_g
            'default_fine_tune_pre_progress', 'default_fine_tune_transforms', 'default_fine_tune_target_transforms',
            'default_sep_select_scene_feat_transforms', 'default_face_scene_remove_noise_in_val',
            'default_face_scene_pre_progress', 'sep_cat_qds_face_scene_transforms',
-           'sep_cat_qds_select_face_scene_transforms']
+           'sep_cat_qds_select_face_scene_transforms', 'get_face_store_root', 'convert_face_pickle_to_store',
+           'load_face_store', 'load_face_from_store', 'load_face_infos', 'get_face_frame_num', 'build_face_store',
+           'pack_face_scene_vid_infos', 'sample_face_frame_indexes', 'sep_cat_qds_face_scene_batch_transforms',
+           'get_mask_slices', 'select_feats_by_mask', 'share_pack_memory', 'get_pack_arrays',
+           'get_scene_store_root', 'write_scene_store', 'build_scene_store', 'convert_scene_pickle_to_store',
+           'load_scene_store', 'get_files_fingerprint', 'save_pack_cache', 'load_pack_cache', 'load_or_build_pack',
+           'select_multi_view_inputs', 'get_result_store_root', 'write_result_store', 'load_result_store',
+           'convert_result_pickle_to_store', 'find_result_stores', 'merge_result_stores', 'merge_class_topk',
+           'get_face_stats_path', 'build_face_stats', 'load_face_stats', 'open_result_store', 'close_result_store',
+           'write_seed_manifest', 'load_seed_manifest', 'open_partial_scene_store', 'save_scene_progress',
+           'close_partial_scene_store', 'get_image_stamps', 'get_reused_frames', 'get_image_manifest_path',
+           'load_image_manifest', 'get_face_store_infos', 'load_face_source', 'get_scene_store_infos',
+           'load_scene_source', 'get_store_rows', 'pack_store_rows', 'gather_store_rows',
+           'evict_pack_caches']
 
 LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+STORE_SUFFIX = '_store'
+FACE_STORE_COLUMNS = ('frame_id', 'bbox', 'det_score', 'quality_score', 'feat')
+FACE_STORE_DTYPES = {'frame_id': np.int32, 'bbox': np.float32, 'det_score': np.float32,
+                     'quality_score': np.float32, 'feat': np.float16}
+SCENE_STORE_DTYPE = np.float16
+PARTIAL_STORE_SUFFIX = '.partial'
+RESULT_CHUNK_SIZE = 1024
+MERGED_RESULT_NAME = 'multi_view_merged'
+PACK_CACHE_VERSION = 2
+PACK_CACHE_NUM_KEEP = 4
+HASH_CHUNK_SIZE = 1 << 24
+FACE_NORM_CHUNK_SIZE = 1 << 20
+FACE_STATS_SUFFIX = '_stats.npz'
+FACE_STATS_KEYS = ('video_names', 'frame_num', 'mean_norm', 'max_norm', 'mean_quality', 'mean_det')
+SAMPLE_KEY_BUDGET = 1 << 22
+SCENE_CHUNK_SIZE = 1024
+MANIFEST_NUM_WORKERS = 32
+
 logger = logging.getLogger(__name__)
 
 
@@ -74,23 +110,115 @@ def topk_func(output, target, k=5):
     return correct / len(target)
 
 
+def merge_class_topk(topk_values, topk_indexes, scores, row_start, k=100):
+    """
+    merge a (num_row, num_classes) chunk of scores whose first row is row_start into the running top k of every class,
+    topk_values and topk_indexes are (k, num_classes) or None before the first chunk
+    """
+    scores = torch.as_tensor(scores)
+    row_indexes = torch.arange(row_start, row_start + scores.size(0), dtype=torch.long)
+    row_indexes = row_indexes.view(-1, 1).expand_as(scores)
+    if topk_values is not None:
+        scores = torch.cat([topk_values, scores], dim=0)
+        row_indexes = torch.cat([topk_indexes, row_indexes], dim=0)
+
+    topk_values, topk_idxes = torch.topk(scores, min(k, scores.size(0)), dim=0)
+    topk_indexes = torch.gather(row_indexes, 0, topk_idxes)
+
+    return topk_values, topk_indexes
+
+
 def default_get_result(output, video_names):
     values, indexes = torch.max(output, dim=1)
     return zip(indexes, values, video_names)
 
 
-def default_scene_pre_progress(tvt, image_root, num_frame=1, **kwargs):
+def _get_image_sort_key(image_name):
+    image_stem = os.path.splitext(image_name)[0]
+    return (0, int(image_stem), image_name) if image_stem.isdigit() else (1, 0, image_name)
+
+
+def _scan_image_names(video_root):
+    image_names = [entry.name for entry in os.scandir(video_root) if entry.is_file()]
+    return sorted(image_names, key=_get_image_sort_key)
+
+
+def get_image_manifest_path(image_root, cache_root):
+    root_key = hashlib.sha1(os.path.abspath(image_root).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_root, 'image_manifest_{}.npz'.format(root_key))
+
+
+def _load_image_manifest_file(manifest_path):
+    video_infos = {}
+    with np.load(manifest_path) as manifest:
+        frame_offsets = manifest['frame_offsets'].tolist()
+        image_names = manifest['image_names'].tolist()
+        video_mtimes = manifest['video_mtimes'].tolist()
+        for video_idx, (video_name, video_mtime) in enumerate(zip(manifest['video_names'].tolist(), video_mtimes)):
+            video_infos[video_name] = (video_mtime, image_names[frame_offsets[video_idx]:frame_offsets[video_idx + 1]])
+    return video_infos
+
+
+def _save_image_manifest_file(manifest_path, video_names, video_mtimes, image_manifest):
+    manifest_root = os.path.dirname(manifest_path)
+    if manifest_root and not os.path.exists(manifest_root):
+        os.makedirs(manifest_root)
+
+    frame_offsets = np.cumsum([0] + [len(image_manifest[video_name]) for video_name in video_names])
+    image_names = [image_name for video_name in video_names for image_name in image_manifest[video_name]]
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'wb') as fout:
+        np.savez(fout, video_names=np.array(video_names, dtype=np.str_),
+                 video_mtimes=np.array(video_mtimes, dtype=np.int64), frame_offsets=frame_offsets.astype(np.int64),
+                 image_names=np.array(image_names, dtype=np.str_))
+    os.replace(temp_path, manifest_path)
+
+
+def load_image_manifest(image_root, cache_root=None, num_workers=MANIFEST_NUM_WORKERS):
+    """
+    map every video dir of image_root to its image names sorted by image index, the dirs are scanned in parallel.
+    with cache_root the manifest is kept in a file and only the video dirs with another mtime are scanned again
+    """
+    manifest_path = get_image_manifest_path(image_root, cache_root) if cache_root is not None else None
+    video_infos = {}
+    if manifest_path is not None and os.path.exists(manifest_path):
+        video_infos = _load_image_manifest_file(manifest_path)
+
+    video_names = sorted(entry.name for entry in os.scandir(image_root) if entry.is_dir())
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        video_mtimes = list(executor.map(lambda video_name: os.stat(os.path.join(image_root, video_name)).st_mtime_ns,
+                                         video_names))
+        scan_video_names = [video_name for video_name, video_mtime in zip(video_names, video_mtimes)
+                            if video_infos.get(video_name, (None,))[0] != video_mtime]
+        scan_image_names = list(executor.map(lambda video_name: _scan_image_names(os.path.join(image_root, video_name)),
+                                             scan_video_names))
+
+    image_manifest = {video_name: video_infos[video_name][1] for video_name in video_names
+                      if video_name in video_infos}
+    image_manifest.update(zip(scan_video_names, scan_image_names))
+    logger.info('image manifest of {} has {} videos, {} of them scanned'.format(
+        image_root, len(video_names), len(scan_video_names)))
+
+    if manifest_path is not None and (len(scan_video_names) > 0 or len(video_infos) != len(video_names)):
+        _save_image_manifest_file(manifest_path, video_names, video_mtimes, image_manifest)
+        logger.info('save image manifest in {}'.format(manifest_path))
+
+    return image_manifest
+
+
+def default_scene_pre_progress(tvt, image_root, num_frame=1, image_manifest=None, **kwargs):
     image_paths = []
     video_names = []
     image_indexes = []
 
-    all_video_names = os.listdir(image_root)
-    for video_name in all_video_names:
+    if image_manifest is None:
+        image_manifest = load_image_manifest(image_root)
+    for video_name in sorted(image_manifest.keys()):
         if tvt in video_name.lower():
             video_image_root = os.path.join(image_root, video_name)
-            all_image_names = os.listdir(video_image_root)
+            all_image_names = image_manifest[video_name]
             for float_idx in np.linspace(1, len(all_image_names), num_frame, endpoint=True):
-                int_index = np.math.floor(float_idx) - 1
+                int_index = int(np.floor(float_idx)) - 1
 
                 image_name = all_image_names[int_index]
                 image_path = os.path.join(video_image_root, image_name)
@@ -122,6 +250,12 @@ def default_vid_transforms(vid_info, modes, num_frame=15, **kwargs):
     result = []
     for mode in modes:
         frames_infos = vid_info[mode]
+        if isinstance(frames_infos, dict):
+            frame_num = get_face_frame_num(frames_infos)
+            frame_idxes = np.random.choice(frame_num, num_frame, replace=frame_num < num_frame)
+            mean_feat = np.mean(frames_infos['feat'][frame_idxes], axis=0)
+            result.append(torch.from_numpy(mean_feat).float())
+            continue
         if len(frames_infos) < num_frame:
             frames_infos = np.random.choice(frames_infos, num_frame, replace=True)
         else:
@@ -179,6 +313,18 @@ def load_val_gt_from_txt(file_path):
     return val_gt_infos
 
 
+def _check_face_feat(face_feat, last_fame_num):
+    [frame_str, bbox, det_score, quality_score, feat] = face_feat
+    [x1, y1, x2, y2] = bbox
+    assert (int(frame_str) >= last_fame_num)
+    assert (0 <= x1 <= x2)
+    assert (0 <= y1 <= y2)
+    assert (type(det_score) == float)
+    assert (type(quality_score) == float)
+    assert (feat.dtype == np.float16 and (feat.shape[0] == 512 or feat.shape[0] == 2048))
+    return int(frame_str)
+
+
 def load_face_from_pickle(file_path):
     assert check_exists(file_path)
 
@@ -193,14 +339,7 @@ def load_face_from_pickle(file_path):
         frame_infos = []
         for ind, face_feat in enumerate(face_feats):
             [frame_str, bbox, det_score, quality_score, feat] = face_feat
-            [x1, y1, x2, y2] = bbox
-            assert (int(frame_str) >= last_fame_num)
-            last_fame_num = int(frame_str)
-            assert (0 <= x1 <= x2)
-            assert (0 <= y1 <= y2)
-            assert (type(det_score) == float)
-            assert (type(quality_score) == float)
-            assert (feat.dtype == np.float16 and (feat.shape[0] == 512 or feat.shape[0] == 2048))
+            last_fame_num = _check_face_feat(face_feat, last_fame_num)
 
             frame_infos.append({'frame_id': last_fame_num,
                                 'bbox': bbox,
@@ -215,37 +354,348 @@ def load_face_from_pickle(file_path):
     return video_infos
 
 
-def merge_multi_view_result(result_root, is_save=True):
+def get_face_store_root(file_path):
+    return os.path.splitext(file_path)[0] + STORE_SUFFIX
+
+
+def convert_face_pickle_to_store(file_path, store_root=None):
+    """
+    write the face pickle as a columnar store: one row per face in every column, and a CSR style
+    `offsets` table so the faces of the i-th video are rows offsets[i]:offsets[i + 1]
+    """
+    assert check_exists(file_path)
+    if store_root is None:
+        store_root = get_face_store_root(file_path)
+
+    with open(file_path, 'rb') as fin:
+        face_feats_dict = pickle.load(fin, encoding='bytes')
+
+    video_names = []
+    offsets = [0]
+    feat_dim = 512
+    for video_name, face_feats in face_feats_dict.items():
+        video_names.append(video_name.decode('utf-8'))
+        offsets.append(offsets[-1] + len(face_feats))
+        if len(face_feats) > 0:
+            feat_dim = face_feats[0][4].shape[0]
+    num_face = offsets[-1]
+
+    # write into a temp dir and rename it at the end, so a broken convert is never taken as a store
+    temp_root = store_root + '.tmp'
+    if not os.path.exists(temp_root):
+        os.makedirs(temp_root)
+
+    shapes = {'frame_id': (num_face,), 'bbox': (num_face, 4), 'det_score': (num_face,),
+              'quality_score': (num_face,), 'feat': (num_face, feat_dim)}
+    columns = {}
+    for column in FACE_STORE_COLUMNS:
+        columns[column] = np.lib.format.open_memmap(os.path.join(temp_root, '{}.npy'.format(column)), mode='w+',
+                                                    dtype=FACE_STORE_DTYPES[column], shape=shapes[column])
+
+    for video_ind, face_feats in enumerate(face_feats_dict.values()):
+        if len(face_feats) == 0:
+            continue
+        last_fame_num = 0
+        frame_ids = []
+        for face_feat in face_feats:
+            last_fame_num = _check_face_feat(face_feat, last_fame_num)
+            frame_ids.append(last_fame_num)
+        start, end = offsets[video_ind], offsets[video_ind + 1]
+        columns['frame_id'][start:end] = frame_ids
+        columns['bbox'][start:end] = [face_feat[1] for face_feat in face_feats]
+        columns['det_score'][start:end] = [face_feat[2] for face_feat in face_feats]
+        columns['quality_score'][start:end] = [face_feat[3] for face_feat in face_feats]
+        columns['feat'][start:end] = np.stack([face_feat[4] for face_feat in face_feats])
+
+    for column in FACE_STORE_COLUMNS:
+        columns[column].flush()
+    del columns
+
+    np.save(os.path.join(temp_root, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(temp_root, 'video_names.npy'), np.array(video_names, dtype=np.str_))
+
+    if os.path.exists(store_root):
+        shutil.rmtree(store_root)
+    os.rename(temp_root, store_root)
+    logger.info('convert {} to face store {} with {} videos and {} faces'
+                .format(file_path, store_root, len(video_names), num_face))
+
+    return store_root
+
+
+def load_face_store(store_root):
+    assert check_exists(store_root)
+
+    face_store = {}
+    for column in FACE_STORE_COLUMNS:
+        face_store[column] = np.load(os.path.join(store_root, '{}.npy'.format(column)), mmap_mode='r')
+    face_store['offsets'] = np.load(os.path.join(store_root, 'offsets.npy'))
+    face_store['video_names'] = np.load(os.path.join(store_root, 'video_names.npy'))
+
+    return face_store
+
+
+def get_face_store_infos(face_store):
+    offsets = face_store['offsets']
+
+    video_infos = []
+    for video_ind, video_name in enumerate(face_store['video_names'].tolist()):
+        start, end = offsets[video_ind], offsets[video_ind + 1]
+        # frame infos in a store are a dict of columns, every column is a lazy slice of the memmap
+        frame_infos = {column: face_store[column][start:end] for column in FACE_STORE_COLUMNS}
+        video_infos.append({
+            'video_ind': video_ind,
+            'video_name': video_name,
+            'frame_infos': frame_infos})
+
+    return video_infos
+
+
+def load_face_from_store(store_root):
+    return get_face_store_infos(load_face_store(store_root))
+
+
+def load_face_infos(file_path):
+    store_root = get_face_store_root(file_path)
+    if os.path.isdir(store_root):
+        logger.info('load face infos from store {}'.format(store_root))
+        return load_face_from_store(store_root)
+    return load_face_from_pickle(file_path)
+
+
+def load_face_source(file_path):
+    """
+    the face store of a face file: the memmapped store if there is one, or else an in-memory store of the pickle
+    """
+    store_root = get_face_store_root(file_path)
+    if os.path.isdir(store_root):
+        logger.info('load face store {}'.format(store_root))
+        return load_face_store(store_root)
+    video_infos = load_face_from_pickle(file_path)
+    return build_face_store([video_info['frame_infos'] for video_info in video_infos],
+                            [video_info['video_name'] for video_info in video_infos])
+
+
+def get_face_frame_num(frame_infos):
+    if isinstance(frame_infos, dict):
+        return len(frame_infos['feat'])
+    return len(frame_infos)
+
+
+def build_face_store(all_frame_infos, video_names):
+    """
+    pack the frame infos of many videos, either lists of dicts or dicts of columns, into an in-memory face store
+    """
+    assert len(all_frame_infos) == len(video_names)
+
+    offsets = np.zeros(len(all_frame_infos) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([get_face_frame_num(frame_infos) for frame_infos in all_frame_infos])
+
+    face_store = {'offsets': offsets, 'video_names': np.array(video_names, dtype=np.str_)}
+    for column in FACE_STORE_COLUMNS:
+        column_list = []
+        for frame_infos in all_frame_infos:
+            if isinstance(frame_infos, dict):
+                column_list.append(np.asarray(frame_infos[column], dtype=FACE_STORE_DTYPES[column]))
+            elif len(frame_infos) > 0:
+                column_list.append(np.array([frame_info[column] for frame_info in frame_infos],
+                                            dtype=FACE_STORE_DTYPES[column]))
+        face_store[column] = np.concatenate(column_list) if len(column_list) > 0 \
+            else np.zeros(0, dtype=FACE_STORE_DTYPES[column])
+
+    return face_store
+
+
+def get_result_store_root(result_root, result_name):
+    return os.path.join(result_root, result_name + STORE_SUFFIX)
+
+
+def open_result_store(store_root, shape, dtype=np.float32):
+    """
+    the scores memmap of a result store to fill row by row, the store only shows up in close_result_store
+    """
+    temp_root = store_root + '.tmp'
+    if not os.path.exists(temp_root):
+        os.makedirs(temp_root)
+    return np.lib.format.open_memmap(os.path.join(temp_root, 'scores.npy'), mode='w+', dtype=dtype, shape=shape)
+
+
+def close_result_store(store_root, scores, video_names, output_num=1):
+    assert len(video_names) == len(scores)
+    scores.flush()
+    del scores
+
+    temp_root = store_root + '.tmp'
+    np.save(os.path.join(temp_root, 'video_names.npy'), np.array(video_names, dtype=np.str_))
+    np.save(os.path.join(temp_root, 'output_num.npy'), np.array(output_num, dtype=np.float64))
+
+    if os.path.exists(store_root):
+        shutil.rmtree(store_root)
+    os.rename(temp_root, store_root)
+    logger.info('write result store {} with {} videos and output num {}'.format(
+        store_root, len(video_names), output_num))
+
+    return store_root
+
+
+def write_result_store(store_root, video_names, outputs, output_num=1, dtype=np.float32,
+                       chunk_size=RESULT_CHUNK_SIZE):
+    """
+    a result store keeps the (num_video, num_classes) sum of output_num model outputs as a memmap and the video names
+    """
+    if isinstance(outputs, torch.Tensor):
+        outputs = outputs.cpu().numpy()
+    assert len(video_names) == len(outputs)
+
+    scores = open_result_store(store_root, outputs.shape, dtype)
+    for start in range(0, len(outputs), chunk_size):
+        scores[start:start + chunk_size] = outputs[start:start + chunk_size]
+
+    return close_result_store(store_root, scores, video_names, output_num)
+
+
+def load_result_store(store_root):
+    assert check_exists(store_root)
+
+    result_store = {'scores': np.load(os.path.join(store_root, 'scores.npy'), mmap_mode='r'),
+                    'video_names': np.load(os.path.join(store_root, 'video_names.npy')),
+                    'output_num': np.load(os.path.join(store_root, 'output_num.npy')).item()}
+
+    return result_store
+
+
+def convert_result_pickle_to_store(file_path, store_root=None):
+    if store_root is None:
+        store_root = os.path.splitext(file_path)[0] + STORE_SUFFIX
+    with open(file_path, 'rb') as fin:
+        output_num, video_names, outputs = pickle.load(fin, encoding='bytes')
+    return write_result_store(store_root, video_names, outputs, output_num)
+
+
+def find_result_stores(result_root):
+    """
+    the result stores in result_root, the old (output_num, video_names, outputs) pickles are converted once and kept
+    """
     assert check_exists(result_root)
-    pickle_name_list = os.listdir(result_root)
-
-    output_num = 0
-    last_name_list = None
-    output_sum = .0
-    for pickle_name in pickle_name_list:
-        logger.info('load pickle file from {}'.format(pickle_name))
-        load_path = os.path.join(result_root, pickle_name)
-        if check_exists(load_path):
-            with open(os.path.join(result_root, pickle_name), 'rb') as fin:
-                pickle_file_data = pickle.load(fin, encoding='bytes')
-                output_num += pickle_file_data[0]
-                output_sum += pickle_file_data[2]
-                if last_name_list is not None and last_name_list != pickle_file_data[1]:
-                    logger.warning('the name list in {} is different from before'.format(pickle_name))
-                else:
-                    last_name_list = pickle_file_data[1]
-            os.remove(load_path)
-            logger.info('pickle file {} has been removed'.format(pickle_name))
-
-    pickle_file_data = (output_num, last_name_list, output_sum)
-
-    if is_save:
-        save_name = 'multi_view_face_{}.pickle'.format(uuid.uuid1())
-        logger.info('save pickle {} in {} with output num is {}'.format(save_name, result_root, output_num))
-        with open(os.path.join(result_root, save_name), 'wb') as fout:
-            pickle.dump(pickle_file_data, fout)
-
-    return pickle_file_data
+    file_names = sorted(os.listdir(result_root))
+    for file_name in file_names:
+        file_path = os.path.join(result_root, file_name)
+        if file_name.endswith('.pickle') and os.path.splitext(file_name)[0] + STORE_SUFFIX not in file_names:
+            logger.info('convert result pickle {} to store'.format(file_path))
+            convert_result_pickle_to_store(file_path)
+
+    return [os.path.join(result_root, dir_name) for dir_name in sorted(os.listdir(result_root))
+            if dir_name.endswith(STORE_SUFFIX) and check_exists(os.path.join(result_root, dir_name, 'scores.npy'))]
+
+
+def _get_result_rows(video_names, store_video_names, store_root):
+    if len(video_names) == len(store_video_names) and np.array_equal(video_names, store_video_names):
+        return None
+
+    name_rows = {video_name: row for row, video_name in enumerate(store_video_names)}
+    missing_names = [video_name for video_name in video_names if video_name not in name_rows]
+    if len(missing_names) > 0:
+        raise RuntimeError('{} videos like {} are missing in {}'.format(len(missing_names), missing_names[0],
+                                                                        store_root))
+    if len(name_rows) > len(video_names):
+        logger.warning('{} videos in {} are not in the first result and ignored'
+                       .format(len(name_rows) - len(video_names), store_root))
+    logger.info('align the rows of {} by video name'.format(store_root))
+
+    return np.array([name_rows[video_name] for video_name in video_names], dtype=np.int64)
+
+
+def merge_result_stores(store_roots, save_root=None, weights=None, chunk_size=RESULT_CHUNK_SIZE):
+    """
+    sum the scores of the stores chunk by chunk with the rows aligned by video name to the first store,
+    the output num is the weighted sum too, the merged scores go to a new store when save_root is given
+    """
+    assert len(store_roots) > 0
+    if weights is None:
+        weights = [1.] * len(store_roots)
+    assert len(weights) == len(store_roots)
+
+    result_stores = [load_result_store(store_root) for store_root in store_roots]
+    video_names = result_stores[0]['video_names']
+    all_rows = [_get_result_rows(video_names, result_store['video_names'], store_root)
+                for result_store, store_root in zip(result_stores, store_roots)]
+    output_num = sum(weight * result_store['output_num'] for weight, result_store in zip(weights, result_stores))
+
+    shape = (len(video_names), result_stores[0]['scores'].shape[1])
+    if save_root is not None:
+        output_sum = open_result_store(save_root, shape)
+    else:
+        output_sum = np.empty(shape, dtype=np.float32)
+
+    for start in range(0, shape[0], chunk_size):
+        end = min(start + chunk_size, shape[0])
+        chunk_sum = np.zeros((end - start, shape[1]), dtype=np.float32)
+        for result_store, rows, weight in zip(result_stores, all_rows, weights):
+            scores = result_store['scores'][start:end] if rows is None else result_store['scores'][rows[start:end]]
+            chunk_sum += np.float32(weight) * scores.astype(np.float32, copy=False)
+        output_sum[start:end] = chunk_sum
+
+    logger.info('merge {} result stores with output num {}'.format(len(store_roots), output_num))
+    if save_root is None:
+        return output_num, video_names.tolist(), output_sum
+
+    close_result_store(save_root, output_sum, video_names, output_num)
+    logger.info('save merged result store in {}'.format(save_root))
+
+    result_store = load_result_store(save_root)
+    return result_store['output_num'], result_store['video_names'].tolist(), result_store['scores']
+
+
+def merge_multi_view_result(result_root, is_save=True, weights=None):
+    """
+    merge every result in result_root without touching them, the merged store is saved in result_root as
+    multi_view_merged_store and only merged again when it is the one result left, weights maps the result names to
+    their weights (default: 1.)
+    """
+    merged_root = get_result_store_root(result_root, MERGED_RESULT_NAME)
+    store_roots = find_result_stores(result_root)
+    if len(store_roots) > 1:
+        store_roots = [store_root for store_root in store_roots
+                       if os.path.normpath(store_root) != os.path.normpath(merged_root)]
+    result_names = [os.path.basename(store_root)[:-len(STORE_SUFFIX)] for store_root in store_roots]
+    for store_root in store_roots:
+        logger.info('load result store from {}'.format(store_root))
+    if weights is not None:
+        weights = [weights.get(result_name, 1.) for result_name in result_names]
+
+    save_root = None
+    if is_save and [os.path.normpath(store_root) for store_root in store_roots] != [os.path.normpath(merged_root)]:
+        save_root = merged_root
+
+    return merge_result_stores(store_roots, save_root, weights)
+
+
+def write_seed_manifest(manifest_path, model_type, seeds, **infos):
+    """
+    the seeds chosen for the ensemble of model_type as json, with the infos of how they were chosen
+    """
+    manifest = dict(infos, model_type=model_type, seeds=[int(seed) for seed in seeds])
+    manifest_dir = os.path.dirname(manifest_path)
+    if manifest_dir and not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as fout:
+        json.dump(manifest, fout, indent=4, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+    logger.info('save seeds {} of {} in {}'.format(manifest['seeds'], model_type, manifest_path))
+
+    return manifest
+
+
+def load_seed_manifest(manifest_path, model_type=None):
+    assert check_exists(manifest_path)
+    with open(manifest_path, 'r') as fin:
+        manifest = json.load(fin)
+    if model_type is not None and manifest['model_type'] != model_type:
+        raise RuntimeError('{} keeps the seeds of {}, not {}'.format(
+            manifest_path, manifest['model_type'], model_type))
+    return [int(seed) for seed in manifest['seeds']]
 
 
 def get_mask_index(seed, feat_length, split_num):
@@ -262,13 +712,332 @@ def get_mask_index(seed, feat_length, split_num):
     return mask_index
 
 
-def load_scene_infos(file_path):
+def select_multi_view_inputs(inputs, input_index, scene_dim=2048):
+    """
+    take the feats of one multi view model from the unmasked (face feats, scene feats) or (scene feats, ) inputs
+    """
+    if len(inputs) == 2:
+        face_feats, scene_feats = inputs
+        face_index, scene_index = input_index
+        face_feats = face_feats.index_select(-1, face_index)
+        scene_feats = scene_feats.view(scene_feats.size(0), -1, scene_dim).index_select(-1, scene_index)
+        return face_feats, scene_feats.view(scene_feats.size(0), -1)
+
+    feats, = inputs
+    index, = input_index
+    feats = feats.view(feats.size(0), -1, scene_dim).index_select(-1, index)
+    return feats.view(feats.size(0), -1),
+
+
+def get_mask_slices(mask_index):
+    mask_index = np.asarray(mask_index, dtype=np.int64)
+    breaks = np.nonzero(np.diff(mask_index) != 1)[0] + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [len(mask_index)]])
+    return [slice(int(mask_index[start]), int(mask_index[end - 1]) + 1) for start, end in zip(starts, ends)]
+
+
+def select_feats_by_mask(feats, mask_index):
+    """
+    select the mask index on the last axis, a mask made of one run is a view, otherwise the runs are copied once
+    """
+    mask_slices = get_mask_slices(mask_index)
+    if len(mask_slices) == 1:
+        return feats[..., mask_slices[0]]
+    return np.concatenate([feats[..., mask_slice] for mask_slice in mask_slices], axis=-1)
+
+
+def get_scene_store_root(file_path):
+    return os.path.splitext(file_path)[0] + STORE_SUFFIX
+
+
+def write_scene_store(store_root, video_names, image_indexes, feats):
+    """
+    a scene store keeps (num_video, num_frame, dim) feats, (num_video, num_frame) image indexes and the video names
+    """
+    assert len(video_names) == len(image_indexes) == len(feats)
+
+    temp_root = store_root + '.tmp'
+    if not os.path.exists(temp_root):
+        os.makedirs(temp_root)
+
+    np.save(os.path.join(temp_root, 'feat.npy'), np.asarray(feats, dtype=SCENE_STORE_DTYPE))
+    np.save(os.path.join(temp_root, 'image_indexes.npy'), np.asarray(image_indexes, dtype=np.int32))
+    np.save(os.path.join(temp_root, 'video_names.npy'), np.array(video_names, dtype=np.str_))
+
+    if os.path.exists(store_root):
+        shutil.rmtree(store_root)
+    os.rename(temp_root, store_root)
+    logger.info('write scene store {} with {} videos'.format(store_root, len(video_names)))
+
+    return store_root
+
+
+def _save_scene_progress(partial_root, done, num_image, fingerprint):
+    temp_path = os.path.join(partial_root, 'progress.json.tmp')
+    with open(temp_path, 'w') as fout:
+        json.dump({'done': int(done), 'num_image': int(num_image), 'fingerprint': fingerprint}, fout)
+    os.replace(temp_path, os.path.join(partial_root, 'progress.json'))
+
+
+def open_partial_scene_store(store_root, num_image, feat_dim, fingerprint):
+    """
+    the (num_image, feat_dim) frame feats of an extraction in progress and the number of frames done,
+    the partial store of another extraction (another fingerprint) is started over
+    """
+    partial_root = store_root + PARTIAL_STORE_SUFFIX
+    progress_path = os.path.join(partial_root, 'progress.json')
+    if os.path.exists(progress_path):
+        with open(progress_path, 'r') as fin:
+            progress = json.load(fin)
+        if progress['fingerprint'] == fingerprint and progress['num_image'] == num_image:
+            feats = np.load(os.path.join(partial_root, 'feat.npy'), mmap_mode='r+')
+            if feats.shape == (num_image, feat_dim):
+                logger.info('resume partial scene store {} from frame {}'.format(partial_root, progress['done']))
+                return feats, progress['done']
+        logger.info('partial scene store {} is of another extraction, start it over'.format(partial_root))
+
+    if os.path.exists(partial_root):
+        shutil.rmtree(partial_root)
+    os.makedirs(partial_root)
+    feats = np.lib.format.open_memmap(os.path.join(partial_root, 'feat.npy'), mode='w+', dtype=SCENE_STORE_DTYPE,
+                                      shape=(num_image, feat_dim))
+    _save_scene_progress(partial_root, 0, num_image, fingerprint)
+    return feats, 0
+
+
+def save_scene_progress(store_root, feats, done, fingerprint):
+    """
+    flush the frame feats before the progress, so the frames before done are always on disk
+    """
+    feats.flush()
+    _save_scene_progress(store_root + PARTIAL_STORE_SUFFIX, done, len(feats), fingerprint)
+
+
+def get_image_stamps(image_paths):
+    """
+    the (size, mtime) of every image, to tell a changed image from the one extracted before
+    """
+    image_stamps = np.empty((len(image_paths), 2), dtype=np.int64)
+    for image_idx, image_path in enumerate(image_paths):
+        stat = os.stat(image_path)
+        image_stamps[image_idx] = (stat.st_size, stat.st_mtime_ns)
+    return image_stamps
+
+
+def get_reused_frames(scene_store, video_names, image_indexes, image_stamps):
+    """
+    the row in the flat (num_video * num_frame) frames of the scene store for every frame with the same
+    video name, image index and stamp, -1 for the new or changed frames
+    """
+    reused_frames = np.full(len(video_names), -1, dtype=np.int64)
+    if scene_store is None or scene_store.get('image_stamps') is None:
+        return reused_frames
+
+    store_frames = {}
+    num_frame = scene_store['image_indexes'].shape[1]
+    for video_idx, video_name in enumerate(scene_store['video_names'].tolist()):
+        for frame_idx, image_index in enumerate(scene_store['image_indexes'][video_idx].tolist()):
+            store_frames[(video_name, image_index)] = video_idx * num_frame + frame_idx
+
+    store_stamps = scene_store['image_stamps'].reshape(-1, 2)
+    for image_idx, (video_name, image_index) in enumerate(zip(video_names, image_indexes)):
+        store_frame = store_frames.get((video_name, int(image_index)), -1)
+        if store_frame >= 0 and (store_stamps[store_frame] == image_stamps[image_idx]).all():
+            reused_frames[image_idx] = store_frame
+    return reused_frames
+
+
+def close_partial_scene_store(store_root, feats, video_names, image_indexes, image_stamps=None, scene_store=None,
+                              extract_infos=None, chunk_size=SCENE_CHUNK_SIZE):
+    """
+    group the frame feats of the partial store by video into the scene store and remove the partial store,
+    the frames of a video are next to each other and every video has the same number of frames.
+    with the scene store before, the partial store only keeps the frames not reused by get_reused_frames,
+    the videos of the scene store not in video_names are kept after the others.
+    the extract infos are saved in the scene store for the next incremental extraction
+    """
+    assert len(video_names) == len(image_indexes)
+    if image_stamps is None:
+        image_stamps = np.full((len(video_names), 2), -1, dtype=np.int64)
+    feats.flush()
+
+    store_video_names = []
+    for video_name in video_names:
+        if len(store_video_names) == 0 or store_video_names[-1] != video_name:
+            store_video_names.append(video_name)
+    if len(set(store_video_names)) != len(store_video_names) or len(video_names) % max(len(store_video_names), 1) != 0:
+        raise RuntimeError('the frames of every video in {} should be together and of the same number'
+                           .format(store_root))
+    num_frame = len(video_names) // max(len(store_video_names), 1)
+    feat_dim = feats.shape[1]
+
+    # every frame is taken from the partial store (feat_rows) or from the scene store before (store_rows)
+    store_rows = get_reused_frames(scene_store, video_names, image_indexes, image_stamps)
+    if (store_rows < 0).sum() != len(feats):
+        raise RuntimeError('the partial store of {} has {} frames but {} frames are not reused'
+                           .format(store_root, len(feats), (store_rows < 0).sum()))
+    feat_rows = np.where(store_rows < 0, np.cumsum(store_rows < 0) - 1, -1)
+    image_indexes = np.asarray(image_indexes, dtype=np.int32).reshape(-1, num_frame)
+    image_stamps = np.asarray(image_stamps, dtype=np.int64).reshape(-1, num_frame, 2)
+
+    if scene_store is not None:
+        if scene_store['feat'].shape[1:] != (num_frame, feat_dim):
+            raise RuntimeError('the scene store {} has {} frames of {} dims, not {} of {}'.format(
+                store_root, scene_store['feat'].shape[1], scene_store['feat'].shape[2], num_frame, feat_dim))
+        listed_videos = set(store_video_names)
+        kept_videos = np.array([video_idx for video_idx, video_name in enumerate(scene_store['video_names'].tolist())
+                                if video_name not in listed_videos], dtype=np.int64)
+        kept_frames = (kept_videos[:, None] * num_frame + np.arange(num_frame)[None, :]).reshape(-1)
+        store_rows = np.concatenate([store_rows, kept_frames])
+        feat_rows = np.concatenate([feat_rows, np.full(len(kept_frames), -1, dtype=np.int64)])
+        store_video_names += scene_store['video_names'][kept_videos].tolist()
+        image_indexes = np.concatenate([image_indexes, scene_store['image_indexes'][kept_videos]])
+        if scene_store.get('image_stamps') is not None:
+            image_stamps = np.concatenate([image_stamps, scene_store['image_stamps'][kept_videos]])
+        else:
+            image_stamps = np.concatenate([image_stamps, np.full((len(kept_videos), num_frame, 2), -1,
+                                                                 dtype=np.int64)])
+        store_feats = scene_store['feat'].reshape(-1, feat_dim)
+        logger.info('reuse {} frames and keep {} videos of scene store {}'.format(
+            (store_rows >= 0).sum() - len(kept_frames), len(kept_videos), store_root))
+
+    temp_root = store_root + '.tmp'
+    if not os.path.exists(temp_root):
+        os.makedirs(temp_root)
+
+    new_feats = np.lib.format.open_memmap(os.path.join(temp_root, 'feat.npy'), mode='w+', dtype=SCENE_STORE_DTYPE,
+                                          shape=(len(store_video_names), num_frame, feat_dim))
+    for start in range(0, len(store_video_names), chunk_size):
+        frames = slice(start * num_frame, (start + chunk_size) * num_frame)
+        chunk_feats = np.empty((len(feat_rows[frames]), feat_dim), dtype=SCENE_STORE_DTYPE)
+        from_feats = feat_rows[frames] >= 0
+        chunk_feats[from_feats] = feats[feat_rows[frames][from_feats]]
+        if not from_feats.all():
+            chunk_feats[~from_feats] = store_feats[store_rows[frames][~from_feats]]
+        new_feats[start:start + chunk_size] = chunk_feats.reshape(-1, num_frame, feat_dim)
+    new_feats.flush()
+    del new_feats
+
+    np.save(os.path.join(temp_root, 'image_indexes.npy'), image_indexes)
+    np.save(os.path.join(temp_root, 'image_stamps.npy'), image_stamps)
+    np.save(os.path.join(temp_root, 'video_names.npy'), np.array(store_video_names, dtype=np.str_))
+    if extract_infos is not None:
+        with open(os.path.join(temp_root, 'extract_infos.json'), 'w') as fout:
+            json.dump(extract_infos, fout, sort_keys=True)
+
+    if os.path.exists(store_root):
+        shutil.rmtree(store_root)
+    os.rename(temp_root, store_root)
+    shutil.rmtree(store_root + PARTIAL_STORE_SUFFIX)
+    logger.info('write scene store {} with {} videos'.format(store_root, len(store_video_names)))
+
+    return store_root
+
+
+def build_scene_store(scene_infos):
+    video_names = list(scene_infos.keys())
+    image_indexes = np.array([[frame_info[0] for frame_info in scene_infos[video_name]]
+                              for video_name in video_names], dtype=np.int32)
+    feats = np.stack([_get_scene_feats(scene_infos[video_name]) for video_name in video_names])
+
+    return {'feat': feats, 'image_indexes': image_indexes, 'video_names': np.array(video_names, dtype=np.str_)}
+
+
+def convert_scene_pickle_to_store(file_path, store_root=None):
+    if store_root is None:
+        store_root = get_scene_store_root(file_path)
+    scene_store = build_scene_store(_load_scene_pickle(file_path))
+    return write_scene_store(store_root, scene_store['video_names'], scene_store['image_indexes'], scene_store['feat'])
+
+
+def load_scene_store(store_root):
+    assert check_exists(store_root)
+
+    scene_store = {'feat': np.load(os.path.join(store_root, 'feat.npy'), mmap_mode='r'),
+                   'image_indexes': np.load(os.path.join(store_root, 'image_indexes.npy')),
+                   'video_names': np.load(os.path.join(store_root, 'video_names.npy'))}
+    # the stores written before the stamps have none, all their frames count as changed
+    stamps_path = os.path.join(store_root, 'image_stamps.npy')
+    scene_store['image_stamps'] = np.load(stamps_path) if os.path.exists(stamps_path) else None
+    # the model and the options the store was extracted with, none for the stores of the old pickles
+    infos_path = os.path.join(store_root, 'extract_infos.json')
+    scene_store['extract_infos'] = None
+    if os.path.exists(infos_path):
+        with open(infos_path, 'r') as fin:
+            scene_store['extract_infos'] = json.load(fin)
+
+    return scene_store
+
+
+def _load_scene_pickle(file_path):
     assert check_exists(file_path)
     with open(file_path, 'rb') as fin:
         scene_infos = pickle.load(fin, encoding='bytes')
     return scene_infos
 
 
+def get_scene_store_infos(scene_store):
+    feats = scene_store['feat']
+    video_names = scene_store['video_names'].tolist()
+    return {video_name: feats[video_idx] for video_idx, video_name in enumerate(video_names)}
+
+
+def load_scene_infos(file_path):
+    """
+    map every video name to its scene feats, from the scene store if there is one or else from the old pickle
+    """
+    store_root = get_scene_store_root(file_path)
+    if os.path.isdir(store_root):
+        logger.info('load scene infos from store {}'.format(store_root))
+        return get_scene_store_infos(load_scene_store(store_root))
+    return _load_scene_pickle(file_path)
+
+
+def load_scene_source(file_path):
+    """
+    the scene store of a scene file: the memmapped store if there is one, or else an in-memory store of the pickle
+    """
+    store_root = get_scene_store_root(file_path)
+    if os.path.isdir(store_root):
+        logger.info('load scene store {}'.format(store_root))
+        return load_scene_store(store_root)
+    return build_scene_store(_load_scene_pickle(file_path))
+
+
+def get_store_rows(stores):
+    """
+    the (store index, row) of every video name in the stores, a later store wins like a dict update
+    """
+    store_rows = {}
+    for store_idx, store in enumerate(stores):
+        for row, video_name in enumerate(store['video_names'].tolist()):
+            store_rows[video_name] = (store_idx, row)
+    return store_rows
+
+
+def pack_store_rows(video_names, stores):
+    store_rows = get_store_rows(stores)
+    refs = np.array([store_rows[video_name] for video_name in video_names], dtype=np.int64).reshape(-1, 2)
+    return {'store': refs[:, 0], 'row': refs[:, 1]}
+
+
+def gather_store_rows(stores, column, store_idxes, rows):
+    """
+    take the rows of a column from several stores, store_idxes gives the store of every row,
+    only the pages of the rows taken are read from a memmapped store
+    """
+    columns = [store[column] for store in stores]
+    if len(columns) == 1:
+        return np.asarray(columns[0][rows])
+    values = np.empty(rows.shape + columns[0].shape[1:], dtype=np.result_type(*columns))
+    for store_idx, store_column in enumerate(columns):
+        selected = store_idxes == store_idx
+        if selected.any():
+            values[selected] = store_column[rows[selected]]
+    return values
+
+
 def default_scene_feat_pre_progress(scene_infos, gt_infos, **kwargs):
     all_frame_infos = []
     all_labels = []
@@ -296,24 +1065,24 @@ def default_scene_feat_remove_noise(frame_infos, labels, video_names, **kwargs):
     return frame_infos, labels, video_names
 
 
-def default_scene_feat_transforms(frame_infos, **kwargs):
-    temp_feats = []
-    for frame_info in frame_infos:
-        temp_feats.append(frame_info[1])
+def _get_scene_feats(scene_frame_infos, scene_mask=None):
+    if isinstance(scene_frame_infos, np.ndarray):
+        feats = scene_frame_infos
+    else:
+        feats = np.array([frame_info[1] for frame_info in scene_frame_infos])
+    if scene_mask is not None:
+        feats = feats[:, scene_mask]
+    return feats
+
 
-    feats = torch.from_numpy(np.array(temp_feats).reshape(-1)).float()
+def default_scene_feat_transforms(frame_infos, **kwargs):
+    feats = torch.from_numpy(np.array(_get_scene_feats(frame_infos).reshape(-1), dtype=np.float32))
 
     return feats
 
 
 def default_sep_select_scene_feat_transforms(frame_infos, mask_index=None, **kwargs):
-    temp_feats = []
-
-    for frame_info in frame_infos:
-        temp_feat = frame_info[1][mask_index]
-        temp_feats.append(temp_feat)
-
-    feats = torch.from_numpy(np.array(temp_feats).reshape(-1)).float()
+    feats = torch.from_numpy(np.array(_get_scene_feats(frame_infos, mask_index).reshape(-1), dtype=np.float32))
 
     return feats
 
@@ -324,6 +1093,96 @@ def default_scene_feat_target_transforms(label, **kwargs):
     return label_torch
 
 
+def _get_face_store_norms(face_store):
+    feats = face_store['feat']
+    norms = np.empty(feats.shape[0], dtype=feats.dtype)
+    for start in range(0, feats.shape[0], FACE_NORM_CHUNK_SIZE):
+        norms[start:start + FACE_NORM_CHUNK_SIZE] = np.linalg.norm(feats[start:start + FACE_NORM_CHUNK_SIZE], axis=1)
+    return norms
+
+
+def get_face_stats_path(file_path):
+    return os.path.splitext(file_path)[0] + FACE_STATS_SUFFIX
+
+
+def _iter_face_stats_frames(file_path):
+    store_root = get_face_store_root(file_path)
+    if os.path.isdir(store_root):
+        face_store = load_face_store(store_root)
+        offsets = face_store['offsets']
+        norms = _get_face_store_norms(face_store)
+        for video_ind, video_name in enumerate(face_store['video_names'].tolist()):
+            start, end = offsets[video_ind], offsets[video_ind + 1]
+            yield video_name, norms[start:end], face_store['quality_score'][start:end], \
+                face_store['det_score'][start:end]
+        return
+
+    with open(file_path, 'rb') as fin:
+        face_feats_dict = pickle.load(fin, encoding='bytes')
+    for video_name, face_feats in face_feats_dict.items():
+        if len(face_feats) == 0:
+            yield video_name.decode('utf-8'), np.empty(0), np.empty(0), np.empty(0)
+            continue
+        feats_np = np.array([face_feat[4] for face_feat in face_feats])
+        yield video_name.decode('utf-8'), np.linalg.norm(feats_np, axis=1), \
+            np.array([face_feat[3] for face_feat in face_feats]), np.array([face_feat[2] for face_feat in face_feats])
+
+
+def build_face_stats(file_path):
+    """
+    per video frame num, mean and max feat l2 norm, mean quality and det score, nan for the videos without face,
+    read from the face store when there is one
+    """
+    video_names = []
+    face_stats = {key: [] for key in FACE_STATS_KEYS if key != 'video_names'}
+    for video_name, norms, quality_scores, det_scores in _iter_face_stats_frames(file_path):
+        video_names.append(video_name)
+        face_stats['frame_num'].append(len(norms))
+        if len(norms) == 0:
+            for key in ('mean_norm', 'max_norm', 'mean_quality', 'mean_det'):
+                face_stats[key].append(np.nan)
+            continue
+        face_stats['mean_norm'].append(np.mean(norms))
+        face_stats['max_norm'].append(np.max(norms))
+        face_stats['mean_quality'].append(np.mean(quality_scores))
+        face_stats['mean_det'].append(np.mean(det_scores))
+
+    face_stats = {key: np.array(value, dtype=np.int64 if key == 'frame_num' else np.float32)
+                  for key, value in face_stats.items()}
+    face_stats['video_names'] = np.array(video_names, dtype=np.str_)
+
+    return face_stats
+
+
+def load_face_stats(file_path):
+    """
+    the per video face stats from the sidecar index beside the pickle, built once and rebuilt when the pickle
+    or its store changes
+    """
+    stats_path = get_face_stats_path(file_path)
+    store_root = get_face_store_root(file_path)
+    source_path = store_root if os.path.isdir(store_root) else file_path
+    fingerprint = json.dumps(get_files_fingerprint([source_path]), sort_keys=True)
+
+    if os.path.exists(stats_path):
+        with np.load(stats_path) as fin:
+            if fin['fingerprint'].item() == fingerprint:
+                return {key: fin[key] for key in FACE_STATS_KEYS}
+        logger.info('face stats {} is out of date, rebuild it'.format(stats_path))
+
+    face_stats = build_face_stats(file_path)
+    temp_path = stats_path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as fout:
+            np.savez(fout, fingerprint=np.array(fingerprint), **face_stats)
+        os.replace(temp_path, stats_path)
+        logger.info('save face stats of {} videos in {}'.format(len(face_stats['video_names']), stats_path))
+    except OSError as err:
+        logger.warning('can not save face stats in {}: {}'.format(stats_path, err))
+
+    return face_stats
+
+
 def split_name_by_l2norm(file_path, split_points):
     if not isinstance(split_points, list):
         if isinstance(split_points, tuple):
@@ -332,35 +1191,32 @@ def split_name_by_l2norm(file_path, split_points):
             split_points = [split_points]
     split_points.sort()
     split_names = [[] for _ in range(len(split_points) + 1)]
-    video_infos = load_face_from_pickle(file_path)
 
-    for video_info in video_infos:
-        feat_list = []
-        frame_infos = video_info['frame_infos']
-        if len(frame_infos) == 0:
-            split_names[0].append(video_info['video_name'])
+    face_stats = load_face_stats(file_path)
+    for video_name, frame_num, norm_value in zip(face_stats['video_names'].tolist(), face_stats['frame_num'].tolist(),
+                                                 face_stats['mean_norm'].tolist()):
+        if frame_num == 0:
+            split_names[0].append(video_name)
             continue
-        for frame_info in frame_infos:
-            feat_list.append(frame_info['feat'])
-        feats_np = np.array(feat_list)
-        norm_value = np.mean(np.linalg.norm(feats_np, axis=1))
         for split_idx, split_point in enumerate(split_points):
             if norm_value < split_point:
-                split_names[split_idx + 1].append(video_info['video_name'])
+                split_names[split_idx + 1].append(video_name)
                 break
     logger.info('split data set by {} over.'.format(' '.join([str(point) for point in split_points])))
 
     return split_names
 
 
-def default_fine_tune_pre_progress(gt_infos, image_root, **kwargs):
+def default_fine_tune_pre_progress(gt_infos, image_root, image_manifest=None, **kwargs):
     image_paths = []
     labels = []
     video_names = []
 
+    if image_manifest is None:
+        image_manifest = load_image_manifest(image_root)
     for video_name, label in gt_infos.items():
         video_root = os.path.join(image_root, video_name, )
-        image_list = os.listdir(video_root)
+        image_list = image_manifest[video_name]
 
         temp_list = [os.path.join(video_root, image_list[idx])
                      for idx in [0, len(image_list) // 2, len(image_list) - 1]]
@@ -387,7 +1243,7 @@ def default_face_scene_pre_progress(face_feat_infos, scene_feat_infos, gt_infos,
     for face_feat_info in face_feat_infos:
         frame_infos = face_feat_info['frame_infos']
         video_name = face_feat_info['video_name']
-        if len(frame_infos) > 0:
+        if get_face_frame_num(frame_infos) > 0:
             vid_infos.setdefault(video_name, {})['face'] = frame_infos
             vid_infos.setdefault(video_name, {})['scene'] = scene_feat_infos[video_name]
             vid_infos.setdefault(video_name, {})['label'] = gt_infos.get(video_name, 0)
@@ -395,61 +1251,161 @@ def default_face_scene_pre_progress(face_feat_infos, scene_feat_infos, gt_infos,
     return list(vid_infos.values())
 
 
-def sep_cat_qds_face_scene_transforms(vid_info, num_frame=15, norm_value=100., **kwargs):
-    result = []
-    face_frame_infos = vid_info['face']
+def _sample_face_feats(face_frame_infos, num_frame, norm_value, face_mask=None, feat_dtype=np.float32):
+    # the feat, quality and det score of a frame are written straight into one array of feat_dtype
+    if isinstance(face_frame_infos, dict):
+        frame_num = get_face_frame_num(face_frame_infos)
+        frame_idxes = np.random.choice(frame_num, num_frame, replace=frame_num < num_frame)
+        feats = face_frame_infos['feat'][frame_idxes]
+        if face_mask is not None:
+            feats = feats[:, face_mask]
+        face_feats = np.empty((num_frame, feats.shape[1] + 2), dtype=feat_dtype)
+        face_feats[:, :-2] = feats
+        face_feats[:, -2] = face_frame_infos['quality_score'][frame_idxes] / np.float32(norm_value)
+        face_feats[:, -1] = face_frame_infos['det_score'][frame_idxes]
+        return face_feats
+
     if len(face_frame_infos) < num_frame:
         frames_infos = np.random.choice(face_frame_infos, num_frame, replace=True)
     else:
         frames_infos = np.random.choice(face_frame_infos, num_frame, replace=False)
-    face_feats = []
-    for frame_info in frames_infos:
+    face_feats = None
+    for frame_idx, frame_info in enumerate(frames_infos):
         feat = frame_info['feat']
-        feat = np.append(feat, frame_info['quality_score'] / norm_value)
-        feat = np.append(feat, frame_info['det_score'])
-        face_feats.append(feat)
-    feats = np.array(face_feats)
-    result.append(torch.from_numpy(feats).float())
-
-    scene_frame_infos = vid_info['scene']
-    scene_feats = []
-    for frame_info in scene_frame_infos:
-        temp_feat = frame_info[1]
-        scene_feats.append(temp_feat)
-    feats = np.array(scene_feats).reshape(-1)
-    result.append(torch.from_numpy(feats).float())
+        if face_mask is not None:
+            feat = feat[face_mask]
+        if face_feats is None:
+            face_feats = np.empty((num_frame, feat.shape[0] + 2), dtype=feat_dtype)
+        face_feats[frame_idx, :-2] = feat
+        face_feats[frame_idx, -2] = frame_info['quality_score'] / norm_value
+        face_feats[frame_idx, -1] = frame_info['det_score']
+    return face_feats
+
+
+def sep_cat_qds_face_scene_transforms(vid_info, num_frame=15, norm_value=100., feat_dtype=np.float32, **kwargs):
+    result = []
+    feats = _sample_face_feats(vid_info['face'], num_frame, norm_value, feat_dtype=feat_dtype)
+    result.append(torch.from_numpy(feats))
+
+    feats = np.array(_get_scene_feats(vid_info['scene']).reshape(-1), dtype=np.float32)
+    result.append(torch.from_numpy(feats))
 
     return result
 
 
 def sep_cat_qds_select_face_scene_transforms(vid_info, face_mask=None, scene_mask=None, num_frame=15, norm_value=100.,
-                                             **kwargs):
+                                             feat_dtype=np.float32, **kwargs):
     result = []
-    face_frame_infos = vid_info['face']
-    if len(face_frame_infos) < num_frame:
-        frames_infos = np.random.choice(face_frame_infos, num_frame, replace=True)
-    else:
-        frames_infos = np.random.choice(face_frame_infos, num_frame, replace=False)
-    face_feats = []
-    for frame_info in frames_infos:
-        feat = frame_info['feat']
-        if face_mask is not None:
-            feat = feat[face_mask]
-        feat = np.append(feat, frame_info['quality_score'] / norm_value)
-        feat = np.append(feat, frame_info['det_score'])
-        face_feats.append(feat)
-    feats = np.array(face_feats)
-    result.append(torch.from_numpy(feats).float())
-
-    scene_frame_infos = vid_info['scene']
-    scene_feats = []
-    for frame_info in scene_frame_infos:
-        feat = frame_info[1]
-        if scene_mask is not None:
-            feat = feat[scene_mask]
-        scene_feats.append(feat)
-    feats = np.array(scene_feats).reshape(-1)
-    result.append(torch.from_numpy(feats).float())
+    feats = _sample_face_feats(vid_info['face'], num_frame, norm_value, face_mask, feat_dtype)
+    result.append(torch.from_numpy(feats))
+
+    feats = np.array(_get_scene_feats(vid_info['scene'], scene_mask).reshape(-1), dtype=np.float32)
+    result.append(torch.from_numpy(feats))
+
+    return result
+
+
+def pack_face_scene_vid_infos(vid_infos, face_stores, scene_stores):
+    """
+    pack the vid infos into small index arrays, the feats stay in the stores: the faces of the i-th video are the rows
+    face.start[i]:face.end[i] of the face store face.store[i] and its scene feats the row scene.row[i] of the scene
+    store scene.store[i]
+    """
+    video_names = [vid_info['video_name'] for vid_info in vid_infos]
+    face_refs = pack_store_rows(video_names, face_stores)
+    face_starts = np.zeros(len(video_names), dtype=np.int64)
+    face_ends = np.zeros(len(video_names), dtype=np.int64)
+    for store_idx, face_store in enumerate(face_stores):
+        selected = face_refs['store'] == store_idx
+        face_starts[selected] = face_store['offsets'][face_refs['row'][selected]]
+        face_ends[selected] = face_store['offsets'][face_refs['row'][selected] + 1]
+    labels = np.array([vid_info['label'] for vid_info in vid_infos], dtype=np.int64)
+
+    return {'face': {'store': face_refs['store'], 'start': face_starts, 'end': face_ends},
+            'scene': pack_store_rows(video_names, scene_stores), 'labels': labels,
+            'video_names': np.array(video_names, dtype=np.str_)}
+
+
+def share_pack_memory(pack):
+    """
+    copy every array of the pack into a shared memory tensor, workers attach to it instead of copying it,
+    a str array is shared as the int32 code points of its chars together with its dtype
+    """
+    if isinstance(pack, dict):
+        return {key: share_pack_memory(value) for key, value in pack.items()}
+    if isinstance(pack, np.ndarray) and pack.dtype.kind == 'U':
+        chars = np.ascontiguousarray(pack).view(np.int32).reshape(pack.shape + (pack.dtype.itemsize // 4,))
+        return share_pack_memory(chars), pack.dtype
+    if isinstance(pack, np.ndarray) and pack.dtype.kind in 'biuf':
+        tensor_dtype = torch.from_numpy(np.empty(0, dtype=pack.dtype)).dtype
+        shared_tensor = torch.empty(pack.shape, dtype=tensor_dtype).share_memory_()
+        shared_tensor.numpy()[...] = pack
+        return shared_tensor
+    return pack
+
+
+def get_pack_arrays(shared_pack):
+    if isinstance(shared_pack, dict):
+        return {key: get_pack_arrays(value) for key, value in shared_pack.items()}
+    if isinstance(shared_pack, tuple):
+        shared_chars, str_dtype = shared_pack
+        chars = shared_chars.numpy()
+        return chars.view(str_dtype).reshape(chars.shape[:-1])
+    if isinstance(shared_pack, torch.Tensor):
+        return shared_pack.numpy()
+    return shared_pack
+
+
+def sample_face_frame_indexes(frame_nums, num_frame):
+    """
+    draw num_frame frame indexes for every video at once, with replacement only for the videos shorter than num_frame
+    """
+    frame_nums = np.asarray(frame_nums, dtype=np.int64)
+    frame_idxes = np.floor(np.random.rand(len(frame_nums), num_frame) * frame_nums[:, None]).astype(np.int64)
+
+    # without replacement: take the num_frame smallest of random keys, the longest videos first to bound the keys size
+    rows = np.nonzero(frame_nums >= num_frame)[0]
+    rows = rows[np.argsort(-frame_nums[rows], kind='stable')]
+    start = 0
+    while start < len(rows):
+        max_num = frame_nums[rows[start]]
+        chunk_rows = rows[start:start + max(1, SAMPLE_KEY_BUDGET // max_num)]
+        keys = np.random.rand(len(chunk_rows), max_num)
+        keys[np.arange(max_num)[None, :] >= frame_nums[chunk_rows][:, None]] = 2.
+        chunk_idxes = np.argpartition(keys, num_frame - 1, axis=1)[:, :num_frame]
+        chunk_order = np.argsort(np.take_along_axis(keys, chunk_idxes, axis=1), axis=1)
+        frame_idxes[chunk_rows] = np.take_along_axis(chunk_idxes, chunk_order, axis=1)
+        start += len(chunk_rows)
+
+    return frame_idxes
+
+
+def sep_cat_qds_face_scene_batch_transforms(pack, indexes, face_stores, scene_stores, face_mask=None, scene_mask=None,
+                                            num_frame=15, norm_value=100., feat_dtype=np.float32, **kwargs):
+    result = []
+    indexes = np.asarray(indexes, dtype=np.int64)
+
+    # only the sampled faces and the scene feats of the batch are gathered from the stores
+    starts = pack['face']['start'][indexes]
+    frame_nums = pack['face']['end'][indexes] - starts
+    face_idxes = starts[:, None] + sample_face_frame_indexes(frame_nums, num_frame)
+    store_idxes = np.broadcast_to(pack['face']['store'][indexes][:, None], face_idxes.shape)
+
+    feats = gather_store_rows(face_stores, 'feat', store_idxes, face_idxes)
+    if face_mask is not None:
+        feats = feats[..., face_mask]
+    face_feats = np.empty(feats.shape[:-1] + (feats.shape[-1] + 2,), dtype=feat_dtype)
+    face_feats[..., :-2] = feats
+    face_feats[..., -2] = gather_store_rows(face_stores, 'quality_score', store_idxes, face_idxes) \
+        / np.float32(norm_value)
+    face_feats[..., -1] = gather_store_rows(face_stores, 'det_score', store_idxes, face_idxes)
+    result.append(torch.from_numpy(face_feats))
+
+    feats = gather_store_rows(scene_stores, 'feat', pack['scene']['store'][indexes], pack['scene']['row'][indexes])
+    if scene_mask is not None:
+        feats = feats[..., scene_mask]
+    # feat_dtype is only for the face feats, the scene feats are float32 like in the default mode
+    result.append(torch.from_numpy(feats.reshape(len(indexes), -1).astype(np.float32, copy=False)))
 
     return result
 
@@ -462,3 +1418,115 @@ def default_face_scene_remove_noise_in_val(vid_infos, **kwargs):
                 or (vid_info['label'] != 0 and 'AUG' in vid_info['video_name']):
             idx_list.append(idx)
     return [vid_infos[idx] for idx in idx_list]
+
+
+def _get_file_fingerprint(file_path, hash_content=False):
+    stat = os.stat(file_path)
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if hash_content:
+        sha1 = hashlib.sha1()
+        with open(file_path, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(HASH_CHUNK_SIZE), b''):
+                sha1.update(chunk)
+        fingerprint['sha1'] = sha1.hexdigest()
+    return fingerprint
+
+
+def get_files_fingerprint(file_paths, hash_content=False):
+    """
+    size and mtime (and the content hash if asked) of every file, a dir counts as all the files in it
+    """
+    fingerprint = {}
+    for file_path in file_paths:
+        file_path = os.path.abspath(file_path)
+        if os.path.isdir(file_path):
+            for dir_path, _, file_names in os.walk(file_path):
+                for file_name in sorted(file_names):
+                    sub_path = os.path.join(dir_path, file_name)
+                    fingerprint[sub_path] = _get_file_fingerprint(sub_path, hash_content)
+        elif os.path.exists(file_path):
+            fingerprint[file_path] = _get_file_fingerprint(file_path, hash_content)
+        else:
+            fingerprint[file_path] = None
+    return fingerprint
+
+
+def save_pack_cache(cache_dir, pack, prefix=''):
+    if prefix == '':
+        temp_dir = cache_dir + '.tmp'
+        if not os.path.exists(temp_dir):
+            os.makedirs(temp_dir)
+    else:
+        temp_dir = cache_dir
+
+    for key, value in pack.items():
+        if isinstance(value, dict):
+            save_pack_cache(temp_dir, value, prefix='{}{}.'.format(prefix, key))
+        else:
+            np.save(os.path.join(temp_dir, '{}{}.npy'.format(prefix, key)), np.asarray(value))
+
+    if prefix == '':
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.rename(temp_dir, cache_dir)
+        logger.info('save pack cache in {}'.format(cache_dir))
+
+
+def load_pack_cache(cache_dir):
+    assert check_exists(cache_dir)
+
+    pack = {}
+    for file_name in sorted(os.listdir(cache_dir)):
+        keys = os.path.splitext(file_name)[0].split('.')
+        sub_pack = pack
+        for key in keys[:-1]:
+            sub_pack = sub_pack.setdefault(key, {})
+        sub_pack[keys[-1]] = np.load(os.path.join(cache_dir, file_name), mmap_mode='r')
+    logger.info('load pack cache from {}'.format(cache_dir))
+
+    return pack
+
+
+def load_or_build_pack(cache_root, cache_name, source_paths, build_func, hash_content=False, **options):
+    """
+    load the pack built by build_func from the cache, the key is the fingerprint of the source files and the options,
+    so the cache is rebuilt as soon as any source file changes
+    """
+    if cache_root is None:
+        return build_func()
+
+    key_infos = {'version': PACK_CACHE_VERSION,
+                 'name': cache_name,
+                 'options': options,
+                 'files': get_files_fingerprint(source_paths, hash_content)}
+    cache_key = hashlib.sha1(json.dumps(key_infos, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    cache_dir = os.path.join(cache_root, '{}_{}'.format(cache_name, cache_key))
+
+    if os.path.isdir(cache_dir):
+        # the mtime of a cache is the time it was last used, the least recently used caches are evicted first
+        os.utime(cache_dir)
+        return load_pack_cache(cache_dir)
+
+    pack = build_func()
+
+    if not os.path.exists(cache_root):
+        os.makedirs(cache_root)
+    save_pack_cache(cache_dir, pack)
+    evict_pack_caches(cache_root, cache_name)
+
+    return pack
+
+
+def evict_pack_caches(cache_root, cache_name, num_keep=PACK_CACHE_NUM_KEEP):
+    """
+    keep the num_keep most recently used caches of cache_name, caches of other names and the .tmp dirs still being
+    written are never touched
+    """
+    cache_pattern = re.compile(r'^{}_[0-9a-f]{{16}}$'.format(re.escape(cache_name)))
+    cache_dirs = [os.path.join(cache_root, dir_name) for dir_name in os.listdir(cache_root)
+                  if cache_pattern.match(dir_name) is not None]
+    cache_dirs.sort(key=lambda cache_dir: os.stat(cache_dir).st_mtime_ns, reverse=True)
+
+    for cache_dir in cache_dirs[num_keep:]:
+        logger.info('evict the least recently used pack cache {}'.format(cache_dir))
+        shutil.rmtree(cache_dir, ignore_errors=True)